@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the work a call does before it touches the network:
+binding and encoding its parameters and building the request.
+
+    legacy - the per-call parameter walk CallPlan replaced, plus urlencode
+    plan - CallPlan.bind (which also fills the path), plus encode_query
+    request - APIMethod construction plus build_request
+
+    python benchmarks/bench_bind.py
+"""
+
+import os
+import sys
+import timeit
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from posterous.api import PostyAPI
+from posterous.bind import encode_query, encode_value
+from posterous.utils import enc_utf8_str
+
+
+def legacy_build_parameters(allowed_params, args, kwargs):
+    """The previous APIMethod._build_parameters, kept for comparison."""
+    parameters = []
+    args = list(args)
+    args.reverse()
+    for name, p_type in allowed_params:
+        value = None
+        if args:
+            value = args.pop()
+        if name in kwargs:
+            if not value:
+                value = kwargs.pop(name)
+            else:
+                raise TypeError('Multiple values for parameter {0} supplied!'.format(name))
+        if not value:
+            continue
+        if not isinstance(p_type, tuple):
+            p_type = (p_type,)
+        if not isinstance(value, p_type):
+            raise TypeError(name)
+        if isinstance(value, list):
+            for val in value:
+                if isinstance(val, list) or not isinstance(val, p_type):
+                    raise TypeError(name)
+            for val in value:
+                parameters.append(('{0}[]'.format(name), enc_utf8_str(val)))
+            continue
+        parameters.append((name, encode_value(value)))
+    return parameters
+
+
+CALLS = [
+    ('get_sites', (), {}),
+    ('get_site', (), {'hostname': 'sachin'}),
+    ('read_posts', (1,), {'page': 3, 'num_posts': 50, 'tag': 'travel'}),
+    ('create_site', (), {'name': 'new site', 'is_private': True, 'hostname': 'new'}),
+]
+
+
+def best_of(func, number=20000, repeat=5):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    api = PostyAPI()
+    api.api_token = 'token'
+
+    print('{0:<12} {1:>12} {2:>12} {3:>14}'.format(
+        'endpoint', 'legacy us', 'plan us', 'request us'))
+    for name, args, kwargs in CALLS:
+        method_class = getattr(PostyAPI, name).api_method
+        params = method_class.allowed_params
+        plan = method_class.plan
+
+        def legacy_call():
+            parameters = legacy_build_parameters(params, args, dict(kwargs))
+            parameters.append(('api_token', 'token'))
+            return method_class.path + '?' + urllib.parse.urlencode(parameters)
+
+        def plan_call():
+            path, parameters = plan.bind(args, kwargs)
+            parameters.append(('api_token', 'token'))
+            return path + '?' + encode_query(parameters)
+
+        legacy = best_of(legacy_call)
+        bound = best_of(plan_call)
+        request = best_of(
+            lambda: method_class(api, args, dict(kwargs)).build_request())
+        print('{0:<12} {1:>12.2f} {2:>12.2f} {3:>14.2f}'.format(
+            name, legacy * 1e6, bound * 1e6, request * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for utils.parse_datetime against the strptime based parser
+it replaced.
+
+    python benchmarks/bench_dates.py
+"""
+
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from posterous.utils import parse_datetime, parse_datetimes
+
+
+def strptime_parse_datetime(time_string):
+    """The previous implementation, kept for comparison."""
+    utc_offset_str = time_string[-6:].strip()
+    sign = 1
+
+    if utc_offset_str[0] == '-':
+        sign = -1
+        utc_offset_str = utc_offset_str[1:5]
+
+    utcoffset = sign * timedelta(hours=int(utc_offset_str[0:2]),
+                                 minutes=int(utc_offset_str[2:4]))
+
+    return datetime.strptime(time_string[:-6], '%a, %d %b %Y %H:%M:%S') - utcoffset
+
+
+def date_strings(n, distinct):
+    """n dates in the Posterous format drawn from a pool of distinct values."""
+    rand = random.Random(0)
+    start = datetime(2009, 1, 1)
+    pool = [(start + timedelta(seconds=rand.randint(0, 10 ** 8)))
+            .strftime('%a, %d %b %Y %H:%M:%S -0800') for i in range(distinct)]
+    return [rand.choice(pool) for i in range(n)]
+
+
+def best_of(func, repeat=5):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    n = 20000
+    uncached = parse_datetime.__wrapped__
+    print('{0:>10}  {1:>12}  {2:>12}  {3:>12}  {4:>12}'.format(
+            'distinct', 'strptime', 'uncached', 'cached', 'batch'))
+    for distinct in (n, 1000, 10):
+        dates = date_strings(n, distinct)
+        assert [strptime_parse_datetime(d) for d in dates[:100]] == parse_datetimes(dates[:100])
+
+        def cached():
+            parse_datetime.cache_clear()
+            for d in dates:
+                parse_datetime(d)
+
+        def batch():
+            parse_datetime.cache_clear()
+            parse_datetimes(dates)
+
+        timings = [best_of(lambda: [strptime_parse_datetime(d) for d in dates]),
+                   best_of(lambda: [uncached(d) for d in dates]),
+                   best_of(cached),
+                   best_of(batch)]
+        print('{0:>10}  {1}'.format(distinct, '  '.join(
+                '{0:>9.3f} us'.format(t / n * 1e6) for t in timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Compares parsing the same read_posts response as XML and as JSON.
+
+The JSON payload is made from the generated XML one (see payloads.py), so
+both describe the same posts; the models they produce are checked to be
+equal before timing.
+
+    decode - ElementTree vs the JSON library (posterous.utils.import_json_loads)
+    dicts - XMLParser vs JSONParser, i.e. decoding plus normalization
+    models - ModelParser.parse, all the way to Post models
+
+    python benchmarks/bench_formats.py
+    python benchmarks/bench_formats.py --profile large
+"""
+
+from datetime import datetime
+from optparse import OptionParser
+import json
+import os
+import sys
+import timeit
+import xml.etree.cElementTree as ET
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from payloads import PROFILES, posts_response
+from posterous.parsers import JSONParser, ModelParser, XMLParser, json_decoder
+
+
+class Method(object):
+    api = None
+    format = 'xml'
+    payload_type = 'post'
+    payload_list = True
+    iterator = False
+
+
+def to_json(xml_payload):
+    """The JSON version of a read_posts XML payload."""
+    def default(value):
+        if isinstance(value, datetime):
+            return value.strftime('%a, %d %b %Y %H:%M:%S +0000')
+        raise TypeError(value)
+    posts = XMLParser().parse(Method, xml_payload)
+    return json.dumps({'posts': posts}, default=default).encode('utf-8')
+
+
+def public(value):
+    """The attributes of models, recursively, without their api."""
+    if isinstance(value, list):
+        return [public(v) for v in value]
+    if hasattr(value, '_api'):
+        return dict((k, public(v)) for k, v in vars(value).items() if k != '_api')
+    return value
+
+
+def best_of(func, repeat):
+    once = timeit.timeit(func, number=1)
+    number = max(1, int(0.2 / max(once, 1e-6)))
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--profile', default='medium', choices=sorted(PROFILES),
+                      help='payload shape: {0} [default: %default]'.format(
+                          ', '.join(sorted(PROFILES))))
+    parser.add_option('--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+
+    shape = PROFILES[options.profile]
+    xml_payload = posts_response(**shape)
+    json_payload = to_json(xml_payload)
+    json_loads = json_decoder()
+    models = ModelParser()
+    xml_models = models.parse(Method, xml_payload)
+    json_models = models.parse(Method, json_payload)
+    if public(xml_models) != public(json_models):
+        sys.exit('The XML and JSON payloads parse to different models')
+
+    print('{0} posts, XML {1:.1f} KB, JSON {2:.1f} KB, decoder {3}.{4}'.format(
+        shape['posts'], len(xml_payload) / 1024.0, len(json_payload) / 1024.0,
+        json_loads.__module__, json_loads.__name__))
+    print('{0:<8} {1:>12} {2:>12} {3:>8}'.format('stage', 'XML posts/s',
+                                                 'JSON posts/s', 'speedup'))
+    stages = [
+        ('decode', lambda: ET.XML(xml_payload), lambda: json_loads(json_payload)),
+        ('dicts', lambda: XMLParser().parse(Method, xml_payload),
+                  lambda: JSONParser().parse(Method, json_payload)),
+        ('models', lambda: models.parse(Method, xml_payload),
+                   lambda: models.parse(Method, json_payload)),
+    ]
+    for name, xml_func, json_func in stages:
+        xml_time = best_of(xml_func, options.repeat)
+        json_time = best_of(json_func, options.repeat)
+        print('{0:<8} {1:>12.0f} {2:>12.0f} {3:>7.1f}x'.format(
+            name, shape['posts'] / xml_time, shape['posts'] / json_time,
+            xml_time / json_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Time to import the library in a fresh interpreter, for what scripts do
+first:
+
+    python - the interpreter alone
+    package - import posterous
+    api - from posterous.api import PostyAPI
+    client - the same plus creating a PostyAPI instance
+
+Each is run --runs times in a new process and the best and median wall
+times are printed. Then come the modules that took longest for the last
+statement, as reported by python -X importtime (cumulative, in ms).
+
+    python benchmarks/bench_import.py --runs 20
+"""
+
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+STATEMENTS = [
+    ('python', 'pass'),
+    ('package', 'import posterous'),
+    ('api', 'from posterous.api import PostyAPI'),
+    ('client', 'from posterous.api import PostyAPI; PostyAPI()'),
+]
+
+
+def run(code, *options):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + list(options) + ['-c', code],
+                            cwd=ROOT, check=True, stderr=subprocess.PIPE)
+    return time.perf_counter() - start, result.stderr.decode('utf-8')
+
+
+def import_times(code):
+    """[(cumulative ms, module)] of each module imported by code."""
+    elapsed, report = run(code, '-X', 'importtime')
+    times = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative_us) / 1000.0, name.strip()))
+    return times
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--runs', type='int', default=10)
+    parser.add_option('--top', type='int', default=15)
+    options, args = parser.parse_args()
+
+    print('{0:<8} {1:>10} {2:>10}'.format('import', 'best ms', 'median ms'))
+    for name, code in STATEMENTS:
+        times = sorted(run(code)[0] for i in range(options.runs))
+        print('{0:<8} {1:>10.1f} {2:>10.1f}'.format(
+            name, times[0] * 1000, times[len(times) // 2] * 1000))
+
+    print('')
+    print('slowest modules of: {0}'.format(STATEMENTS[-1][1]))
+    for cumulative, module in sorted(import_times(STATEMENTS[-1][1]), reverse=True)[:options.top]:
+        print('{0:>8.1f}  {1}'.format(cumulative, module))
+
+
+if __name__ == '__main__':
+    main()
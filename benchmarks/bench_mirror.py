@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Answers the same read calls from the local stand-in server (fakeserver.py)
+and from a posterous.mirror synced from it:
+
+    page - read_posts of each page of a site
+    range - the posts of one day; the live api reads every page to find them
+    search - posts with a word in their title or body; the live api reads
+             every page too
+    tags - get_tags of every site
+
+Also reports how long the first sync and an incremental one take.
+
+    python benchmarks/bench_mirror.py --posts 1000 --latency 0.01
+"""
+
+from datetime import timedelta
+from optparse import OptionParser
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+from fakeserver import FakeServer
+from posterous.api import PostyAPI
+from posterous.mirror import Mirror, MirrorAPI, plain_text
+
+
+def words(post):
+    """The words of a post as FTS5 splits them: runs of word characters."""
+    return set(re.findall(r'\w+', '{0} {1}'.format(post.title, plain_text(post.body)).lower()))
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sites', type='int', default=2)
+    parser.add_option('--posts', type='int', default=500)
+    parser.add_option('--per-page', type='int', default=50)
+    parser.add_option('--latency', type='float', default=0.005)
+    options, args = parser.parse_args()
+
+    server = FakeServer(sites=options.sites, posts_per_site=options.posts,
+                        latency=options.latency).start()
+    root = tempfile.mkdtemp()
+    try:
+        live = PostyAPI('bench', 'secret')
+        live.host = server.url
+        live.api_token = 'token-bench'
+        mirror = Mirror(os.path.join(root, 'mirror.db'))
+        local = MirrorAPI(mirror)
+
+        sync_time, counts = timed(lambda: mirror.sync(live, per_page=options.per_page))
+        again_time, again = timed(lambda: mirror.sync(live, per_page=options.per_page))
+        print('sync: {0} posts in {1:.2f}s, again in {2:.3f}s ({3} changed)'.format(
+            counts['posts'], sync_time, again_time, again['posts']))
+
+        site_ids = [site.id for site in live.get_sites()]
+        pages = options.posts // options.per_page + 1
+        # one day of posts, in the middle of the generated ones
+        posts = live.read_posts(site_ids[0], page=pages // 2, num_posts=options.per_page)
+        day = posts[0].date.replace(hour=0, minute=0, second=0)
+        word = sorted(words(posts[0]))[0]
+
+        def read_pages(api):
+            return [[post.id for post in api.read_posts(site_id, page=page,
+                                                        num_posts=options.per_page)]
+                    for site_id in site_ids for page in range(1, pages + 1)]
+
+        def live_range():
+            return sorted(post.id for post in live.iter_posts(site_ids[0], per_page=50)
+                          if day <= post.date < day + timedelta(days=1))
+
+        def local_range():
+            return sorted(post.id for post in
+                          local.posts_between(site_ids[0], day, day + timedelta(days=1)))
+
+        def live_search():
+            return sorted(post.id for site_id in site_ids
+                          for post in live.iter_posts(site_id, per_page=50)
+                          if word in words(post))
+
+        def local_search():
+            return sorted(post.id for post in local.search_posts(word, limit=10 ** 6))
+
+        def tags(api):
+            return [[str(tag) for tag in api.get_tags(site_id)] for site_id in site_ids]
+
+        print('{0:<8} {1:>10} {2:>10} {3:>8}'.format('call', 'live s', 'mirror s', 'speedup'))
+        for name, live_func, local_func in [
+                ('page', lambda: read_pages(live), lambda: read_pages(local)),
+                ('range', live_range, local_range),
+                ('search', live_search, local_search),
+                ('tags', lambda: tags(live), lambda: tags(local))]:
+            live_time, live_result = timed(live_func)
+            local_time, local_result = timed(local_func)
+            if live_result != local_result:
+                sys.exit('{0}: the mirror disagrees'.format(name))
+            print('{0:<8} {1:>10.3f} {2:>10.3f} {3:>7.1f}x'.format(
+                name, live_time, local_time, live_time / local_time))
+        mirror.close()
+    finally:
+        server.stop()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Compares the two backup layouts of posterous.backup on generated posts:
+a JSON file per post, and the indexed pack of posterous.pack.
+
+    write - saving every post
+    scan - reading every post back
+    lookup - reading random posts by id
+    range - reading the posts of one month
+
+    python benchmarks/bench_pack.py --posts 20000
+"""
+
+from datetime import datetime
+from optparse import OptionParser
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from payloads import posts_response
+from posterous.backup import encode_json, pack_path, post_slug, post_files
+from posterous.pack import PackReader, PackWriter
+from posterous.parsers import ModelParser
+from posterous.utils import import_json_loads
+
+
+class Method(object):
+    api = None
+    format = 'xml'
+    payload_type = 'post'
+    payload_list = True
+    iterator = False
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--posts', type='int', default=5000)
+    parser.add_option('--lookups', type='int', default=1000)
+    options, args = parser.parse_args()
+
+    posts = ModelParser().parse(Method, posts_response(
+        posts=options.posts, comments=2, media=1, body_length=1000))
+    # the generated titles repeat, keep the slugs apart
+    for post in posts:
+        post.link = '{0}-{1}'.format(post.link, post.id)
+    ids = [post.id for post in posts]
+    loads = import_json_loads()
+    rand = random.Random(0)
+    lookups = [rand.choice(ids) for i in range(options.lookups)]
+    month = (datetime(2010, 1, 1), datetime(2010, 2, 1))
+    by_id = dict((post.id, post_slug(post)) for post in posts)
+
+    root = tempfile.mkdtemp()
+    folder = os.path.join(root, 'folder', 'bench')
+    packed = os.path.join(root, 'pack', 'bench')
+    os.makedirs(folder)
+    os.makedirs(packed)
+    try:
+        def write_folder():
+            for post in posts:
+                with open(os.path.join(folder, '%s.json' % post_slug(post)), 'wb') as f:
+                    f.write(encode_json(post))
+
+        def write_pack():
+            with PackWriter(pack_path(packed)) as pack:
+                for post in posts:
+                    pack.add(post.id, post.date, encode_json(post))
+
+        def scan_folder():
+            result = []
+            for path in post_files(folder):
+                with open(path, 'rb') as f:
+                    result.append(loads(f.read()))
+            return len(result)
+
+        def scan_pack():
+            with PackReader(pack_path(packed)) as pack:
+                return sum(1 for post in pack)
+
+        def lookup_folder():
+            for post_id in lookups:
+                with open(os.path.join(folder, '%s.json' % by_id[post_id]), 'rb') as f:
+                    loads(f.read())
+
+        def lookup_pack():
+            with PackReader(pack_path(packed)) as pack:
+                for post_id in lookups:
+                    pack.get(post_id)
+
+        def range_folder():
+            # the folder layout has no index, every post has to be read
+            count = 0
+            for path in post_files(folder):
+                with open(path, 'rb') as f:
+                    date = loads(f.read())['date']
+                count += '2010-01' <= date < '2010-02'
+            return count
+
+        def range_pack():
+            with PackReader(pack_path(packed)) as pack:
+                return sum(1 for post in pack.between(*month))
+
+        print('{0} posts, {1:.1f} MB of JSON'.format(
+            len(posts), sum(len(encode_json(post)) for post in posts) / 1e6))
+        print('{0:<8} {1:>10} {2:>10} {3:>8}'.format('stage', 'folder s', 'pack s', 'speedup'))
+        for name, folder_func, pack_func in [('write', write_folder, write_pack),
+                                             ('scan', scan_folder, scan_pack),
+                                             ('lookup', lookup_folder, lookup_pack),
+                                             ('range', range_folder, range_pack)]:
+            folder_time, folder_result = timed(folder_func)
+            pack_time, pack_result = timed(pack_func)
+            if folder_result != pack_result:
+                sys.exit('{0}: the layouts disagree'.format(name))
+            print('{0:<8} {1:>10.3f} {2:>10.3f} {3:>7.1f}x'.format(
+                name, folder_time, pack_time, folder_time / pack_time))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Benchmark of the response parsing pipeline on generated read_posts
+responses (see payloads.py).
+
+Each stage is timed separately and run once more under tracemalloc for
+its peak memory:
+
+    xml - ElementTree parsing the payload
+    xmldict - XMLDict turning the parsed posts into dicts, with set_type
+    dates - parse_datetime on every date of the payload, cold cache
+    models - Post.parse_obj building models from the dicts
+    pipeline - ModelParser.parse, i.e. all of the above
+
+    python benchmarks/bench_parse.py
+    python benchmarks/bench_parse.py --profile large --posts 500
+    python benchmarks/bench_parse.py --save       # record a new baseline
+
+The results are compared with the baseline file, if there is one, and
+stages that got slower or use more memory than the threshold allows are
+flagged. The exit status is 1 if any stage regressed.
+"""
+
+from optparse import OptionParser
+import gc
+import json
+import os
+import re
+import sys
+import timeit
+import tracemalloc
+import xml.etree.cElementTree as ET
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from payloads import PROFILES, posts_response
+from posterous.models import Post
+from posterous.parsers import ModelParser, XMLDict, XMLParser
+from posterous.utils import parse_datetime
+
+
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+
+
+class Method(object):
+    """The attributes of a read_posts APIMethod the parsers look at."""
+    api = None
+    format = 'xml'
+    payload_type = 'post'
+    payload_list = True
+    iterator = False
+
+
+def stages(payload):
+    """(name, function) of each stage, prepared for the payload."""
+    root = ET.XML(payload)
+    data = XMLParser().parse(Method, payload)
+    dates = re.findall(br'<date>([^<]+)</date>', payload)
+    dates = [d.decode('utf-8') for d in dates]
+    parser = ModelParser()
+
+    def parse_dates():
+        parse_datetime.cache_clear()
+        for d in dates:
+            parse_datetime(d)
+
+    return [('xml', lambda: ET.XML(payload)),
+            ('xmldict', lambda: [XMLDict(el) for el in root]),
+            ('dates', parse_dates),
+            ('models', lambda: Post.parse(None, data)),
+            ('pipeline', lambda: parser.parse(Method, payload))]
+
+
+def peak_memory(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        # keep the result alive until the peak has been read
+        result = func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(func, posts, size, repeat):
+    # aim for runs of about 0.2s
+    once = timeit.timeit(func, number=1)
+    number = max(1, int(0.2 / max(once, 1e-6)))
+    seconds = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    return {'seconds': seconds,
+            'posts_per_sec': posts / seconds,
+            'mb_per_sec': size / seconds / 1e6,
+            'peak_kb': peak_memory(func) / 1024.0}
+
+
+def compare(result, baseline, threshold):
+    """Names of the ways a stage regressed compared to the baseline."""
+    problems = []
+    if result['posts_per_sec'] < baseline['posts_per_sec'] * (1 - threshold):
+        problems.append('throughput')
+    if result['peak_kb'] > baseline['peak_kb'] * (1 + threshold):
+        problems.append('memory')
+    return problems
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--profile', default='medium', choices=sorted(PROFILES),
+                      help='payload shape: {0} [default: %default]'.format(
+                          ', '.join(sorted(PROFILES))))
+    parser.add_option('--posts', type='int', help='posts per response')
+    parser.add_option('--comments', type='int', help='comments per post')
+    parser.add_option('--media', type='int', help='media per post')
+    parser.add_option('--body-length', type='int', dest='body_length',
+                      help='characters of post body')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='timing runs per stage, the best counts [default: %default]')
+    parser.add_option('--baseline', default=DEFAULT_BASELINE,
+                      help='baseline file [default: %default]')
+    parser.add_option('--save', action='store_true',
+                      help='store the results in the baseline file')
+    parser.add_option('--threshold', type='float', default=0.15,
+                      help='allowed slowdown/growth before flagging [default: %default]')
+    options, args = parser.parse_args()
+
+    shape = dict(PROFILES[options.profile])
+    for name in shape:
+        if getattr(options, name) is not None:
+            shape[name] = getattr(options, name)
+    # results are only comparable for the same payload
+    key = 'posts={posts} comments={comments} media={media} body={body_length}'.format(**shape)
+    payload = posts_response(**shape)
+
+    baselines = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baselines = json.load(f)
+    baseline = baselines.get(key, {})
+
+    print('{0}, {1:.1f} KB'.format(key, len(payload) / 1024.0))
+    print('{0:<10} {1:>12} {2:>10} {3:>10} {4:>10}  {5}'.format(
+        'stage', 'posts/s', 'MB/s', 'peak KB', 'vs base', ''))
+    results = {}
+    regressed = False
+    for name, func in stages(payload):
+        result = results[name] = measure(func, shape['posts'], len(payload),
+                                         options.repeat)
+        change, flags = '', ''
+        if name in baseline:
+            change = '{0:+.0%}'.format(
+                result['posts_per_sec'] / baseline[name]['posts_per_sec'] - 1)
+            problems = compare(result, baseline[name], options.threshold)
+            if problems:
+                regressed = True
+                flags = 'REGRESSION: ' + ', '.join(problems)
+        print('{0:<10} {1:>12.0f} {2:>10.2f} {3:>10.0f} {4:>10}  {5}'.format(
+            name, result['posts_per_sec'], result['mb_per_sec'],
+            result['peak_kb'], change, flags))
+
+    if options.save:
+        baselines[key] = results
+        with open(options.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print('Saved baseline to {0}'.format(options.baseline))
+    return 1 if regressed and not options.save else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
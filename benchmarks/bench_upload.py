@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Uploads a generated file with new_post to the local stand-in server
+(fakeserver.py) in each of the ways the client can send it, and reports
+the throughput and the peak memory the client allocated for it:
+
+    bytes - the file read into memory first and passed as bytes
+    sendfile - Upload(path), sent with sendfile() and no checksum
+    sendfile-md5 - Upload(path), hashed from a memory map as it is sent
+    file-md5 - Upload(open file) read in chunks, e.g. for a pipe
+    async-md5 - Upload(path) through AsyncPostyAPI, memory mapped chunks
+
+The size and MD5 the server received are checked against the file.
+
+    python benchmarks/bench_upload.py --size 200
+"""
+
+from optparse import OptionParser
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+from fakeserver import FakeServer
+from posterous.aio import AsyncPostyAPI
+from posterous.api import PostyAPI
+from posterous.multipart import Upload
+
+
+class Pipe(object):
+    """A file that can only be read, like a pipe, so nothing is mapped."""
+    def __init__(self, f):
+        self.f = f
+        self.name = f.name
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+
+def client(server, cls=PostyAPI):
+    api = cls('bench', 'secret')
+    api.host = server.url
+    api.api_token = 'token-bench'
+    return api
+
+
+def upload_bytes(server, path):
+    with open(path, 'rb') as f:
+        client(server).new_post(1, title='bytes', media=f.read())
+
+
+def upload_sendfile(server, path):
+    client(server).new_post(1, title='sendfile', media=Upload(path, checksum=None))
+
+
+def upload_sendfile_md5(server, path):
+    upload = Upload(path)
+    client(server).new_post(1, title='sendfile', media=upload)
+    return upload.digest
+
+
+def upload_file_md5(server, path):
+    with open(path, 'rb') as f:
+        upload = Upload(Pipe(f), filename=os.path.basename(path))
+        client(server).new_post(1, title='file', media=upload)
+    return upload.digest
+
+
+def upload_async_md5(server, path):
+    upload = Upload(path)
+
+    async def main():
+        async with client(server, AsyncPostyAPI) as api:
+            await api.new_post(1, title='async', media=upload)
+    asyncio.run(main())
+    return upload.digest
+
+
+MODES = [('bytes', upload_bytes),
+         ('sendfile', upload_sendfile),
+         ('sendfile-md5', upload_sendfile_md5),
+         ('file-md5', upload_file_md5),
+         ('async-md5', upload_async_md5)]
+
+
+def make_file(size):
+    """A file of size bytes and its MD5."""
+    fd, path = tempfile.mkstemp(suffix='.mp4')
+    md5 = hashlib.md5()
+    block = os.urandom(1024 * 1024)
+    with os.fdopen(fd, 'wb') as f:
+        for offset in range(0, size, len(block)):
+            data = block[:size - offset]
+            f.write(data)
+            md5.update(data)
+    return path, md5.hexdigest()
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--size', type='int', default=64,
+                      help='file size in MB [default: %default]')
+    parser.add_option('--mode', action='append',
+                      help='mode to run, can be repeated [default: all]')
+    options, args = parser.parse_args()
+
+    names = options.mode or [name for name, func in MODES]
+    path, md5 = make_file(options.size * 1024 * 1024)
+    server = FakeServer(sites=1, posts_per_site=0).start()
+    try:
+        print('{0:<13} {1:>8} {2:>8} {3:>12} {4:>9}'.format(
+            'mode', 'seconds', 'MB/s', 'peak MB', 'checksum'))
+        for name, func in MODES:
+            if name not in names:
+                continue
+            tracemalloc.start()
+            start = time.perf_counter()
+            digest = func(server, path)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            received = server.uploads[-1]
+            if received['md5'] != md5 or (digest is not None and digest != md5):
+                sys.exit('{0}: the server received a different file'.format(name))
+            print('{0:<13} {1:>8.2f} {2:>8.1f} {3:>12.2f} {4:>9}'.format(
+                name, seconds, options.size / seconds, peak / 1024.0 / 1024.0,
+                'ok' if digest else '-'))
+    finally:
+        server.stop()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
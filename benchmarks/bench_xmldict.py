@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Scaling benchmark for the XML to dict conversion.
+
+Times XMLDict on an element with N sibling children and XMLParser.parse
+on a response whose payload is followed by N stray siblings (the case
+where they get moved under the first child). The time per sibling should
+stay flat from 10 to 10,000 siblings if the conversion is linear.
+
+    python benchmarks/bench_xmldict.py
+"""
+
+import os
+import sys
+import timeit
+import xml.etree.cElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from posterous.parsers import XMLDict, XMLParser
+
+
+SIZES = (10, 100, 1000, 10000)
+
+
+class Method(object):
+    payload_list = False
+
+
+def siblings_element(n):
+    """A <post> with n <comment> siblings and n <media> siblings."""
+    comment = ('<comment><body>comment body</body><author>sachin</author>'
+               '<id>{0}</id></comment>')
+    media = '<media><type>image</type><url>http://posterous.com/{0}.jpg</url></media>'
+    body = ''.join(comment.format(i) + media.format(i) for i in range(n))
+    return '<post><id>1</id><title>title</title>{0}</post>'.format(body)
+
+
+def siblings_response(n):
+    """A single-model response with n siblings after the model element."""
+    tail = ''.join('<tag{0}>{0}</tag{0}>'.format(i) for i in range(n))
+    return '<rsp stat="ok"><site><id>1</id></site>{0}</rsp>'.format(tail).encode('utf-8')
+
+
+def best_of(func, number, repeat=5):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = XMLParser()
+    print('{0:>8}  {1:>14}  {2:>14}'.format('siblings', 'XMLDict us/el', 'parse us/el'))
+    for n in SIZES:
+        element = ET.XML(siblings_element(n))
+        payload = siblings_response(n)
+        number = max(1, 20000 // n)
+        dict_time = best_of(lambda: XMLDict(element), number)
+        parse_time = best_of(lambda: parser.parse(Method, payload), number)
+        print('{0:>8}  {1:>14.3f}  {2:>14.3f}'.format(
+                n, dict_time / (2 * n) * 1e6, parse_time / n * 1e6))
+
+
+if __name__ == '__main__':
+    main()
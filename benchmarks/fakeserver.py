@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the Posterous API, for load and latency testing.
+
+Serves the /api/2 endpoints declared in posterous/api.py with deterministic
+data generated by payloads.py:
+
+    GET    /auth/token                          (basic auth)
+    GET    /users/{user_id}/sites               (all, or ?hostname=)
+    GET    /users/{user_id}/sites/primary
+    POST   /users/{user_id}/sites
+    POST   /users/{user_id}/sites/{site_id}/posts     (multipart media uploads)
+    DELETE /users/{user_id}/sites               (?hostname=)
+    GET    /users/{user_id}/sites/{site_id}/posts
+    GET    /users/{user_id}/sites/{site_id}/posts/{post_id}
+    GET    /users/{user_id}/sites/{site_id}/posts/{post_id}/comments
+    GET    /files/...                           (media, with Range support)
+
+Placeholders left in the path by the client are filled from the query
+string. Responses carry an ETag and If-None-Match is answered with 304.
+Uploaded files are read as they arrive and only their size and MD5 are
+kept, on server.uploads.
+
+Knobs for each server, settable while it runs:
+
+    latency - seconds added before each response, plus up to jitter more
+    bandwidth - bytes per second each response body is sent at
+    error_rate - fraction of API requests answered with a 500 or 503
+    rate_limit - requests per second accepted before answering 429
+
+    server = FakeServer(sites=3, posts_per_site=200, latency=0.02)
+    server.start()
+    api = PostyAPI('user', 'pass')
+    api.host = server.url
+    ...
+    server.stop()
+
+It can also be run on its own:
+
+    python benchmarks/fakeserver.py --port 8080 --latency 0.05
+"""
+
+from base64 import b64decode
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+import hashlib
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from payloads import START, post_xml, response, site_xml
+
+
+API_ROOT = '/api/2'
+
+ROUTES = [
+    ('token', r'/auth/token'),
+    ('primary_site', r'/users/(?P<user_id>[^/]+)/sites/primary'),
+    ('comments', r'/users/(?P<user_id>[^/]+)/sites/(?P<site_id>[^/]+)/posts/(?P<post_id>[^/]+)/comments'),
+    ('post', r'/users/(?P<user_id>[^/]+)/sites/(?P<site_id>[^/]+)/posts/(?P<post_id>[^/]+)'),
+    ('posts', r'/users/(?P<user_id>[^/]+)/sites/(?P<site_id>[^/]+)/posts'),
+    ('tags', r'/users/(?P<user_id>[^/]+)/sites/(?P<site_id>[^/]+)/tags'),
+    ('sites', r'/users/(?P<user_id>[^/]+)/sites'),
+]
+ROUTES = [(name, re.compile('^' + API_ROOT + pattern + '$')) for name, pattern in ROUTES]
+
+# media urls and their file sizes (in KB) in the generated posts
+MEDIA_SIZE = re.compile(r'<url>([^<]+)</url><filesize>(\d+)</filesize>')
+MEDIA_URL = re.compile(r'<(?:url|thumb|flv|mp4)>([^<]+/files/[^<]+)</')
+COMMENT = re.compile(r'<comment>.*?</comment>', re.S)
+
+DEFAULT_FILE_SIZE = 16 * 1024
+
+# the tags of every site
+TAGS = ('bench', 'travel', 'food')
+
+
+def body_chunks(rfile, headers, chunk_size=64 * 1024):
+    """Yields a request body as it is read, plain or chunked."""
+    if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        while True:
+            size = int(rfile.readline().split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                while rfile.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            while size:
+                chunk = rfile.read(min(size, chunk_size))
+                size -= len(chunk)
+                yield chunk
+            rfile.readline()
+    remaining = int(headers.get('Content-Length', 0))
+    while remaining:
+        chunk = rfile.read(min(remaining, chunk_size))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+
+def read_multipart(chunks, boundary):
+    """
+    Returns the (fields, files) of a multipart/form-data body without
+    holding its files in memory: fields maps names to lists of values,
+    files is a list of dicts with the name, filename, size and md5.
+    """
+    delimiter = b'\r\n--' + boundary.encode('latin-1')
+    fields, files = {}, []
+    # the first delimiter has no CRLF in front of it
+    buffer = b'\r\n'
+    part = None
+    chunks = iter(chunks)
+    finished = False
+    while not finished:
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+        else:
+            buffer += chunk
+        while True:
+            if part is not None and part.get('headers') is None:
+                end = buffer.find(b'\r\n\r\n')
+                if end < 0:
+                    break
+                part['headers'] = buffer[:end].decode('utf-8')
+                buffer = buffer[end + 4:]
+                disposition = dict(re.findall(r'(\w+)="([^"]*)"', part['headers']))
+                part.update(name=disposition.get('name'),
+                            filename=disposition.get('filename'),
+                            size=0, md5=hashlib.md5(), data=[])
+            index = buffer.find(delimiter)
+            if index < 0:
+                # keep what could be the start of a delimiter
+                keep = len(delimiter) + 4
+                if part is not None and part.get('headers') is not None and len(buffer) > keep:
+                    add_data(part, buffer[:-keep])
+                    buffer = buffer[-keep:]
+                break
+            if len(buffer) < index + len(delimiter) + 2 and not finished:
+                break
+            if part is not None:
+                add_data(part, buffer[:index])
+                end_part(part, fields, files)
+            rest = buffer[index + len(delimiter):]
+            if rest.startswith(b'--'):
+                return fields, files
+            part = {'headers': None}
+            buffer = rest[2:]
+    return fields, files
+
+
+def add_data(part, data):
+    part['size'] += len(data)
+    part['md5'].update(data)
+    if part['filename'] is None:
+        part['data'].append(data)
+
+
+def end_part(part, fields, files):
+    if part['filename'] is None:
+        value = b''.join(part['data']).decode('utf-8')
+        fields.setdefault(part['name'], []).append(value)
+    else:
+        files.append({'name': part['name'], 'filename': part['filename'],
+                      'size': part['size'], 'md5': part['md5'].hexdigest()})
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=''):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+class Site(object):
+    def __init__(self, site_id, xml):
+        self.id = site_id
+        self.xml = xml
+        self.posts = []
+
+
+class Posterous(object):
+    """The generated accounts data and the logic of each endpoint."""
+    def __init__(self, files_url, sites=3, posts_per_site=100, comments=2,
+                 media=1, body_length=500, seed=0):
+        self.files_url = files_url
+        self.comments = comments
+        self.media = media
+        self.body_length = body_length
+        self.rand = random.Random(seed)
+        self.sites = []
+        self.files = {}
+        self.tokens = set()
+        self._lock = threading.Lock()
+        for i in range(sites):
+            self.add_site(posts=posts_per_site)
+
+    def add_site(self, hostname=None, posts=0):
+        with self._lock:
+            site_id = len(self.sites) + 1 if not self.sites else self.sites[-1].id + 1
+            site = Site(site_id, site_xml(self.rand, site_id, posts, hostname))
+            self.sites.append(site)
+            # newest first, one post an hour
+            for i in reversed(range(posts)):
+                post_id = site_id * 100000 + i
+                date = (START + timedelta(hours=i)).strftime('%a, %d %b %Y %H:%M:%S -0800')
+                xml = post_xml(self.rand, post_id, self.comments, self.media,
+                               self.body_length, date, self.files_url)
+                site.posts.append((post_id, xml))
+                for url in MEDIA_URL.findall(xml):
+                    self.files.setdefault(urllib.parse.urlsplit(url).path,
+                                          DEFAULT_FILE_SIZE)
+                for url, size in MEDIA_SIZE.findall(xml):
+                    self.files[urllib.parse.urlsplit(url).path] = int(size) * 1024
+            return site
+
+    def add_post(self, site):
+        with self._lock:
+            post_id = site.posts[0][0] + 1 if site.posts else site.id * 100000
+            xml = post_xml(self.rand, post_id, 0, 0, self.body_length,
+                           media_root=self.files_url)
+            site.posts.insert(0, (post_id, xml))
+            return xml
+
+    def site(self, site_id=None, hostname=None):
+        for site in self.sites:
+            if (site_id is not None and str(site.id) == str(site_id) or
+                    hostname is not None and '<hostname>{0}</hostname>'.format(hostname) in site.xml):
+                return site
+        raise HTTPError(404, 'No such site')
+
+    def post(self, site, post_id):
+        for id, xml in site.posts:
+            if str(id) == str(post_id):
+                return xml
+        raise HTTPError(404, 'No such post')
+
+    def authenticate(self, route, params, headers):
+        if route == 'token':
+            auth = headers.get('Authorization', '')
+            if not auth.startswith('Basic '):
+                raise HTTPError(401, 'Basic authentication required')
+            username = b64decode(auth[6:]).decode('utf-8').split(':', 1)[0]
+            token = 'token-{0}'.format(username)
+            self.tokens.add(token)
+            return token
+        if not params.get('api_token'):
+            raise HTTPError(401, 'api_token required')
+
+    def handle(self, method, route, args, params, headers):
+        """Returns the XML body for a request."""
+        token = self.authenticate(route, params, headers)
+        if route == 'token':
+            return response('<api_token>{0}</api_token>'.format(token))
+        if route == 'primary_site':
+            if not self.sites:
+                raise HTTPError(404, 'No sites')
+            return response(self.sites[0].xml)
+        if route == 'sites':
+            if method == 'POST':
+                return response(self.add_site(params.get('hostname')).xml)
+            if method == 'DELETE':
+                site = self.site(hostname=params.get('hostname'))
+                with self._lock:
+                    self.sites.remove(site)
+                return response()
+            if params.get('hostname'):
+                return response(self.site(hostname=params['hostname']).xml)
+            return response(*[site.xml for site in self.sites])
+
+        site = self.site(site_id=args['site_id'])
+        if route == 'posts' and method == 'POST':
+            return response(self.add_post(site))
+        if route == 'posts':
+            posts = site.posts
+            if params.get('since_id'):
+                posts = [p for p in posts if p[0] > int(params['since_id'])]
+            per_page = int(params.get('num_posts') or 10)
+            start = (int(params.get('page') or 1) - 1) * per_page
+            return response(*[xml for id, xml in posts[start:start + per_page]])
+        if route == 'tags':
+            return response(*['<tag><id>{0}</id><tag_string>{1}</tag_string>'
+                              '<count>{2}</count></tag>'.format(i + 1, name, len(site.posts))
+                              for i, name in enumerate(TAGS)])
+        post = self.post(site, args['post_id'])
+        if route == 'post':
+            return response(post)
+        return response(*COMMENT.findall(post))
+
+    def file_body(self, path):
+        size = self.files.get(path)
+        if size is None:
+            raise HTTPError(404, 'No such file')
+        # deterministic content, so downloads can be checked
+        block = hashlib.sha1(path.encode('utf-8')).digest() * 64
+        return (block * (size // len(block) + 1))[:size]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let them wait for
+    # the client's delayed ACK on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server.fake
+        server.count('requests')
+        try:
+            server.delay()
+            parts = urllib.parse.urlsplit(self.path)
+            if parts.path.startswith('/files/'):
+                return self.send_file(server.app.file_body(parts.path))
+            body = self.route(server, parts)
+        except HTTPError as e:
+            return self.send_error_body(e)
+        etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+        if self.command == 'GET' and self.headers.get('If-None-Match') == etag:
+            server.count(304)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        server.count(200)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.send_body(body)
+
+    def do_POST(self):
+        chunks = body_chunks(self.rfile, self.headers)
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            boundary = content_type.split('boundary=', 1)[1].strip('"')
+            self.form, files = read_multipart(chunks, boundary)
+            self.server.fake.record_uploads(files)
+        else:
+            self.form = urllib.parse.parse_qs(b''.join(chunks).decode('utf-8'))
+        self.do_GET()
+
+    do_DELETE = do_GET
+
+    def route(self, server, parts):
+        params = dict((k, v[0]) for k, v in urllib.parse.parse_qs(parts.query).items())
+        params.update((k, v[0]) for k, v in getattr(self, 'form', {}).items())
+        path = urllib.parse.unquote(parts.path)
+        for name, pattern in ROUTES:
+            match = pattern.match(path)
+            if match:
+                break
+        else:
+            raise HTTPError(404, 'Unknown endpoint')
+        server.check_throttle()
+        server.check_errors()
+        args = {}
+        for key, value in match.groupdict().items():
+            if value.startswith('{'):
+                value = params.get(key, 'me' if key == 'user_id' else None)
+            args[key] = value
+        return server.app.handle(self.command, name, args, params, self.headers)
+
+    def send_file(self, data):
+        start, status = 0, 200
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                return self.send_error_body(HTTPError(416))
+            status = 206
+        self.server.fake.count(status)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data) - start))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(data) - 1, len(data)))
+        self.end_headers()
+        self.send_body(data[start:])
+
+    def send_error_body(self, error):
+        self.server.fake.count(error.status)
+        body = '<rsp stat="fail"><err msg="{0}" /></rsp>'.format(error.message).encode('utf-8')
+        self.send_response(error.status)
+        if error.status in (429, 503):
+            self.send_header('Retry-After', '1')
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_body(self, body):
+        bandwidth = self.server.fake.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        chunk = max(1024, int(bandwidth / 20))
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i:i + chunk])
+            time.sleep(len(body[i:i + chunk]) / float(bandwidth))
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer(object):
+    """Runs the stand-in in a background thread on a free local port."""
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 bandwidth=None, error_rate=0.0, rate_limit=None, seed=0,
+                 **data_options):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.stats = {}
+        # the files received, see read_multipart
+        self.uploads = []
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.url = 'http://{0}:{1}'.format(*self.httpd.server_address)
+        self.app = Posterous(self.url + '/files', seed=seed, **data_options)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name='fake-posterous')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def record_uploads(self, files):
+        with self._lock:
+            self.uploads.extend(files)
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self._lock:
+                extra = self._rand.uniform(0, self.jitter)
+            time.sleep(self.latency + extra)
+
+    def check_throttle(self):
+        if not self.rate_limit:
+            return
+        with self._lock:
+            second, count = self._window
+            now = int(time.time())
+            if now != second:
+                second, count = now, 0
+            count += 1
+            self._window = (second, count)
+        if count > self.rate_limit:
+            raise HTTPError(429, 'Rate limit exceeded')
+
+    def check_errors(self):
+        if not self.error_rate:
+            return
+        with self._lock:
+            fail = self._rand.random() < self.error_rate
+            status = self._rand.choice((500, 503))
+        if fail:
+            raise HTTPError(status, 'Injected failure')
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--sites', type='int', default=3)
+    parser.add_option('--posts', type='int', default=100, help='posts per site')
+    parser.add_option('--comments', type='int', default=2)
+    parser.add_option('--media', type='int', default=1)
+    parser.add_option('--body-length', type='int', default=500, dest='body_length')
+    parser.add_option('--latency', type='float', default=0.0)
+    parser.add_option('--jitter', type='float', default=0.0)
+    parser.add_option('--bandwidth', type='int', help='bytes per second')
+    parser.add_option('--error-rate', type='float', default=0.0, dest='error_rate')
+    parser.add_option('--rate-limit', type='int', dest='rate_limit',
+                      help='requests per second')
+    options, args = parser.parse_args()
+
+    server = FakeServer(options.host, options.port, options.latency,
+                        options.jitter, options.bandwidth, options.error_rate,
+                        options.rate_limit, sites=options.sites,
+                        posts_per_site=options.posts, comments=options.comments,
+                        media=options.media, body_length=options.body_length)
+    print('Serving the Posterous API on {0}{1}'.format(server.url, API_ROOT))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Load driver for the client, run against the local stand-in server
+(fakeserver.py).
+
+Each scenario makes the same kind of calls with one feature of the client
+turned on or off and reports calls per second, the p50/p99 latency of a
+call and the number of connections opened:
+
+    no-keepalive - sequential reads, a new connection for each
+    keepalive - sequential reads over the pooled connections
+    threads - reads of different pages from several threads at once
+    batch - get_site for many hostnames through api.batch()
+    cache - repeated reads served from a MemoryCache
+    coalesce - identical reads from several threads at once
+    async - reads through AsyncPostyAPI and asyncio.gather
+    throttled - threads against a rate limited server, with a RateLimiter
+
+    python benchmarks/load.py --latency 0.01 --calls 200
+    python benchmarks/load.py --scenario threads --threads 16
+"""
+
+from optparse import OptionParser
+import asyncio
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+from fakeserver import FakeServer
+from posterous.aio import AsyncPostyAPI
+from posterous.api import PostyAPI
+from posterous.bind import RateLimiter
+from posterous.cache import MemoryCache
+from posterous.metrics import Histogram
+from posterous.transport import HTTPTransport
+
+
+class Run(object):
+    """Timings of the calls of one scenario."""
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.seconds = None
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+        finally:
+            with self._lock:
+                self.latency.add(time.perf_counter() - start)
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+        return self
+
+
+def client(server, cls=PostyAPI, **kwargs):
+    api = cls('load', 'secret', **kwargs)
+    api.host = server.url
+    return api
+
+
+def in_threads(count, target, *args):
+    threads = [threading.Thread(target=target, args=args + (i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def no_keepalive(server, options):
+    api = client(server, transport=HTTPTransport(pool_size=0))
+    api.get_api_token()
+    run = Run()
+    for i in range(options.calls):
+        run.call(api.get_sites)
+    return run.finish(), api.transport
+
+
+def keepalive(server, options):
+    api = client(server)
+    run = Run()
+    for i in range(options.calls):
+        run.call(api.get_sites)
+    return run.finish(), api.transport
+
+
+def threads(server, options):
+    api = client(server, transport=HTTPTransport(pool_size=options.threads))
+    per_thread = max(1, options.calls // options.threads)
+    run = Run()
+
+    def work(index):
+        for page in range(per_thread):
+            run.call(api.read_posts, 1, page=index * per_thread + page + 1,
+                     num_posts=1)
+    in_threads(options.threads, work)
+    return run.finish(), api.transport
+
+
+def batch(server, options):
+    api = client(server, transport=HTTPTransport(pool_size=options.threads))
+    hostnames = ['site{0}'.format(i % len(server.app.sites) + 1)
+                 for i in range(options.calls)]
+    run = Run()
+    # the calls are made when the batch exits, time the whole of it
+    start = time.perf_counter()
+    with api.batch(max_workers=options.threads) as calls:
+        for i, hostname in enumerate(hostnames):
+            # different user ids keep the calls from being coalesced
+            api.get_site(hostname=hostname, user_id=str(i))
+    elapsed = time.perf_counter() - start
+    for i in range(options.calls):
+        run.latency.add(elapsed / options.calls)
+    run.errors = len(calls.errors)
+    return run.finish(), api.transport
+
+
+def cache(server, options):
+    api = client(server, cache=MemoryCache())
+    run = Run()
+    for i in range(options.calls):
+        run.call(api.get_sites)
+    return run.finish(), api.transport
+
+
+def coalesce(server, options):
+    api = client(server, transport=HTTPTransport(pool_size=options.threads))
+    per_thread = max(1, options.calls // options.threads)
+    run = Run()
+
+    def work(index):
+        for i in range(per_thread):
+            run.call(api.get_primary_site)
+    in_threads(options.threads, work)
+    return run.finish(), api.transport
+
+
+def async_(server, options):
+    run = Run()
+
+    async def call(api, page):
+        start = time.perf_counter()
+        try:
+            await api.read_posts(1, page=page, num_posts=1)
+        except Exception:
+            run.errors += 1
+        run.latency.add(time.perf_counter() - start)
+
+    async def main():
+        api = client(server, AsyncPostyAPI)
+        await api.fetch_token(None)
+        run.started = time.perf_counter()
+        for start in range(0, options.calls, options.threads):
+            pages = range(start + 1, min(options.calls, start + options.threads) + 1)
+            await asyncio.gather(*[call(api, page) for page in pages])
+        await api.close()
+        return api.transport
+
+    transport = asyncio.run(main())
+    return run.finish(), transport
+
+
+def throttled(server, options):
+    limit = server.rate_limit
+    server.rate_limit = limit or 50
+    try:
+        limiter = RateLimiter(rate=server.rate_limit, max_in_flight=options.threads,
+                              base_delay=0.1)
+        api = client(server, rate_limiter=limiter,
+                     transport=HTTPTransport(pool_size=options.threads))
+        api.get_api_token()
+        per_thread = max(1, options.calls // options.threads)
+        run = Run()
+
+        def work(index):
+            for page in range(per_thread):
+                run.call(api.read_posts, 1, page=index * per_thread + page + 1,
+                         num_posts=1)
+        in_threads(options.threads, work)
+        return run.finish(), api.transport
+    finally:
+        server.rate_limit = limit
+
+
+SCENARIOS = [('no-keepalive', no_keepalive),
+             ('keepalive', keepalive),
+             ('threads', threads),
+             ('batch', batch),
+             ('cache', cache),
+             ('coalesce', coalesce),
+             ('async', async_),
+             ('throttled', throttled)]
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--scenario', action='append',
+                      help='scenario to run, can be repeated [default: all]')
+    parser.add_option('--calls', type='int', default=200,
+                      help='calls per scenario [default: %default]')
+    parser.add_option('--threads', type='int', default=8,
+                      help='concurrency of the parallel scenarios [default: %default]')
+    parser.add_option('--latency', type='float', default=0.005,
+                      help='server latency in seconds [default: %default]')
+    parser.add_option('--jitter', type='float', default=0.0)
+    parser.add_option('--bandwidth', type='int', help='server bytes per second')
+    parser.add_option('--error-rate', type='float', default=0.0, dest='error_rate')
+    parser.add_option('--rate-limit', type='int', dest='rate_limit',
+                      help='server requests per second')
+    options, args = parser.parse_args()
+
+    names = options.scenario or [name for name, func in SCENARIOS]
+    unknown = set(names) - set(name for name, func in SCENARIOS)
+    if unknown:
+        parser.error('unknown scenario: {0}'.format(', '.join(sorted(unknown))))
+
+    server = FakeServer(latency=options.latency, jitter=options.jitter,
+                        bandwidth=options.bandwidth, error_rate=options.error_rate,
+                        rate_limit=options.rate_limit, sites=3,
+                        posts_per_site=max(options.calls, 50)).start()
+    try:
+        print('{0:<13} {1:>6} {2:>8} {3:>9} {4:>8} {5:>8} {6:>6} {7:>6}'.format(
+            'scenario', 'calls', 'seconds', 'calls/s', 'p50 ms', 'p99 ms',
+            'conns', 'errors'))
+        for name, func in SCENARIOS:
+            if name not in names:
+                continue
+            run, transport = func(server, options)
+            calls = run.latency.count
+            print('{0:<13} {1:>6} {2:>8.2f} {3:>9.1f} {4:>8.2f} {5:>8.2f} {6:>6} {7:>6}'.format(
+                name, calls, run.seconds, calls / run.seconds,
+                run.latency.percentile(50) * 1000, run.latency.percentile(99) * 1000,
+                transport.stats.connections_opened, run.errors))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
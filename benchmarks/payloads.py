@@ -0,0 +1,128 @@
+"""
+Generates realistic Posterous API responses for the benchmarks.
+
+The output is deterministic for a given seed, so runs can be compared.
+
+    from payloads import posts_response
+    xml = posts_response(posts=50, comments=3, media=2, body_length=2000)
+"""
+
+from datetime import datetime, timedelta
+import random
+
+
+# Sizes of the responses used by the benchmarks, see bench_parse.py
+PROFILES = {
+    'small': dict(posts=10, comments=1, media=1, body_length=200),
+    'medium': dict(posts=50, comments=3, media=2, body_length=2000),
+    'large': dict(posts=200, comments=10, media=4, body_length=10000),
+}
+
+WORDS = ('brunch san francisco posterous photo video weekend trip coffee '
+         'music album review table touch original art collection link '
+         'issue latest great first last time place today tomorrow').split()
+
+START = datetime(2009, 1, 1)
+MEDIA_ROOT = 'http://posterous.com/getfile/files.posterous.com'
+
+
+def words(rand, n):
+    return ' '.join(rand.choice(WORDS) for i in range(n))
+
+
+def text(rand, length):
+    """HTML about length characters long."""
+    parts = []
+    size = 0
+    while size < length:
+        part = '<p>{0}</p>'.format(words(rand, rand.randint(5, 30)))
+        parts.append(part)
+        size += len(part)
+    return ''.join(parts)[:max(length, 0)]
+
+
+def date(rand):
+    return (START + timedelta(seconds=rand.randint(0, 10 ** 8))).strftime(
+        '%a, %d %b %Y %H:%M:%S -0800')
+
+
+def media_xml(rand, post_id, index, media_root=MEDIA_ROOT):
+    kind = ('image', 'audio', 'video')[index % 3]
+    base = '{0}/bench/{1}-{2}'.format(media_root, post_id, index)
+    if kind == 'image':
+        return ('<media><type>image</type>'
+                '<medium><url>{0}.scaled500.jpg</url><filesize>{1}</filesize>'
+                '<height>333</height><width>500</width></medium>'
+                '<thumb><url>{0}.thumb.jpg</url><filesize>5</filesize>'
+                '<height>36</height><width>36</width></thumb>'
+                '</media>').format(base, rand.randint(10, 500))
+    if kind == 'audio':
+        return ('<media><type>audio</type><url>{0}.mp3</url>'
+                '<filesize>{1}</filesize><artist>{2}</artist><album>{3}</album>'
+                '<song>{4}</song></media>').format(
+                    base, rand.randint(1000, 10000), words(rand, 2),
+                    words(rand, 1), words(rand, 3))
+    return ('<media><type>video</type><url>{0}.avi</url>'
+            '<filesize>{1}</filesize><thumb>{0}.png</thumb>'
+            '<flv>{0}.flv</flv><mp4>{0}.mp4</mp4></media>').format(
+                base, rand.randint(1000, 10000))
+
+
+def comment_xml(rand, post_id, index):
+    return ('<comment><id>{0}</id><body><![CDATA[{1}]]></body><date>{2}</date>'
+            '<author>{3}</author>'
+            '<authorpic>http://files.posterous.com/user_profile_pics/{4}/head.jpg</authorpic>'
+            '</comment>').format(post_id * 1000 + index, words(rand, 12),
+                                 date(rand), rand.choice(WORDS), rand.randint(1, 10 ** 6))
+
+
+def post_xml(rand, post_id, comments=2, media=1, body_length=500, post_date=None,
+             media_root=MEDIA_ROOT):
+    title = words(rand, rand.randint(2, 10))
+    slug = title.replace(' ', '-')
+    return ''.join([
+        '<post>',
+        '<url>http://post.ly/{0:x}</url>'.format(post_id),
+        '<link>http://bench.posterous.com/{0}</link>'.format(slug),
+        '<title>{0}</title>'.format(title),
+        '<id>{0}</id>'.format(post_id),
+        '<body><![CDATA[{0}]]></body>'.format(text(rand, body_length)),
+        '<date>{0}</date>'.format(post_date or date(rand)),
+        '<views>{0}</views>'.format(rand.randint(0, 1000)),
+        '<private>false</private>',
+        '<author>bench</author>',
+        '<authorpic>http://files.posterous.com/user_profile_pics/1/head.jpg</authorpic>',
+        '<commentsenabled>true</commentsenabled>',
+        ''.join(media_xml(rand, post_id, i, media_root) for i in range(media)),
+        '<commentscount>{0}</commentscount>'.format(comments),
+        ''.join(comment_xml(rand, post_id, i) for i in range(comments)),
+        '</post>'])
+
+
+def site_xml(rand, site_id, num_posts=50, hostname=None):
+    hostname = hostname or 'site{0}'.format(site_id)
+    return ('<site><id>{0}</id><name>{1}</name>'
+            '<url>http://{2}.posterous.com</url><hostname>{2}</hostname>'
+            '<private>false</private><primary>{3}</primary>'
+            '<commentsenabled>true</commentsenabled>'
+            '<num_posts>{4}</num_posts></site>').format(
+                site_id, words(rand, 3), hostname,
+                'true' if site_id == 1 else 'false', num_posts)
+
+
+def response(*elements):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<rsp stat="ok">{0}</rsp>'
+            .format(''.join(elements)).encode('utf-8'))
+
+
+def posts_response(posts=50, comments=2, media=1, body_length=500, seed=0,
+                   start_id=1):
+    """A read_posts response with the given number and shape of posts."""
+    rand = random.Random(seed)
+    return response(*[post_xml(rand, start_id + i, comments, media, body_length)
+                      for i in range(posts)])
+
+
+def sites_response(sites=2, seed=0):
+    rand = random.Random(seed)
+    return response(*[site_xml(rand, i + 1) for i in range(sites)])
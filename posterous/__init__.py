@@ -17,7 +17,48 @@ __author__ = "Benjamin Reitzammer <http://github.com/nureineide>"
 __email__ = "benjamin@squeakyvessel.com"
 __credits__ = ['Michael Campagnaro <http://github.com/mikecampo>']
 
-from posterous.api import API
+import importlib
+import sys
+import types
 
-# unauthenticated instance 
-api = API()
+# Everything is imported on first access (PEP 562), so that scripts only
+# pay for the parts of the library they use.
+_submodules = ('aio', 'auth', 'backup', 'batch', 'bind', 'cache', 'cursor',
+               'error', 'metrics', 'mirror', 'models', 'multipart', 'pack',
+               'parsers', 'transport', 'utils')
+
+
+class _Package(types.ModuleType):
+    """
+    posterous.api is the unauthenticated API instance, as it always was,
+    even though the import system sets it to the posterous.api submodule
+    whenever that gets imported.
+    """
+    @property
+    def api(self):
+        instance = self.__dict__.get('_api')
+        if instance is None:
+            instance = self.__dict__['_api'] = self.API()
+        return instance
+
+    @api.setter
+    def api(self, value):
+        if not isinstance(value, types.ModuleType):
+            self.__dict__['_api'] = value
+
+
+sys.modules[__name__].__class__ = _Package
+
+
+def __getattr__(name):
+    if name in ('API', 'PostyAPI'):
+        from posterous.api import PostyAPI
+        globals().update(API=PostyAPI, PostyAPI=PostyAPI)
+        return PostyAPI
+    if name in _submodules:
+        return importlib.import_module('posterous.' + name)
+    raise AttributeError("module 'posterous' has no attribute '{0}'".format(name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules) | set(('API', 'PostyAPI', 'api')))
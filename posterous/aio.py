@@ -0,0 +1,396 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+"""
+asyncio flavour of the client. Every method bound on PostyAPI is available
+on AsyncPostyAPI as a coroutine that shares the parameter checking and
+parsing of the blocking version.
+
+    api = AsyncPostyAPI('username', 'password')
+    sites = await api.get_sites()
+"""
+
+import asyncio
+from collections import deque
+import http.client
+import io
+import time
+import urllib.parse
+
+from posterous.api import PostyAPI
+from posterous.transport import (HTTPTransport, IDEMPOTENT_METHODS, Response,
+                                 TransportStats)
+
+
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected,
+                           asyncio.IncompleteReadError,
+                           ConnectionResetError,
+                           BrokenPipeError)
+
+
+class _Connection(object):
+    """An open stream pair plus the time it was last returned to the pool."""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncHTTPTransport(object):
+    """
+    Non-blocking counterpart of posterous.transport.HTTPTransport built on
+    asyncio streams. Takes the same pooling options.
+    """
+    default_ports = {'http': 80, 'https': 443}
+
+    def __init__(self, pool_size=10, idle_timeout=60, timeout=None):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.stats = TransportStats()
+        self._pools = {}
+
+    async def request(self, method, url, body=None, headers=None):
+        """Sends the request and returns a Response."""
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or self.default_ports[parts.scheme]
+        key = (parts.scheme, parts.hostname, port)
+        target = parts.path or '/'
+        if parts.query:
+            target = '{0}?{1}'.format(target, parts.query)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        stream = None
+        if hasattr(body, 'send_to'):
+            # written after the headers a chunk at a time, see posterous.multipart
+            stream, body = body, None
+            headers = dict(headers or {})
+            if stream.length is None:
+                headers['Transfer-Encoding'] = 'chunked'
+            elif not any(name.lower() == 'content-length' for name in headers):
+                headers['Content-Length'] = str(stream.length)
+        data = self._encode_request(method, target, parts.netloc, body,
+                                    headers or {})
+        timings = {'request_bytes': len(data) + (stream and stream.length or 0)}
+
+        conn, reused = await self._acquire(key, timings=timings)
+        try:
+            response, will_close = await self._send(conn, method, data, stream, timings)
+        except STALE_CONNECTION_ERRORS:
+            self._discard(conn)
+            if not reused or method not in IDEMPOTENT_METHODS:
+                raise
+            # the server closed the idle connection, try again on a new one
+            conn, reused = await self._acquire(key, fresh=True, timings=timings)
+            try:
+                response, will_close = await self._send(conn, method, data, stream, timings)
+            except Exception:
+                self._discard(conn)
+                raise
+        except BaseException:
+            self._discard(conn)
+            raise
+
+        self.stats.requests += 1
+        if reused:
+            self.stats.connections_reused += 1
+
+        if will_close:
+            self._discard(conn)
+        else:
+            self._release(key, conn)
+        response.timings = timings
+        return response
+
+    async def close(self):
+        """Closes all idle connections."""
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for conn in pool:
+                self._discard(conn)
+
+    def _encode_request(self, method, target, netloc, body, headers):
+        lines = ['{0} {1} HTTP/1.1'.format(method, target)]
+        names = set(name.lower() for name in headers)
+        if 'host' not in names:
+            lines.append('Host: {0}'.format(netloc))
+        if 'accept-encoding' not in names:
+            lines.append('Accept-Encoding: identity')
+        if body is not None and 'content-length' not in names:
+            lines.append('Content-Length: {0}'.format(len(body)))
+        for name, value in headers.items():
+            lines.append('{0}: {1}'.format(name, value))
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        return head + body if body else head
+
+    async def _send(self, conn, method, data, stream, timings):
+        conn.writer.write(data)
+        if stream is not None:
+            await self._write_stream(conn.writer, stream)
+        await conn.writer.drain()
+        return await asyncio.wait_for(
+            self._read_response(conn.reader, method, timings), self.timeout)
+
+    async def _write_stream(self, writer, stream):
+        chunked = stream.length is None
+        for chunk in stream:
+            if chunked:
+                writer.write('{0:x}\r\n'.format(len(chunk)).encode('ascii'))
+            writer.write(chunk)
+            if chunked:
+                writer.write(b'\r\n')
+            # wait for the socket so only a chunk or so is ever buffered
+            await writer.drain()
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+
+    async def _read_response(self, reader, method, timings):
+        start = time.perf_counter()
+        status_line = await reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected(
+                'Remote end closed connection without response')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n')
+                                   .split(' ', 2) + [''])[:3]
+        status = int(status)
+
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line)
+        headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+        received = time.perf_counter()
+        timings['ttfb'] = received - start
+
+        connection = headers.get('Connection', '').lower()
+        will_close = (connection == 'close' or
+                      (version == 'HTTP/1.0' and connection != 'keep-alive'))
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = await self._read_chunked(reader)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            # the body is delimited by the server closing the connection
+            body = await reader.read()
+            will_close = True
+        timings['transfer'] = time.perf_counter() - received
+        timings['response_bytes'] = len(body)
+
+        return Response(status, reason, headers, body), will_close
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # skip the trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def _acquire(self, key, fresh=False, timings=None):
+        now = time.monotonic()
+        pool = self._pools.get(key)
+        while pool and not fresh:
+            conn = pool.pop()
+            if now - conn.last_used < self.idle_timeout:
+                return conn, True
+            self._discard(conn)
+
+        scheme, host, port = key
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=(scheme == 'https') or None),
+            self.timeout)
+        if timings is not None:
+            timings['connect'] = time.perf_counter() - start
+        self.stats.connections_opened += 1
+        return _Connection(reader, writer), False
+
+    def _release(self, key, conn):
+        pool = self._pools.setdefault(key, deque())
+        if len(pool) < self.pool_size:
+            conn.last_used = time.monotonic()
+            pool.append(conn)
+        else:
+            self._discard(conn)
+
+    def _discard(self, conn):
+        conn.close()
+        self.stats.connections_closed += 1
+
+
+async def send(api, method, http_method, url, body, headers):
+    """Coroutine version of APIMethod.send."""
+    limiter = api.rate_limiter
+    attempt = 0
+    queued = time.perf_counter()
+    method.timings['queue'] = 0.0
+    while True:
+        if limiter is not None:
+            await limiter.acquire_async(method)
+        method.timings['queue'] += time.perf_counter() - queued
+        try:
+            resp = await api.transport.request(http_method, url, body, headers)
+        except Exception as e:
+            queued = time.perf_counter()
+            if limiter is not None:
+                limiter.release(method, None)
+                if limiter.should_retry(method, None, attempt):
+                    await asyncio.sleep(limiter.retry_delay(attempt))
+                    attempt += 1
+                    continue
+            raise Exception('Failed to send request: {0}'.format(e))
+
+        queued = time.perf_counter()
+        if limiter is not None:
+            limiter.release(method, resp.status)
+            if limiter.should_retry(method, resp.status, attempt):
+                await asyncio.sleep(limiter.retry_delay(attempt,
+                                                        resp.getheader('Retry-After')))
+                attempt += 1
+                continue
+        return resp
+
+
+def bind_coroutine(call):
+    """
+    Turns a method created by bind_method into a coroutine function that
+    sends the request on the api's asynchronous transport.
+    """
+    APIMethod = call.api_method
+
+    async def _coroutine(api, *args, **kwargs):
+        if APIMethod.auth_type == 'token' and not api.api_token:
+            # fetch the token up front, APIMethod can't await it
+            await api.fetch_token(None)
+
+        method = APIMethod(api, args, kwargs)
+        try:
+            while True:
+                http_method, url, body, headers = method.build_request()
+                cached = method.cached_response(url)
+                if cached is not None:
+                    return method.finish(api.parser.parse(method, cached))
+
+                resp = await send(api, method, http_method, url, body, headers)
+
+                if resp.status == 401 and method.can_refresh_token():
+                    method.refresh_token(await api.fetch_token(method.api_token))
+                    continue
+                method.timings.update(resp.timings)
+                return method.finish(method.parse_response(resp, url))
+        except Exception:
+            method.record(error=True)
+            raise
+
+    _coroutine.api_method = APIMethod
+    return _coroutine
+
+
+class AsyncPostyAPI(PostyAPI):
+    """PostyAPI whose API calls are coroutines."""
+    def __init__(self, username=None, password=None, parser=None,
+                 transport=None, cache=None, tokens=None, rate_limiter=None,
+                 metrics=None, format='xml'):
+        PostyAPI.__init__(self, username, password, parser,
+                          transport or AsyncHTTPTransport(), cache, tokens,
+                          rate_limiter, metrics, format)
+        self._token_lock = asyncio.Lock()
+
+    async def fetch_token(self, stale_token):
+        """
+        Coroutine version of TokenManager.get/refresh: one coroutine fetches
+        the token while the others wait for it.
+        """
+        async with self._token_lock:
+            tokens = self.tokens
+            if tokens.token and tokens.token != stale_token:
+                return tokens.token
+            token = tokens.load()
+            if token and token != stale_token:
+                tokens.token = token
+                return token
+            if not (self.username and self.password):
+                raise Exception("You must suppy a username and password!")
+            token = await self.get_api_token()
+            tokens.fetches += 1
+            tokens.store(token)
+            return token
+
+    async def iter_posts(self, site_id, per_page=50, prefetch=1, start_page=1,
+                         **kwargs):
+        """
+        Async generator version of PostyAPI.iter_posts: yields every post of
+        a site, requesting the next page while the current one is consumed
+        unless prefetch is 0.
+        """
+        def fetch(page):
+            call = self.read_posts(site_id, page=page, num_posts=per_page, **kwargs)
+            return asyncio.ensure_future(call) if prefetch else call
+
+        pending = fetch(start_page)
+        page = start_page
+        try:
+            while pending is not None:
+                posts = await pending
+                pending = None
+                # a short page is the last one, like Cursor
+                if len(posts) == per_page:
+                    page += 1
+                    pending = fetch(page)
+                for post in posts:
+                    yield post
+        finally:
+            if isinstance(pending, asyncio.Future):
+                pending.cancel()
+            elif pending is not None:
+                pending.close()
+
+    def batch(self, max_workers=8):
+        raise TypeError('AsyncPostyAPI calls are coroutines already, '
+                        'run them concurrently with asyncio.gather')
+
+    @property
+    def blocking_transport(self):
+        """
+        An HTTPTransport for what has no coroutine version, such as
+        Media.download, created on first use.
+        """
+        transport = self.__dict__.get('_blocking_transport')
+        if transport is None:
+            transport = self._blocking_transport = HTTPTransport()
+        return transport
+
+    async def close(self):
+        await self.transport.close()
+        if '_blocking_transport' in self.__dict__:
+            self._blocking_transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+for name, value in list(vars(PostyAPI).items()):
+    if hasattr(value, 'api_method'):
+        setattr(AsyncPostyAPI, name, bind_coroutine(value))
@@ -1,11 +1,75 @@
-from postypy.bind import bind_method
+import threading
+
+from posterous.bind import FILE, bind_method
+from posterous.parsers import ModelParser
 
 class PostyAPI(object):
-    def __init__(self, username=None, password=None):
+    def __init__(self, username=None, password=None, parser=None,
+                 transport=None, cache=None, tokens=None, rate_limiter=None,
+                 metrics=None, format='xml'):
         self.username = username
         self.password = password
+        # Shared by every thread using this instance, see posterous.auth
+        if tokens is None:
+            from posterous.auth import TokenManager
+            tokens = TokenManager()
+        self.tokens = tokens
         self.host = 'http://posterous.com'
         self.api_root = "/api/2"
+        # Response format asked for, 'xml' or 'json'
+        self.format = format
+        self.parser = parser or ModelParser()
+        # Keep-alive connection pool shared by all calls on this instance,
+        # created on first use
+        self._transport = transport
+        # Optional response cache for read methods, see posterous.cache
+        self.cache = cache
+        # Coalesces identical concurrent GET calls, None turns it off
+        from posterous.cache import SingleFlight
+        self.inflight = SingleFlight()
+        # Optional scheduler shared by the api instances of an account,
+        # see posterous.bind.RateLimiter
+        self.rate_limiter = rate_limiter
+        # Optional posterous.metrics.MetricsRegistry recording every call
+        self.metrics = metrics
+        # Per thread state, e.g. the batch calls are collected in
+        self._local = threading.local()
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            from posterous.transport import HTTPTransport
+            self._transport = HTTPTransport()
+        return self._transport
+
+    @transport.setter
+    def transport(self, transport):
+        self._transport = transport
+
+    @property
+    def api_token(self):
+        return self.tokens.token
+
+    @api_token.setter
+    def api_token(self, token):
+        self.tokens.token = token
+
+    def batch(self, max_workers=8):
+        """
+        Returns a context in which API calls return futures and are sent
+        concurrently when it exits, see posterous.batch.Batch.
+        """
+        from posterous.batch import Batch
+        return Batch(self, max_workers)
+
+    def iter_posts(self, site_id, **kwargs):
+        """
+        Yields every post of a site, fetching the next page in the background.
+        Takes the per_page and prefetch options of posterous.cursor.Cursor and
+        the parameters of read_posts.
+        """
+        from posterous.cursor import Cursor
+        return Cursor(self.read_posts, site_id, **kwargs).items()
     
     ### Posterous API calls
     """
@@ -19,6 +83,8 @@ class PostyAPI(object):
     "parameters" - The parameters that may be supplied to the call as
         documented on apidocs.posterous.com
         -- "user_id" - "me" by default 
+    "cache_ttl" - Seconds a GET response may be served from the api's cache.
+        Methods without it are never cached.
     """
     ## Authentication
     
@@ -38,6 +104,7 @@ class PostyAPI(object):
         path = '/users/{user_id}/sites',
         response_type = 'site_list',
         auth_type = 'token',
+        cache_ttl = 300,
         parameters = [
             ('user_id', str)]
         )
@@ -47,6 +114,7 @@ class PostyAPI(object):
         path = '/users/{user_id}/sites',
         response_type = 'site',
         auth_type = 'token',
+        cache_ttl = 300,
         parameters = [
             ('user_id', str),
             ('hostname', str)]
@@ -54,9 +122,10 @@ class PostyAPI(object):
         
     ''' Returns a single Site object for the user's primary site. '''
     get_primary_site = bind_method(
-        path = 'users/{user_id}/sites/primary',
+        path = '/users/{user_id}/sites/primary',
         response_type = 'site',
         auth_type = 'token',
+        cache_ttl = 300,
         parameters = [
             ('user_id', str)]
         )
@@ -95,4 +164,52 @@ class PostyAPI(object):
             ('user_id', str),
             ('hostname', str)]
         )
-    
\ No newline at end of file
+    
+    ## Posts
+
+    ''' Returns a list of Post objects for a site, one page at a time.'''
+    read_posts = bind_method(
+        path = '/users/{user_id}/sites/{site_id}/posts',
+        response_type = 'post_list',
+        auth_type = 'token',
+        cache_ttl = 60,
+        parameters = [
+            ('site_id', int),
+            ('user_id', str),
+            ('page', int),
+            ('num_posts', int),
+            ('since_id', int),
+            ('tag', str)]
+        )
+
+    ''' Creates a post on a site and returns it as a Post object. Files,
+    or a list of them, given as media are streamed from disk while they
+    are uploaded, see posterous.multipart.'''
+    new_post = bind_method(
+        path = '/users/{user_id}/sites/{site_id}/posts',
+        method = 'POST',
+        response_type = 'post',
+        auth_type = 'token',
+        parameters = [
+            ('site_id', int),
+            ('user_id', str),
+            ('title', str),
+            ('body', str),
+            ('tags', str),
+            ('autopost', bool),
+            ('is_private', bool),
+            ('media', (FILE, list))]
+        )
+
+    ## Tags
+
+    ''' Returns a list of Tag objects for the tags used on a site.'''
+    get_tags = bind_method(
+        path = '/users/{user_id}/sites/{site_id}/tags',
+        response_type = 'tag_list',
+        auth_type = 'token',
+        cache_ttl = 300,
+        parameters = [
+            ('site_id', int),
+            ('user_id', str)]
+        )
@@ -0,0 +1,107 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+from contextlib import contextmanager
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # no cross-process locking, e.g. on Windows
+    fcntl = None
+
+
+class TokenManager(object):
+    """
+    Holds the API token used by token authenticated methods.
+
+    Only one caller at a time fetches a token; everyone else waits for it
+    and reuses the result. The manager can be shared by several PostyAPI
+    instances. When a path is given the token is also kept in that file,
+    which lets worker processes of the same account share a single token
+    (the file is locked while a token is fetched).
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.token = None
+        self.fetches = 0
+        self._lock = threading.Lock()
+
+    def get(self, api):
+        """Returns the current token, fetching one from api if there's none."""
+        token = self.token
+        if token:
+            return token
+        with self._lock:
+            if not self.token:
+                self._acquire(api, None)
+            return self.token
+
+    def refresh(self, api, stale_token):
+        """
+        Replaces a token the server rejected. If another caller already
+        replaced it, that token is returned without fetching again.
+        """
+        with self._lock:
+            if self.token and self.token != stale_token:
+                return self.token
+            self._acquire(api, stale_token)
+            return self.token
+
+    def load(self):
+        """Returns the token stored in the file, if any."""
+        if self.path is None:
+            return None
+        try:
+            with open(self.path) as f:
+                return f.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    def store(self, token):
+        """Sets the token and writes it to the file atomically."""
+        self.token = token
+        if self.path is None:
+            return
+        import tempfile
+        folder = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=folder, prefix='.token')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(token)
+            os.replace(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def _acquire(self, api, stale_token):
+        with self._file_lock():
+            # another process may have fetched one in the meantime
+            token = self.load()
+            if token and token != stale_token:
+                self.token = token
+                return
+            if not (api.username and api.password):
+                raise Exception("You must suppy a username and password!")
+            token = api.get_api_token()
+            self.fetches += 1
+            self.store(token)
+
+    @contextmanager
+    def _file_lock(self):
+        if self.path is None or fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
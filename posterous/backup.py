@@ -0,0 +1,657 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+"""
+Backs up Posterous sites into a folder structure like
+
+    /{folder}
+        /{site.hostname}
+            site-{site.hostname}.json
+            {post-slug}.json  <-- contains body & comments & everything else
+            {post-slug}_{num}.{ext}  <-- the post's media
+            manifest-{site.hostname}.json  <-- what was saved, for reruns
+
+or, with format='pack', with the posts appended to a single indexed file
+instead of one file each (see posterous.pack):
+
+            posts-{site.hostname}.pack
+            posts-{site.hostname}.pack.idx
+
+folder_to_pack() and pack_to_folder() convert a site folder from one
+layout to the other.
+
+Page fetching, JSON writing and media downloads each run in their own
+bounded pool of worker threads, so the network is never left idle while
+files are being written.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import urllib.parse
+import zlib
+
+from posterous.models import Model
+from posterous.pack import PackReader, PackWriter, index_path
+from posterous.utils import import_simplejson
+
+json = import_simplejson()
+
+
+class JsonDateEncoder(json.JSONEncoder):
+    """Encodes models as their attributes and dates as strings."""
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return str(o)
+        if isinstance(o, Model):
+            return dict((k, v) for k, v in vars(o).items() if not k.startswith('_'))
+        return json.JSONEncoder.default(self, o)
+
+
+def post_slug(post):
+    return link_slug(post.link)
+
+
+def link_slug(link):
+    return re.sub(r'^/', '', urllib.parse.urlparse(link).path)
+
+
+def encode_json(obj):
+    """The JSON write_json saves, as bytes."""
+    return json.dumps(obj, cls=JsonDateEncoder).encode('utf-8')
+
+
+def pack_path(site_folder):
+    hostname = os.path.basename(os.path.normpath(site_folder))
+    return os.path.join(site_folder, 'posts-%s.pack' % hostname)
+
+
+def post_files(site_folder):
+    """The post files of a site folder in the folder layout."""
+    for name in sorted(os.listdir(site_folder)):
+        if name.endswith('.json') and not name.startswith(('site-', 'manifest-')):
+            yield os.path.join(site_folder, name)
+
+
+def folder_to_pack(site_folder, remove=False):
+    """
+    Appends the post files of a site folder to its pack and returns the
+    path of the pack. The site file, the manifest and the media stay as
+    they are. The post files are deleted if remove is true.
+    """
+    path = pack_path(site_folder)
+    paths = list(post_files(site_folder))
+    with PackWriter(path) as pack:
+        for post_file in paths:
+            with open(post_file, 'rb') as f:
+                payload = f.read()
+            post = json.loads(payload.decode('utf-8'))
+            pack.add(post['id'], post.get('date'), payload)
+    if remove:
+        for post_file in paths:
+            os.remove(post_file)
+    return path
+
+
+def pack_to_folder(site_folder, remove=False):
+    """
+    Writes the posts in the pack of a site folder out as post files, the
+    reverse of folder_to_pack. The pack is deleted if remove is true.
+    """
+    path = pack_path(site_folder)
+    with PackReader(path) as pack:
+        for entry in pack.entries_between():
+            payload = pack.raw(entry[0])
+            post = pack.decode(payload)
+            with open(os.path.join(site_folder, '%s.json' % link_slug(post['link'])), 'wb') as f:
+                f.write(payload)
+    if remove:
+        os.remove(path)
+        if os.path.exists(index_path(path)):
+            os.remove(index_path(path))
+
+
+def media_url(media):
+    return media.medium_url if hasattr(media, 'medium_url') else media.url
+
+
+class BoundedExecutor(object):
+    """
+    A thread pool whose queue of pending tasks is bounded, so a fast
+    producer blocks instead of piling up work in memory.
+    """
+    def __init__(self, max_workers, max_pending=None, name=None):
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_pending or max_workers * 2)
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait)
+
+
+class BlobStore(object):
+    """
+    Content addressed store for media shared by posts, sites and accounts.
+
+    Every file is kept once under {root}/{sha1[:2]}/{sha1} and linked into
+    the backup folders. A media url seen before is linked without being
+    downloaded; a new url is downloaded and dropped if its content turns
+    out to be a blob that's already stored.
+
+    "link" - 'hardlink' (the default), 'symlink' or 'copy'. Hard links
+        fall back to symbolic links across file systems.
+    """
+    def __init__(self, root, link='hardlink'):
+        self.root = root
+        self.link = link
+        self.url_hits = 0
+        self.hash_hits = 0
+        self.bytes_saved = 0
+        self._index_path = os.path.join(root, 'urls.json')
+        self._incoming = os.path.join(root, 'incoming')
+        self._lock = threading.Lock()
+        # url -> Event set when its download is over
+        self._fetching = {}
+        if not os.path.exists(self._incoming):
+            os.makedirs(self._incoming)
+        self.urls = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                self.urls = json.load(f)
+
+    def blob_path(self, checksum):
+        return os.path.join(self.root, checksum[:2], checksum)
+
+    def fetch(self, media, path, prefer=None):
+        """
+        Places the media at path, downloading it only if neither its url nor
+        its content is in the store yet. Returns the SHA-1 of the content.
+        """
+        url = media.best_source(prefer)[0]
+        download = False
+        while True:
+            with self._lock:
+                checksum = self.urls.get(url)
+                if checksum and os.path.exists(self.blob_path(checksum)):
+                    self.url_hits += 1
+                    self.bytes_saved += os.path.getsize(self.blob_path(checksum))
+                    break
+                pending = self._fetching.get(url)
+                if pending is None:
+                    self._fetching[url] = threading.Event()
+                    download = True
+                    break
+            # the url is being downloaded by another worker, link its blob
+            # once it's done (or take over if it failed)
+            pending.wait()
+        if download:
+            try:
+                checksum = self._download(media, url, prefer)
+            finally:
+                with self._lock:
+                    self._fetching.pop(url).set()
+        self._link(self.blob_path(checksum), path)
+        return checksum
+
+    def save_index(self):
+        with self._lock:
+            tmp = self._index_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.urls, f)
+            os.replace(tmp, self._index_path)
+
+    def _download(self, media, url, prefer):
+        # named after the url so that a killed download gets resumed
+        incoming = os.path.join(self._incoming,
+                                hashlib.sha1(url.encode('utf-8')).hexdigest())
+        hasher = hashlib.sha1()
+        media.download(incoming, prefer=prefer, hasher=hasher)
+        checksum = hasher.hexdigest()
+
+        blob = self.blob_path(checksum)
+        with self._lock:
+            if os.path.exists(blob):
+                # same content under another url
+                self.hash_hits += 1
+                self.bytes_saved += os.path.getsize(incoming)
+                os.remove(incoming)
+            else:
+                if not os.path.exists(os.path.dirname(blob)):
+                    os.makedirs(os.path.dirname(blob))
+                os.replace(incoming, blob)
+            self.urls[url] = checksum
+        return checksum
+
+    def _link(self, blob, path):
+        if os.path.lexists(path):
+            os.remove(path)
+        if self.link == 'hardlink':
+            try:
+                os.link(blob, path)
+                return
+            except OSError:
+                # e.g. the backup lives on another file system
+                pass
+        if self.link in ('hardlink', 'symlink'):
+            os.symlink(os.path.abspath(blob), path)
+        else:
+            shutil.copyfile(blob, path)
+
+
+class BackupStats(object):
+    """Counters for the throughput summary."""
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.sites = 0
+        self.pages = 0
+        self.posts = 0
+        self.media = 0
+        self.bytes = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def error(self, message):
+        logging.error(message)
+        with self._lock:
+            self.errors.append(message)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def summary(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return ('Backed up {0} sites, {1} pages, {2} posts and {3} media files '
+                '({4:.1f} MB) in {5:.1f}s: {6:.1f} posts/s, {7:.2f} MB/s, '
+                '{8} errors').format(
+                    self.sites, self.pages, self.posts, self.media,
+                    self.bytes / 1e6, elapsed, self.posts / elapsed,
+                    self.bytes / 1e6 / elapsed, len(self.errors))
+
+
+class Manifest(object):
+    """
+    Records what has been backed up for a site so that a rerun can skip
+    unchanged posts and a killed run can pick up where it stopped.
+
+    For every post it keeps the date, the comment count, the size of its
+    JSON record (and its CRC-32 in a pack) and the size and checksum of
+    each media file. "checkpoint" is the date of the newest post
+    seen by the last run that completed, "resume_page" the last page whose
+    posts were all written by a run that didn't.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.posts = {}
+        self.checkpoint = None
+        self.resume_page = None
+        self.failed = False
+        self._newest = None
+        self._next_page = None
+        self._outstanding = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        manifest = cls(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            manifest.posts = data.get('posts', {})
+            manifest.resume_page = data.get('resume_page')
+            manifest.checkpoint = cls._parse_date(data.get('checkpoint'))
+            if manifest.resume_page:
+                # the posts written before the run was killed count too
+                manifest._newest = cls._parse_date(data.get('newest'))
+        return manifest
+
+    @staticmethod
+    def _parse_date(value):
+        if not value:
+            return None
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+    def save(self):
+        with self._lock:
+            data = {'checkpoint': self.checkpoint and str(self.checkpoint),
+                    'newest': self._newest and str(self._newest),
+                    'resume_page': self.resume_page,
+                    'posts': self.posts}
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+
+    def is_current(self, post, site_folder, pack=None):
+        """
+        True if the post and its media are on disk, complete, and haven't
+        changed. "pack" is the PackWriter of a site in the pack layout.
+        """
+        entry = self.posts.get(str(post.id))
+        if entry is None:
+            return False
+        record = entry.get('record') or {}
+        if pack is not None:
+            stored = pack.entries.get(post.id)
+            if stored is None:
+                return False
+            if 'size' in record and stored[3] != record['size']:
+                return False
+            if 'crc32' in record and stored[4] != record['crc32']:
+                return False
+        else:
+            path = os.path.join(site_folder, '%s.json' % post_slug(post))
+            if not os.path.exists(path):
+                return False
+            if 'size' in record and os.path.getsize(path) != record['size']:
+                return False
+        if entry['date'] != str(getattr(post, 'date', None)):
+            return False
+        if entry['commentscount'] != getattr(post, 'commentscount', 0):
+            return False
+        media = getattr(post, 'media', [])
+        if len(entry['media']) != len(media):
+            return False
+        for record, m in zip(entry['media'], media):
+            path = os.path.join(site_folder, record['file'])
+            if record['url'] != media_url(m):
+                return False
+            if not os.path.exists(path) or os.path.getsize(path) != record['size']:
+                return False
+        return True
+
+    def is_older(self, post):
+        """True if the post predates the last completed run."""
+        date = getattr(post, 'date', None)
+        return bool(self.checkpoint and date and date < self.checkpoint)
+
+    def start(self, page):
+        """Called with the first page requested by this run."""
+        self._next_page = page
+
+    def start_page(self, page, count):
+        with self._lock:
+            self._outstanding[page] = count
+        self._advance()
+
+    def post_done(self, page, post, media, record=None):
+        date = getattr(post, 'date', None)
+        with self._lock:
+            self.posts[str(post.id)] = {'date': str(date),
+                                        'commentscount': getattr(post, 'commentscount', 0),
+                                        'record': record,
+                                        'media': media}
+            if date and (self._newest is None or date > self._newest):
+                self._newest = date
+            self._outstanding[page] -= 1
+        self._advance()
+
+    def post_failed(self, page):
+        with self._lock:
+            self.failed = True
+
+    def finish(self):
+        """Moves the checkpoint forward if every post was written."""
+        if not self.failed:
+            if self._newest and (self.checkpoint is None or self._newest > self.checkpoint):
+                self.checkpoint = self._newest
+            self.resume_page = None
+        self.save()
+
+    def _advance(self):
+        # the resume point is the last page with nothing outstanding below it
+        advanced = False
+        with self._lock:
+            while self._outstanding.get(self._next_page) == 0:
+                del self._outstanding[self._next_page]
+                self.resume_page = self._next_page
+                self._next_page += 1
+                advanced = True
+        if advanced:
+            self.save()
+
+
+class PostJob(object):
+    """Counts down the files of a post and reports it to the manifest."""
+    def __init__(self, manifest, page, post, files):
+        self.manifest = manifest
+        self.page = page
+        self.post = post
+        self.media = [None] * (files - 1)
+        # the size (and CRC-32) of the post's JSON, once written
+        self.record = None
+        self.remaining = files
+        self.failed = False
+        self._lock = threading.Lock()
+
+    def done(self, index=None, record=None):
+        with self._lock:
+            if index is not None:
+                self.media[index] = record
+            self.remaining -= 1
+            finished = self.remaining == 0
+        if finished:
+            if self.failed:
+                self.manifest.post_failed(self.page)
+            else:
+                self.manifest.post_done(self.page, self.post, self.media, self.record)
+
+    def fail(self):
+        # reported now: if the post itself failed, its media were never
+        # submitted and the count won't reach 0
+        self.failed = True
+        self.manifest.post_failed(self.page)
+        self.done()
+
+
+class BackupEngine(object):
+    """
+    Writes the sites of an account to disk.
+
+    "page_workers" - Pages of posts requested at the same time.
+    "json_workers" - Threads serializing and writing post files.
+    "media_workers" - Concurrent media downloads.
+    "incremental" - Skip posts the site's manifest shows as unchanged and
+        stop at posts older than the last completed run. A killed run is
+        resumed either way.
+    "blob_store" - A BlobStore to keep media in; the files in the site
+        folders are then links to it.
+    "format" - 'folder' saves each post to its own JSON file, 'pack'
+        appends them to the site's pack, see posterous.pack.
+    """
+    def __init__(self, api, folder, batch_size=50, site_id=None,
+                 page_workers=4, json_workers=2, media_workers=8,
+                 incremental=True, blob_store=None, format='folder'):
+        self.api = api
+        self.folder = folder
+        self.batch_size = batch_size
+        self.site_id = site_id
+        self.page_workers = page_workers
+        self.json_workers = json_workers
+        self.media_workers = media_workers
+        self.incremental = incremental
+        self.blob_store = blob_store
+        if format not in ('folder', 'pack'):
+            raise ValueError('Unknown backup format {0}'.format(format))
+        self.format = format
+        self.stats = BackupStats()
+
+    def run(self):
+        """Backs up every site (or just site_id) and returns the stats."""
+        self.page_pool = BoundedExecutor(self.page_workers, self.page_workers,
+                                         'backup-page')
+        self.json_pool = BoundedExecutor(self.json_workers, None, 'backup-json')
+        self.media_pool = BoundedExecutor(self.media_workers, None, 'backup-media')
+        self.packs = []
+        manifests = []
+        try:
+            for site in self.api.get_sites():
+                if self.site_id and self.site_id != site.id:
+                    continue
+                manifests.append(self.backup_site(site))
+        finally:
+            self.page_pool.shutdown()
+            self.json_pool.shutdown()
+            self.media_pool.shutdown()
+            for pack in self.packs:
+                pack.close()
+            self.stats.finished = time.monotonic()
+        for manifest in manifests:
+            manifest.finish()
+        if self.blob_store is not None:
+            self.blob_store.save_index()
+        return self.stats
+
+    def backup_site(self, site):
+        site_folder = os.path.join(self.folder, site.hostname)
+        logging.info("Creating folder '%s' for site '%s'" % (site_folder, site.id))
+        if not os.path.exists(site_folder):
+            os.makedirs(site_folder)
+
+        # create a private folder in case they have private posts
+        private_folder = os.path.join(site_folder, "private")
+        if not os.path.exists(private_folder):
+            os.mkdir(private_folder)
+
+        site_file = os.path.join(site_folder, 'site-%s.json' % site.hostname)
+        self.json_pool.submit(self._task, None, self.write_json, site, site_file)
+
+        pack = None
+        if self.format == 'pack':
+            pack = PackWriter(pack_path(site_folder))
+            self.packs.append(pack)
+
+        manifest = Manifest.load(os.path.join(site_folder,
+                                              'manifest-%s.json' % site.hostname))
+        # a killed run starts over at the last page it completed
+        start = manifest.resume_page or 1
+        manifest.start(start)
+        for page, posts in self.fetch_pages(site, start):
+            manifest.start_page(page, len(posts))
+            older = False
+            for post in posts:
+                older = older or (self.incremental and manifest.is_older(post))
+                if self.incremental and manifest.is_current(post, site_folder, pack):
+                    logging.debug("Skipping unchanged post '%s'" % post.title)
+                    entry = manifest.posts[str(post.id)]
+                    manifest.post_done(page, post, entry['media'], entry.get('record'))
+                    continue
+                job = PostJob(manifest, page, post, 1 + len(getattr(post, 'media', [])))
+                self.json_pool.submit(self._task, job, self.backup_post, job,
+                                      site_folder, pack)
+            if older:
+                # everything past this page was backed up by an earlier run
+                break
+        self.stats.add(sites=1)
+        return manifest
+
+    def fetch_pages(self, site, start=1):
+        """
+        Yields (page number, posts) in order. Up to page_workers pages are
+        requested ahead; requesting stops once a page comes back short.
+        """
+        pending = {}
+        next_page = start
+        page = start
+        try:
+            while True:
+                while len(pending) < self.page_workers:
+                    pending[next_page] = self.page_pool.submit(
+                        self.api.read_posts, site.id, page=next_page,
+                        num_posts=self.batch_size)
+                    next_page += 1
+
+                logging.info("Retrieving page %s with %s posts per page" %
+                             (page, self.batch_size))
+                posts = pending.pop(page).result()
+                self.stats.add(pages=1)
+                yield page, posts
+                if len(posts) < self.batch_size:
+                    return
+                page += 1
+        finally:
+            # pages past the last one are of no use
+            for future in pending.values():
+                future.cancel()
+
+    def backup_post(self, job, site_folder, pack=None):
+        post = job.post
+        slug = post_slug(post)
+        if pack is None:
+            post_file = os.path.join(site_folder, '%s.json' % slug)
+            logging.debug("Opening file '%s' for post '%s'" % (post_file, post.title))
+            self.write_json(post, post_file)
+            job.record = {'size': os.path.getsize(post_file)}
+        else:
+            logging.debug("Packing post '%s'" % post.title)
+            payload = encode_json(post)
+            pack.add(post.id, getattr(post, 'date', None), payload)
+            job.record = {'size': len(payload), 'crc32': zlib.crc32(payload)}
+        self.stats.add(posts=1)
+        job.done()
+
+        # save the media from each post
+        for i, m in enumerate(getattr(post, 'media', [])):
+            u = media_url(m)
+            media_type = re.search(r'\.(\w+)$', u).group(1)
+            media_file = os.path.join(site_folder, '%s_%s.%s' % (slug, i, media_type))
+            self.media_pool.submit(self._task, job, self.save_media, job, i, m,
+                                   u, media_file)
+
+    def save_media(self, job, index, media, url, path):
+        checksum = self.download_media(job.post, media, path)
+        size = os.path.getsize(path)
+        self.stats.add(media=1, bytes=size)
+        job.done(index, {'file': os.path.basename(path), 'url': url,
+                         'size': size, 'sha1': checksum})
+
+    def write_json(self, obj, path):
+        with open(path, 'w+') as f:
+            json.dump(obj, f, cls=JsonDateEncoder)
+
+    def download_media(self, post, media, path):
+        """Downloads the media to path and returns the SHA-1 of the content."""
+        logging.debug("Getting media for post '%s' from url '%s'" %
+                      (post.title, media_url(media)))
+        # same source as media_url, resuming what a killed run left behind
+        if self.blob_store is not None:
+            return self.blob_store.fetch(media, path, prefer=('medium', 'url'))
+        checksum = hashlib.sha1()
+        media.download(path, prefer=('medium', 'url'), hasher=checksum)
+        return checksum.hexdigest()
+
+    def _task(self, job, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            subject = args[-1] if job is None else 'post {0}'.format(job.post.id)
+            self.stats.error('{0} failed for {1}: {2}'.format(fn.__name__, subject, e))
+            if job is not None:
+                job.fail()
@@ -0,0 +1,101 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+"""
+Sends many API calls concurrently.
+
+    with api.batch(max_workers=8) as batch:
+        for hostname in hostnames:
+            api.get_site(hostname=hostname)
+    sites = batch.results()
+
+Inside the with block the bound methods of the api return a Future instead
+of blocking. The calls are sent when the block exits, at most max_workers
+at a time, over the api's shared connections (and rate limiter, if any).
+If the block raises, nothing is sent and the calls are cancelled.
+"""
+
+
+class Batch(object):
+    def __init__(self, api, max_workers=8):
+        self.api = api
+        self.max_workers = max_workers
+        self.calls = []
+        self.futures = []
+        self.sent = False
+        self._previous = None
+
+    def __enter__(self):
+        local = self.api._local
+        self._previous = getattr(local, 'batch', None)
+        local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.api._local.batch = self._previous
+        if exc_type is None:
+            self.send()
+        else:
+            for future in self.futures:
+                future.cancel()
+
+    def submit(self, api_method, args, kwargs):
+        """Queues a call of the APIMethod class and returns its Future."""
+        if self.sent:
+            raise Exception('The batch has already been sent')
+        from concurrent.futures import Future
+        future = Future()
+        self.calls.append((api_method, args, kwargs))
+        self.futures.append(future)
+        return future
+
+    def send(self):
+        """Sends the queued calls and waits for all of them to finish."""
+        if self.sent:
+            return
+        self.sent = True
+        if not self.calls:
+            return
+        workers = min(self.max_workers, len(self.calls))
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(workers, thread_name_prefix='posterous-batch') as pool:
+            for call, future in zip(self.calls, self.futures):
+                pool.submit(self._run, call, future)
+
+    def results(self):
+        """
+        Results in submission order, None for the calls that failed or were
+        cancelled.
+        """
+        return [None if f.cancelled() or f.exception() else f.result()
+                for f in self.futures]
+
+    @property
+    def errors(self):
+        """
+        (index, exception) of each call that failed. The calls cancelled
+        because the with block raised have a CancelledError.
+        """
+        errors = []
+        for i, future in enumerate(self.futures):
+            if future.cancelled():
+                from concurrent.futures import CancelledError
+                errors.append((i, CancelledError()))
+            elif future.exception() is not None:
+                errors.append((i, future.exception()))
+        return errors
+
+    def _run(self, call, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        api_method, args, kwargs = call
+        try:
+            future.set_result(api_method(self.api, args, kwargs).execute())
+        except Exception as e:
+            future.set_exception(e)
@@ -1,6 +1,429 @@
+from base64 import b64encode
+from datetime import datetime
+import re
+import threading
+import time
+import urllib.parse
+
+from posterous.parsers import content_format
+from posterous.utils import enc_utf8_str
+
+
+# Accept header sent for each response format
+ACCEPT = {'xml': 'text/xml, application/xml',
+          'json': 'application/json'}
+
+# Parameter type of the values uploaded as files, named so that
+# posterous.multipart is only imported once files are sent
+FILE = 'file'
+
+
+class TokenBucket(object):
+    """
+    Allows "rate" requests per second with bursts of up to "capacity".
+    Requests reserve a token right away and are told how long to wait for
+    it, so callers are served in the order they arrive.
+    """
+    def __init__(self, rate, capacity=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns the seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def slow_down(self, factor, min_rate):
+        with self._lock:
+            self.rate = max(min_rate, self.rate * factor)
+
+    def speed_up(self, step):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + step)
+
+
+class RateLimiter(object):
+    """
+    Schedules the calls of one or more PostyAPI instances so they stay
+    within the quota of the Posterous account.
+
+    Each call takes a token from the bucket of its account and, if a rate
+    was set for it, from the bucket of its method. Throttling (429) and
+    server errors (5xx) halve the rates and the number of calls allowed in
+    flight; successful calls raise them again step by step. Other failures,
+    like connection errors or a rejected request, leave them alone. GET
+    calls that got a 429 or 5xx, or couldn't be sent, are retried up to
+    "retries" times after an exponential backoff with full jitter, honoring
+    Retry-After.
+
+    "rate" - Requests per second allowed per account.
+    "burst" - Requests an idle account may send at once.
+    "method_rates" - Requests per second for single methods, keyed on
+        their path, e.g. {'/users/{user_id}/sites/{site_id}/posts': 2}.
+    "max_in_flight" - Concurrent calls allowed before any throttling.
+    "backoff_interval" - Seconds during which further failures don't slow
+        down the calls again, so that a burst of concurrent failures counts
+        as one.
+    """
+    throttle_statuses = (429, 503)
+
+    def __init__(self, rate=10.0, burst=None, method_rates=None,
+                 max_in_flight=16, retries=3, base_delay=0.5, max_delay=30.0,
+                 min_rate=0.1, backoff_interval=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.method_rates = method_rates or {}
+        self.max_in_flight = max_in_flight
+        self.limit = max_in_flight
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_rate = min_rate
+        self.backoff_interval = backoff_interval
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.throttled = 0
+        self.retried = 0
+        self._buckets = {}
+        self._successes = 0
+        self._last_backoff = None
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+        # futures of coroutines waiting in acquire_async
+        self._waiters = []
+
+    def buckets(self, method):
+        """The account and method buckets a call draws from."""
+        account = method.api.username or id(method.api)
+        keys = [('account', account)]
+        if method.path in self.method_rates:
+            keys.append(('method', method.path))
+        with self._lock:
+            buckets = []
+            for key in keys:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    rate = self.rate if key[0] == 'account' else self.method_rates[key[1]]
+                    bucket = self._buckets[key] = TokenBucket(rate, self.burst)
+                buckets.append(bucket)
+            return buckets
+
+    def current_rate(self, account=None):
+        """The requests per second currently allowed for an account."""
+        bucket = self._buckets.get(('account', account))
+        if bucket is None:
+            return self.rate
+        return bucket.rate
+
+    def acquire(self, method):
+        """Waits until the call may be sent."""
+        with self._lock:
+            self.queue_depth += 1
+        try:
+            delay = max(bucket.reserve() for bucket in self.buckets(method))
+            if delay:
+                time.sleep(delay)
+            with self._slots:
+                while self.in_flight >= self.limit:
+                    self._slots.wait()
+                self.in_flight += 1
+        finally:
+            with self._lock:
+                self.queue_depth -= 1
+
+    async def acquire_async(self, method):
+        """Coroutine version of acquire, see posterous.aio."""
+        import asyncio
+
+        with self._lock:
+            self.queue_depth += 1
+        try:
+            delay = max(bucket.reserve() for bucket in self.buckets(method))
+            if delay:
+                await asyncio.sleep(delay)
+            while True:
+                with self._lock:
+                    if self.in_flight < self.limit:
+                        self.in_flight += 1
+                        return
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters.append(waiter)
+                # woken by release(), then try again like the threads do
+                await waiter
+        finally:
+            with self._lock:
+                self.queue_depth -= 1
+
+    def release(self, method, status):
+        """Records the outcome of a call; status is None if it wasn't sent."""
+        throttled = status is not None and (status in self.throttle_statuses or
+                                            status >= 500)
+        failed = status is None or status >= 400
+        buckets = self.buckets(method)
+        back_off = False
+        with self._slots:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self._successes = 0
+                now = time.monotonic()
+                if (self._last_backoff is None or
+                        now - self._last_backoff >= self.backoff_interval):
+                    self._last_backoff = now
+                    back_off = True
+                    self.limit = max(1, self.limit // 2)
+            elif not failed:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_in_flight:
+                    self._successes = 0
+                    self.limit += 1
+            self._slots.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            try:
+                waiter.get_loop().call_soon_threadsafe(wake, waiter)
+            except RuntimeError:
+                # its event loop is closed, nobody waits any more
+                pass
+        for bucket in buckets:
+            if back_off:
+                bucket.slow_down(0.5, self.min_rate)
+            elif not failed:
+                bucket.speed_up(bucket.max_rate / 10.0)
+
+    def should_retry(self, method, status, attempt):
+        if method.method != 'GET' or attempt >= self.retries:
+            return False
+        return status is None or status in self.throttle_statuses or status >= 500
+
+    def retry_delay(self, attempt, retry_after=None):
+        self.retried += 1
+        try:
+            return min(self.max_delay, float(retry_after))
+        except (TypeError, ValueError):
+            import random
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def stats(self):
+        return {'rate': dict((key[1], bucket.rate)
+                             for key, bucket in self._buckets.items()),
+                'in_flight': self.in_flight,
+                'limit': self.limit,
+                'queue_depth': self.queue_depth,
+                'throttled': self.throttled,
+                'retried': self.retried}
+
+
+def wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def encode_value(value):
+    """Casts a parameter value and utf-8 encodes it."""
+    if isinstance(value, bool):
+        value = int(value)
+    elif isinstance(value, datetime):
+        value = '{0} +0000'.format(value.strftime('%a, %d %b %Y %H:%M:%S').split('.')[0])
+    return enc_utf8_str(value)
+
+
+# query values that urlencode would leave as they are
+SAFE_QUERY_VALUE = re.compile(r'[\w.~-]*$', re.ASCII)
+
+
+def encode_query(parameters):
+    """
+    Same output as urllib.parse.urlencode for (name, value) pairs, but
+    only quotes the names and values that need it.
+    """
+    parts = []
+    for name, value in parameters:
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        elif not isinstance(value, str):
+            value = str(value)
+        if not SAFE_QUERY_VALUE.match(value):
+            value = urllib.parse.quote_plus(value)
+        if not SAFE_QUERY_VALUE.match(name):
+            name = urllib.parse.quote_plus(name)
+        parts.append(name + '=' + value)
+    return '&'.join(parts)
+
+
+class CallPlan(object):
+    """
+    The part of an API call that is the same every time, worked out once
+    per endpoint by bind_method: where each argument goes, how it's checked
+    and encoded, and which parameters fill in the placeholders of the path
+    (these are left out of the query string).
+    """
+    placeholder = re.compile(r'{(\w+)}')
+    # path values that don't need quoting
+    safe_value = re.compile(r'[\w.-]+$', re.ASCII)
+    # values for placeholders the caller didn't supply
+    defaults = {'user_id': 'me'}
+
+    def __init__(self, path, parameters):
+        self.path = path
+        self.names = tuple(name for name, p_type in parameters)
+        self.positions = dict((name, i) for i, name in enumerate(self.names))
+        self.path_names = tuple(self.placeholder.findall(path))
+        missing = [name for name in self.path_names
+                   if name not in self.positions and name not in self.defaults]
+        if missing:
+            raise Exception('No parameter for {0} in {1}'.format(', '.join(missing), path))
+        # literal text and placeholder names, alternately
+        self.pieces = self.placeholder.split(path)
+        # the path of a call that supplies none of the placeholders
+        self.default_path = None
+        if all(name in self.defaults for name in self.path_names):
+            self.default_path = self.fill_path({})
+        # whether any parameter takes files
+        self.files = False
+        self.params = []
+        for name, p_type in parameters:
+            if not isinstance(p_type, tuple):
+                p_type = (p_type,)
+            if FILE in p_type:
+                self.files = True
+                check = self.deferred(self.file_validator, name, p_type)
+                encode = self.deferred(self.file_encoder, name, p_type)
+            else:
+                check = self.validator(name, p_type)
+                encode = self.encoder(name, p_type)
+            self.params.append((name, check, encode, name in self.path_names))
+
+    def deferred(self, make, name, p_type):
+        """Returns a function made by make(name, p_type) when first called."""
+        made = []
+
+        def call(*args):
+            if not made:
+                made.append(make(name, p_type))
+            return made[0](*args)
+        return call
+
+    def file_validator(self, name, p_type):
+        from posterous.multipart import FILE_TYPES
+        return self.validator(name, FILE_TYPES + tuple(t for t in p_type if t != FILE))
+
+    def file_encoder(self, name, p_type):
+        """Returns a function adding files as they are, see posterous.multipart."""
+        from posterous.multipart import Upload
+        list_name = '{0}[]'.format(name)
+
+        def encode(value, parameters):
+            if isinstance(value, list):
+                for val in value:
+                    parameters.append((list_name, val if isinstance(val, Upload)
+                                       else Upload(val)))
+            else:
+                parameters.append((name, value if isinstance(value, Upload)
+                                   else Upload(value)))
+        return encode
+
+    def validator(self, name, p_type):
+        """Returns a function raising TypeError for invalid values."""
+        if list not in p_type:
+            def check(value):
+                if not isinstance(value, p_type):
+                    raise TypeError('The value passed for parameter {0} is not valid! It must be one of these: {1}'.format(name, p_type))
+            return check
+
+        def check(value):
+            if not isinstance(value, p_type):
+                raise TypeError('The value passed for parameter {0} is not valid! It must be one of these: {1}'.format(name, p_type))
+            if isinstance(value, list):
+                for val in value:
+                    if isinstance(val, list) or not isinstance(val, p_type):
+                        raise TypeError('A value passed for parameter {0} is not valid. It must be one of these: {1}'.format(name, p_type))
+        return check
+
+    def encoder(self, name, p_type):
+        """Returns a function adding a value to the query parameters."""
+        if p_type == (str,):
+            return lambda value, parameters: parameters.append((name, value))
+        if p_type == (int,):
+            # bools are ints too
+            return lambda value, parameters: parameters.append((name, str(int(value))))
+
+        list_name = '{0}[]'.format(name)
+        def encode(value, parameters):
+            if isinstance(value, list):
+                for val in value:
+                    parameters.append((list_name, enc_utf8_str(val)))
+            else:
+                parameters.append((name, encode_value(value)))
+        return encode
+
+    def bind(self, args, kwargs):
+        """Returns the (path, parameters) for a call."""
+        if not args and not kwargs and self.default_path is not None:
+            return self.default_path, []
+        if len(args) > len(self.names):
+            raise TypeError('Takes at most {0} arguments ({1} given)'.format(
+                len(self.names), len(args)))
+        values = dict(zip(self.names, args))
+        for name, value in kwargs.items():
+            if name not in self.positions:
+                raise TypeError('Unexpected parameter {0}!'.format(name))
+            if values.get(name):
+                raise TypeError('Multiple values for parameter {0} supplied!'.format(name))
+            values[name] = value
+
+        parameters = []
+        path_values = {}
+        for name, check, encode, in_path in self.params:
+            value = values.get(name)
+            # values that are empty or false are left out
+            if not value:
+                continue
+            check(value)
+            if in_path:
+                path_values[name] = value
+            else:
+                encode(value, parameters)
+
+        if not path_values and self.default_path is not None:
+            return self.default_path, parameters
+        return self.fill_path(path_values), parameters
+
+    def fill_path(self, values):
+        pieces = list(self.pieces)
+        for i in range(1, len(pieces), 2):
+            name = pieces[i]
+            if name in values:
+                value = values[name]
+                if not isinstance(value, str):
+                    value = encode_value(value)
+                    if isinstance(value, bytes):
+                        value = value.decode('utf-8')
+                if not self.safe_value.match(value):
+                    value = urllib.parse.quote(value, safe='')
+            else:
+                try:
+                    value = self.defaults[name]
+                except KeyError:
+                    raise TypeError('Missing parameter {0}!'.format(name))
+            pieces[i] = value
+        return ''.join(pieces)
+
+
 def bind_method(**options):
-    
-    
+
+
     class APIMethod(object):
         # Required arguments
         path = options['path']
@@ -9,13 +432,32 @@ def bind_method(**options):
         response_type = options.get('response_type', None)
         auth_type = options.get('auth_type', None)
         allowed_params = options.get('parameters', [])
-        
+        # Seconds a GET response may be served from api.cache, None if never
+        cache_ttl = options.get('cache_ttl', None)
+        # Response types ending in '_list' are parsed into a list of models
+        payload_list = bool(response_type) and response_type.endswith('_list')
+        payload_type = response_type[:-5] if payload_list else response_type
+        if payload_type == 'ok_code':
+            # nothing to parse, the call returns the HTTP status
+            payload_type = None
+        format = 'xml'
+        plan = CallPlan(path, allowed_params)
+
         def __init__(self, api, args, kwargs):
             self.api = api
-            self.headers = kwargs['headers']
-            _check_authentication(api, auth_type)
-            _check_params(args, kwargs)
-            
+            self.format = api.format
+            self.headers = kwargs.pop('headers', {})
+            # Parse list payloads lazily, yielding models as they arrive
+            self.iterator = kwargs.pop('iterator', False) and self.payload_list
+            # called with (bytes sent, total) while files are uploaded
+            self.progress = kwargs.pop('progress', None)
+            self.url_path, self.parameters = self.plan.bind(args, kwargs)
+            self._check_authentication(api, self.auth_type)
+            self.cache_entry = None
+            self.token_refreshed = False
+            # measurements of this call, see posterous.metrics
+            self.timings = {}
+
         def _check_authentication(self, api, auth_type):
             if auth_type == None:
                 pass
@@ -24,105 +466,251 @@ def bind_method(**options):
                     raise Exception("You must suppy a username and password!")
                 else:
                     creds = '{0}:{1}'.format(self.api.username, self.api.password)
-                    auth = b64encode(creds.encode('latin-1'))
-                    self.headers['Authorization'] = 'Basic %s'.format(auth)
-            elif api_type = 'token':
-                if api.api_token:
-                    self.parameters['api_token'] = api.api_token
-                elif not api.api_token and (self.api.username and self.api.password):
-                    api.auth_token = api.get_api_token()
-                else:
-                    raise Exception("You must suppy a username and password!")
+                    auth = b64encode(creds.encode('latin-1')).decode('ascii')
+                    self.headers['Authorization'] = 'Basic {0}'.format(auth)
+            elif auth_type == 'token':
+                # fetched once and shared, see posterous.auth.TokenManager
+                self.api_token = api.tokens.get(api)
+                self.parameters.append(('api_token', self.api_token))
             else:
                 raise Exception("Not a valid authentication type.")
-                
-        def _build_parameters(self, args, kwargs):
-            self.parameters = []
-            
-            args = list(args)
-            args.reverse()
-
-            for name, p_type in self.allowed_params:
-                value = None
-                if args:
-                    value = args.pop()
-
-                if name in kwargs:
-                    if not value:
-                        value = kwargs.pop(name)
-                    else:
-                        raise TypeError('Multiple values for parameter {0} supplied!'.format(name))
-                if not value:
-                    continue
-
-                if not isinstance(p_type, tuple):
-                    p_type = (p_type,)
-
-                self._check_type(value, p_type, name)
-                self._set_param(name, value)
-            
-        def _check_type(self, value, p_type, name):
-            """
-            Throws a TypeError exception if the value type is not in the p_type tuple.
-            """
-            if not isinstance(value, p_type):
-                raise TypeError('The value passed for parameter {0} is not valid! It must be one of these: {1}'.format(name, p_type))
 
-            if isinstance(value, list):
-                for val in value:
-                    if isinstance(val, list) or not isinstance(val, p_type):
-                        raise TypeError('A value passed for parameter {0} is not valid. It must be one of these: {1}'.format(name, p_type))
-            
-        def _set_param(self, name, value):
-            """Do appropriate type casts and utf-8 encode the parameter values"""
-            if isinstance(value, bool):
-                value = int(value)
-            
-            elif isinstance(value, datetime):
-                value = '{0} +0000'.format(value.strftime('%a, %d %b %Y %H:%M:%S').split('.')[0])
-            
-            elif isinstance(value, list):
-                for val in value:
-                    self.parameters.append(('{0}[]'.format(name), enc_utf8_str(val)))
-                return
+        def can_refresh_token(self):
+            """True if a rejected token may be replaced for this call."""
+            return (self.auth_type == 'token' and not self.token_refreshed and
+                    bool(self.api.username and self.api.password))
 
-            self.parameters.append((name, enc_utf8_str(value)))
+        def refresh_token(self, token):
+            """Swaps the api_token parameter for a new token."""
+            self.token_refreshed = True
+            self.api_token = token
+            self.parameters = [(k, v) for k, v in self.parameters if k != 'api_token']
+            self.parameters.append(('api_token', token))
 
-        def execute(self):
+        def has_uploads(self):
+            if not self.plan.files:
+                return False
+            from posterous.multipart import Upload
+            return any(isinstance(value, Upload) for name, value in self.parameters)
+
+        def build_request(self):
+            """Returns the (method, url, body, headers) for this call."""
             # Build request URL
-            url = self.api_url + self.path
-
-            # Apply authentication if required
-            if self.auth_type = "basic":
-                auth = b64encode('{0}:{1}'.format(
-                        self.api.username, 
-                        self.api.password).encode('latin-1'))
-                self.headers['Authorization'] = 'Basic %s'.format(auth)
-            if self.auth_type = "token":
-                self.parameters['api_token'] = self.api.api_token
-                
+            url = self.api.host + self.api.api_root + self.url_path
+
             # Encode the parameters
             post_data = None
-            if self.method == 'POST':
-                post_data = urllib.parse.urlencode(self.parameters)
-            elif self.method == 'GET' and self.parameters:
-                url = '{0}?{1}'.format(url, urllib.parse.urlencode(self.parameters))
-            
-            # Make the request
+            if self.method == 'POST' and self.has_uploads():
+                # streamed by the transport, see posterous.multipart
+                from posterous.multipart import MultipartBody
+                post_data = MultipartBody(self.parameters, progress=self.progress)
+                self.headers['Content-Type'] = post_data.content_type
+                if post_data.length is not None:
+                    self.headers['Content-Length'] = str(post_data.length)
+            elif self.method == 'POST':
+                post_data = encode_query(self.parameters)
+                self.headers.setdefault('Content-Type',
+                                        'application/x-www-form-urlencoded')
+            elif self.parameters:
+                url = url + '?' + encode_query(self.parameters)
+            self.headers.setdefault('Accept', ACCEPT[self.format])
+
+            return self.method, url, post_data, self.headers
+
+        def cached_response(self, url):
+            """
+            Returns the cached body for url while it's fresh. An expired
+            entry is kept so the request can be made conditional.
+            """
+            cache = self.api.cache
+            if cache is None:
+                return None
+            if self.method != 'GET':
+                return None
+            if not self.cache_ttl or self.iterator:
+                return None
+
+            entry = cache.get(url)
+            if entry is None:
+                return None
+            if not entry.expired():
+                return entry.body
+
+            if entry.can_revalidate():
+                self.cache_entry = entry
+                if entry.etag:
+                    self.headers['If-None-Match'] = entry.etag
+                if entry.last_modified:
+                    self.headers['If-Modified-Since'] = entry.last_modified
+            return None
+
+        def parse_response(self, resp, url=None):
+            """Checks the response status and parses the body into models."""
+            cache = self.api.cache
+            if resp.status == 304 and self.cache_entry is not None:
+                # not modified, serve the revalidated copy
+                cache.refresh(url, self.cache_ttl)
+                return self.api.parser.parse(self, self.cache_entry.body)
+
+            if resp.status >= 400:
+                resp.close()
+                raise Exception('Failed to send request: HTTP Error {0}: {1}'.format(
+                        resp.status, resp.reason))
+
+            if cache is not None and url is not None and self.method != 'GET':
+                # the resource changed, drop what was read from it before
+                # the body is parsed, so a bad body can't leave it cached
+                cache.invalidate(url.split('?', 1)[0])
+            if self.payload_type is None:
+                resp.read()
+                return resp.status
+
+            # the server may not honour the Accept header
+            self.format = content_format(resp.getheader('Content-Type'), self.format)
+            if self.iterator:
+                # the parser reads the body from the response as it goes
+                return self.api.parser.parse(self, resp)
+            result = self.api.parser.parse(self, resp.read())
+
+            if (cache is not None and url is not None and self.method == 'GET'
+                    and self.cache_ttl):
+                cache.store(url, url.split('?', 1)[0], resp.body, self.cache_ttl,
+                            resp.getheader('ETag'), resp.getheader('Last-Modified'))
+            return result
+
+        def send(self, method, url, body, headers):
+            """
+            Makes the request over the api's pooled connections, scheduled
+            and retried by the api's rate limiter if it has one.
+            """
+            limiter = self.api.rate_limiter
+            attempt = 0
+            queued = time.perf_counter()
+            self.timings['queue'] = 0.0
+            while True:
+                if limiter is not None:
+                    limiter.acquire(self)
+                # the waits before each attempt, not the failed attempts
+                self.timings['queue'] += time.perf_counter() - queued
+                try:
+                    resp = self.api.transport.request(method, url, body, headers,
+                                                      stream=self.iterator)
+                except Exception as e:
+                    queued = time.perf_counter()
+                    if limiter is not None:
+                        limiter.release(self, None)
+                        if limiter.should_retry(self, None, attempt):
+                            time.sleep(limiter.retry_delay(attempt))
+                            attempt += 1
+                            continue
+                    # TODO: do better parsing of errors
+                    raise Exception('Failed to send request: {0}'.format(e))
+
+                queued = time.perf_counter()
+                if limiter is not None:
+                    limiter.release(self, resp.status)
+                    if limiter.should_retry(self, resp.status, attempt):
+                        resp.close()
+                        time.sleep(limiter.retry_delay(attempt,
+                                                       resp.getheader('Retry-After')))
+                        attempt += 1
+                        continue
+                return resp
+
+        def execute(self):
+            request = self.build_request()
+            inflight = self.api.inflight
             try:
-                request = urllib.request.Request(url, post_data, self.headers)
-                resp = urllib.request.urlopen(request)
-            except Exception as e:
-                # TODO: do better parsing of errors
-                raise Exception('Failed to send request: {0}'.format(e))
+                if inflight is not None and self.method == 'GET' and not self.iterator:
+                    # identical concurrent reads share a single request
+                    return self.coalesce(inflight, request)
+                return self.perform(request)
+            except Exception:
+                self.record(error=True)
+                raise
+
+        def coalesce(self, inflight, request):
+            """
+            Makes the request, or waits for the identical one in flight. The
+            callers that waited are recorded as coalesced, with their wait.
+            """
+            led = []
+
+            def lead():
+                led.append(True)
+                self.timings['coalesced'] = 0
+                return self.perform(request)
+
+            start = time.perf_counter()
+            try:
+                result = inflight.do(request[:2], self.api, lead)
+            finally:
+                if not led:
+                    self.timings['coalesced'] = 1
+                    self.timings['wait'] = time.perf_counter() - start
+            if not led:
+                self.record()
+            return result
+
+        def perform(self, request):
+            method, url, body, headers = request
+            cached = self.cached_response(url)
+            if cached is not None:
+                return self.finish(self.api.parser.parse(self, cached))
+
+            resp = self.send(method, url, body, headers)
+
+            if resp.status == 401 and self.can_refresh_token():
+                # the token expired or was revoked, get a new one and retry once
+                resp.close()
+                self.refresh_token(self.api.tokens.refresh(self.api, self.api_token))
+                return self.perform(self.build_request())
+
+            self.timings.update(resp.timings)
+            return self.finish(self.parse_response(resp, url))
+
+        def finish(self, result):
+            """
+            Records the call and returns its result. Iterator calls are
+            recorded once the caller has gone through the models.
+            """
+            if self.iterator and self.api.metrics is not None:
+                return self.record_iter(result)
+            self.record()
+            return result
+
+        def record_iter(self, items):
+            error = True
+            try:
+                for item in items:
+                    yield item
+                error = False
+            except GeneratorExit:
+                # the caller stopped early
+                error = False
+                raise
+            finally:
+                self.record(error=error)
+
+        def record(self, error=False):
+            """Hands the measurements of the call to the api's metrics."""
+            metrics = self.api.metrics
+            if metrics is not None:
+                self.timings['error'] = 1 if error else 0
+                metrics.record(self.path, self.timings)
 
-            return self.api.parser.parse(self, resp.read())
 
-    
     def _call(api, *args, **kwargs):
+        batch = getattr(api._local, 'batch', None)
+        if batch is not None:
+            # queued until the batch is sent, see posterous.batch
+            return batch.submit(APIMethod, args, kwargs)
         method = APIMethod(api, args, kwargs)
         return method.execute()
 
+    # Exposed so that other clients (see posterous.aio) can be generated
+    # from the same declarations.
+    _call.api_method = APIMethod
     return _call
 
-            
\ No newline at end of file
+
@@ -0,0 +1,176 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+from collections import OrderedDict
+import copy
+import threading
+import time
+
+
+class CacheEntry(object):
+    """A cached response body plus the validators needed to revalidate it."""
+    def __init__(self, path, body, ttl, etag=None, last_modified=None):
+        self.path = path
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = time.monotonic() + ttl
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def can_revalidate(self):
+        return bool(self.etag or self.last_modified)
+
+
+class MemoryCache(object):
+    """
+    In-memory LRU cache of response bodies for read methods.
+
+    Entries are keyed on the request URL (path plus encoded parameters) and
+    remember the URL path, so that a POST or DELETE to a path can drop every
+    entry at or below it.
+
+    "max_entries" - The maximum number of responses kept.
+    "max_bytes" - The maximum total size of the cached bodies.
+    """
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the entry for key, fresh or expired, or None. Callers check
+        entry.expired() and revalidate as needed.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if entry.expired():
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def store(self, key, path, body, ttl, etag=None, last_modified=None):
+        entry = CacheEntry(path, body, ttl, etag, last_modified)
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            while (len(self._entries) > self.max_entries or
+                   self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def refresh(self, key, ttl):
+        """Marks an entry fresh again after the server answered 304."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires = time.monotonic() + ttl
+                self.revalidations += 1
+
+    def invalidate(self, path):
+        """Removes the entries for path and everything below it."""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.path == path or entry.path.startswith(path + '/'):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+
+class _Flight(object):
+    def __init__(self, api):
+        self.api = api
+        self.followers = 0
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical concurrent reads. The first caller for a key makes
+    the request; callers arriving while it is in flight wait for it and
+    get the same result instead of sending their own.
+
+    Each caller receives its own copy of the parsed models, so they can be
+    changed freely. The copies share the api object of the caller.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, api, fn):
+        """Returns fn(), or a copy of the result of the call running for key."""
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(api)
+                leader = True
+            else:
+                flight.followers += 1
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result, {id(flight.api): api})
+
+        try:
+            result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        else:
+            flight.result = result
+        finally:
+            with self._lock:
+                del self._flights[key]
+                shared = flight.followers > 0
+            if shared and flight.error is None:
+                # keep a pristine copy for the followers, the caller may
+                # change its models as soon as it gets them
+                flight.result = copy.deepcopy(result, {id(api): api})
+            flight.done.set()
+        return result
@@ -0,0 +1,106 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import queue
+import threading
+
+
+class Cursor(object):
+    """
+    Iterates over a paginated API method page by page or item by item.
+
+        for post in Cursor(api.read_posts, site.id, per_page=50).items():
+            print(post.title)
+
+    Pages are requested until the server returns one with fewer than
+    per_page results, so a stale post count can't cut the iteration short.
+    While a page is being consumed the next ones are fetched in a background
+    thread, at most "prefetch" pages ahead (0 fetches on demand).
+    """
+    page_param = 'page'
+    per_page_param = 'num_posts'
+
+    def __init__(self, method, *args, **kwargs):
+        self.method = method
+        self.per_page = kwargs.pop('per_page', 50)
+        self.prefetch = kwargs.pop('prefetch', 1)
+        self.start_page = kwargs.pop('start_page', 1)
+        self.args = args
+        self.kwargs = kwargs
+
+    def fetch(self, page):
+        kwargs = dict(self.kwargs)
+        kwargs[self.page_param] = page
+        kwargs[self.per_page_param] = self.per_page
+        return self.method(*self.args, **kwargs)
+
+    def pages(self):
+        """Yields each page as a list of models."""
+        if self.prefetch > 0:
+            return self._prefetched_pages()
+        return self._pages()
+
+    def items(self):
+        """Yields the models of every page."""
+        for page in self.pages():
+            for item in page:
+                yield item
+
+    def __iter__(self):
+        return self.items()
+
+    def _pages(self):
+        page = self.start_page
+        while True:
+            results = self.fetch(page)
+            if results:
+                yield results
+            if len(results) < self.per_page:
+                return
+            page += 1
+
+    def _prefetched_pages(self):
+        pages = queue.Queue()
+        slots = threading.Semaphore(self.prefetch)
+        stop = threading.Event()
+
+        def produce():
+            page = self.start_page
+            try:
+                while True:
+                    # wait until fewer than prefetch pages are waiting
+                    slots.acquire()
+                    if stop.is_set():
+                        return
+                    results = self.fetch(page)
+                    if results:
+                        pages.put((results, None))
+                    if len(results) < self.per_page:
+                        break
+                    page += 1
+                pages.put((None, None))
+            except Exception as e:
+                pages.put((None, e))
+
+        worker = threading.Thread(target=produce, name='posterous-cursor')
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                results, error = pages.get()
+                if error is not None:
+                    raise error
+                if results is None:
+                    return
+                slots.release()
+                yield results
+        finally:
+            # let a producer blocked on a slot run to completion
+            stop.set()
+            slots.release()
@@ -0,0 +1,144 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+"""
+Per call measurements.
+
+    metrics = MetricsRegistry()
+    api = PostyAPI(username, password, metrics=metrics)
+    ...
+    print(metrics.summary()['/users/{user_id}/sites']['ttfb']['p99'])
+
+Every call records the following, in seconds unless noted, tagged with the
+path of its method:
+
+    queue - waiting for the rate limiter and retry backoffs, without the
+        time spent on the attempts that failed
+    connect - opening a new connection (absent when one was reused)
+    ttfb - from sending the request to reading the response headers
+    transfer - reading the response body
+    parse - parsing the XML into dicts
+    build - building the models from the dicts
+    request_bytes - size of the request line, headers and body
+    response_bytes - size of the response body
+    error - 1 if the call raised an exception, else 0; its mean is the
+        error rate
+    coalesced - for reads that can share a request (see SingleFlight), 1
+        if the call waited for an identical one instead of sending its own
+    wait - how long a coalesced call waited for the shared request
+
+Calls answered from the cache only record parse, build and error, coalesced
+calls only coalesced, wait and error. Calls made with iterator=True are
+recorded once the caller has gone through the models; their body is read
+while it is parsed, so its transfer is counted in parse.
+"""
+
+import math
+import threading
+
+
+class Histogram(object):
+    """
+    Streaming histogram with logarithmic buckets. Memory stays constant
+    and percentiles are accurate to within the bucket growth factor.
+    """
+    growth = 1.05
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.zeros = 0
+        self.buckets = {}
+        self._log_growth = math.log(self.growth)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += 1
+        else:
+            index = int(math.floor(math.log(value) / self._log_growth))
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """Returns the value below which q percent of the values fall."""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(math.ceil(self.count * q / 100.0)))
+        seen = self.zeros
+        if seen >= rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # the upper edge of the bucket, within the observed range
+                value = self.growth ** (index + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.mean,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99)}
+
+
+class MetricsRegistry(object):
+    """
+    Aggregates the measurements of API calls into a histogram per method
+    path and measurement, and passes each call's measurements on to the
+    subscribed callbacks.
+    """
+    def __init__(self):
+        self.listeners = []
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """callback(path, measurements) is called after every call."""
+        self.listeners.append(callback)
+
+    def record(self, path, measurements):
+        with self._lock:
+            for name, value in measurements.items():
+                key = (path, name)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.add(value)
+        for callback in self.listeners:
+            callback(path, measurements)
+
+    def histogram(self, path, name):
+        """The Histogram of one measurement of a method, or None."""
+        return self._histograms.get((path, name))
+
+    def summary(self):
+        """{path: {measurement: {count, mean, min, max, p50, p99}}}"""
+        with self._lock:
+            summary = {}
+            for (path, name), histogram in self._histograms.items():
+                summary.setdefault(path, {})[name] = histogram.as_dict()
+            return summary
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
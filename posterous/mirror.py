@@ -0,0 +1,473 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+"""
+A local copy of an account in SQLite, and an api that answers read calls
+from it instead of from Posterous.
+
+    mirror = Mirror('account.db')
+    mirror.sync(PostyAPI('username', 'password'))
+
+    api = MirrorAPI(mirror)
+    for site in api.get_sites():
+        posts = site.read_posts(tag='travel')
+    posts = api.search_posts('brunch')
+
+Every model is kept as the JSON of its attributes next to the columns it is
+queried by, so reads decode only the rows they return.
+"""
+
+import datetime
+import html
+import re
+import sqlite3
+import threading
+
+from posterous.cursor import Cursor
+from posterous.error import PosterousError
+from posterous.models import Model, Post, Site, Tag
+from posterous.utils import import_json_loads, import_simplejson
+
+json = import_simplejson()
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sites (
+    id INTEGER PRIMARY KEY,
+    hostname TEXT,
+    is_primary INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sites_hostname ON sites (hostname);
+
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    site_id INTEGER NOT NULL,
+    date INTEGER,
+    title TEXT,
+    body TEXT,
+    commentscount INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS posts_site_date ON posts (site_id, date, id);
+
+CREATE TABLE IF NOT EXISTS comments (
+    post_id INTEGER NOT NULL,
+    id INTEGER,
+    date INTEGER,
+    author TEXT,
+    body TEXT
+);
+CREATE INDEX IF NOT EXISTS comments_post ON comments (post_id);
+
+CREATE TABLE IF NOT EXISTS media (
+    post_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    type TEXT,
+    url TEXT,
+    filesize INTEGER,
+    PRIMARY KEY (post_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS tags (
+    site_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    count INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (site_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS post_tags (
+    post_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (post_id, name)
+);
+CREATE INDEX IF NOT EXISTS post_tags_name ON post_tags (name, post_id);
+
+-- how far the last sync of a site got, see Mirror.sync
+CREATE TABLE IF NOT EXISTS sync_state (
+    site_id INTEGER PRIMARY KEY,
+    resume_page INTEGER,
+    complete INTEGER NOT NULL
+);
+'''
+
+# the text of the posts, without their markup
+FTS_SCHEMA = 'CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(title, body)'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MARKUP = re.compile(r'<[^>]*>')
+
+
+def timestamp(date):
+    if date is None:
+        return None
+    return int((date - EPOCH).total_seconds())
+
+
+def plain_text(body):
+    return html.unescape(MARKUP.sub(' ', body or ''))
+
+
+def fts_query(words):
+    """Quotes each word as an FTS5 phrase, so none is read as syntax."""
+    return ' '.join('"{0}"'.format(word.replace('"', '""')) for word in words)
+
+
+def like_pattern(word):
+    """A LIKE pattern for the substring word, its wildcards escaped."""
+    for char in '\\%_':
+        word = word.replace(char, '\\' + char)
+    return '%{0}%'.format(word)
+
+
+def tag_name(tag):
+    """The name of a tag whether it's a Tag, a dict or a string."""
+    if isinstance(tag, str):
+        return tag
+    if isinstance(tag, dict):
+        return tag.get('name') or tag.get('tag_string')
+    return getattr(tag, 'name', None) or getattr(tag, 'tag_string', None)
+
+
+def encode_model(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat(' ')
+    if isinstance(obj, Model):
+        return dict((k, v) for k, v in vars(obj).items() if not k.startswith('_'))
+    raise TypeError('{0!r} can not be mirrored'.format(obj))
+
+
+def dumps(obj):
+    return json.dumps(obj, default=encode_model)
+
+
+class Mirror(object):
+    """
+    Keeps the sites, posts, comments, media and tags of an account in an
+    SQLite database, see sync(). Can be shared by threads.
+
+    "path" - The database file, or ':memory:'.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._loads = import_json_loads()
+        with self._lock:
+            if path != ':memory:':
+                # readers in other processes aren't blocked by a sync
+                self.db.execute('PRAGMA journal_mode=WAL')
+                self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(SCHEMA)
+            try:
+                self.db.execute(FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5, search falls back to LIKE
+                self.fts = False
+            self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    ## Syncing
+
+    def sync(self, api, site_id=None, full=False, per_page=50):
+        """
+        Copies the sites of the account behind api, or just site_id, and
+        returns the number of sites and posts saved.
+
+        Posts come newest first; unless "full" is set, a site is done at the
+        first page with no new or changed post (by date and comment count).
+        A full sync also drops the posts that are gone from the site.
+
+        The last page saved is recorded as it goes, so a sync that was
+        interrupted is finished by the next one, from that page to the last,
+        before the newest posts are read again.
+        """
+        counts = {'sites': 0, 'posts': 0, 'deleted': 0}
+        for site in api.get_sites():
+            if site_id and site.id != site_id:
+                continue
+            self.save_site(site)
+            known = self.post_versions(site.id)
+            seen = set()
+            resume_page, complete = self.sync_state(site.id)
+            if not full and not complete and resume_page:
+                counts['posts'] += self._sync_pages(api, site.id, resume_page, False,
+                                                    known, seen, per_page)
+                complete = True
+            counts['posts'] += self._sync_pages(api, site.id, 1, complete and not full,
+                                                known, seen, per_page)
+            if full:
+                gone = [post_id for post_id in known if post_id not in seen]
+                self.delete_posts(gone)
+                counts['deleted'] += len(gone)
+            if hasattr(api, 'get_tags'):
+                self.save_tags(site.id, api.get_tags(site.id))
+            counts['sites'] += 1
+        return counts
+
+    def _sync_pages(self, api, site_id, start, stop_early, known, seen, per_page):
+        """
+        Saves the new and changed posts from page "start" on and returns how
+        many there were. With "stop_early" it stops at the first page
+        without any.
+        """
+        saved = 0
+        pages = Cursor(api.read_posts, site_id, per_page=per_page, start_page=start)
+        for page, posts in enumerate(pages.pages(), start):
+            changed = []
+            for post in posts:
+                version = (timestamp(getattr(post, 'date', None)),
+                           getattr(post, 'commentscount', 0))
+                if known.get(post.id) != version:
+                    known[post.id] = version
+                    changed.append(post)
+            seen.update(post.id for post in posts)
+            self.save_posts(site_id, changed)
+            self.save_sync_state(site_id, page, False)
+            saved += len(changed)
+            if stop_early and not changed:
+                # the rest was mirrored by an earlier sync
+                break
+        self.save_sync_state(site_id, None, True)
+        return saved
+
+    def sync_state(self, site_id):
+        """
+        The (resume page, complete) of a site: the last page saved by a
+        sync that didn't finish, and whether the last sync did.
+        """
+        with self._lock:
+            row = self.db.execute('SELECT resume_page, complete FROM sync_state '
+                                  'WHERE site_id = ?', (site_id,)).fetchone()
+        if row is None:
+            return None, False
+        return row[0], bool(row[1])
+
+    def save_sync_state(self, site_id, resume_page, complete):
+        with self._lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                            (site_id, resume_page, int(complete)))
+
+    def post_versions(self, site_id):
+        """Maps the ids of the mirrored posts to their (date, comment count)."""
+        with self._lock:
+            rows = self.db.execute('SELECT id, date, commentscount FROM posts '
+                                   'WHERE site_id = ?', (site_id,)).fetchall()
+        return dict((post_id, (date, count)) for post_id, date, count in rows)
+
+    def save_site(self, site):
+        with self._lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO sites VALUES (?, ?, ?, ?)',
+                            (site.id, getattr(site, 'hostname', None),
+                             int(bool(getattr(site, 'primary', False))), dumps(site)))
+
+    def save_posts(self, site_id, posts):
+        if not posts:
+            return
+        rows, comments, media, tags, texts = [], [], [], [], []
+        for post in posts:
+            date = timestamp(getattr(post, 'date', None))
+            title = getattr(post, 'title', None)
+            body = getattr(post, 'body', None)
+            rows.append((post.id, site_id, date, title, body,
+                         getattr(post, 'commentscount', 0), dumps(post)))
+            for comment in getattr(post, 'comments', []):
+                comments.append((post.id, getattr(comment, 'id', None),
+                                 timestamp(getattr(comment, 'date', None)),
+                                 getattr(comment, 'author', None),
+                                 getattr(comment, 'body', None)))
+            for i, m in enumerate(getattr(post, 'media', [])):
+                media.append((post.id, i, getattr(m, 'type', None),
+                              getattr(m, 'medium_url', None) or getattr(m, 'url', None),
+                              getattr(m, 'medium_filesize', None) or getattr(m, 'filesize', None)))
+            for tag in getattr(post, 'tags', None) or []:
+                tags.append((post.id, tag_name(tag)))
+            texts.append((post.id, title or '', plain_text(body)))
+
+        ids = [(post.id,) for post in posts]
+        with self._lock, self.db:
+            self._delete_children(ids)
+            self.db.executemany('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.executemany('INSERT INTO comments VALUES (?, ?, ?, ?, ?)', comments)
+            self.db.executemany('INSERT INTO media VALUES (?, ?, ?, ?, ?)', media)
+            self.db.executemany('INSERT OR IGNORE INTO post_tags VALUES (?, ?)', tags)
+            if self.fts:
+                self.db.executemany('INSERT INTO posts_fts (rowid, title, body) '
+                                    'VALUES (?, ?, ?)', texts)
+
+    def delete_posts(self, post_ids):
+        ids = [(post_id,) for post_id in post_ids]
+        with self._lock, self.db:
+            self._delete_children(ids)
+            self.db.executemany('DELETE FROM posts WHERE id = ?', ids)
+
+    def _delete_children(self, ids):
+        for table in ('comments', 'media', 'post_tags'):
+            self.db.executemany('DELETE FROM {0} WHERE post_id = ?'.format(table), ids)
+        if self.fts:
+            self.db.executemany('DELETE FROM posts_fts WHERE rowid = ?', ids)
+
+    def save_tags(self, site_id, tags):
+        rows = [(site_id, tag_name(tag), getattr(tag, 'count', None), dumps(tag))
+                for tag in tags]
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM tags WHERE site_id = ?', (site_id,))
+            self.db.executemany('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)', rows)
+
+    ## Reading
+
+    def query(self, sql, args=()):
+        with self._lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def sites(self, api=None, hostname=None, primary=False):
+        sql = 'SELECT data FROM sites'
+        args = []
+        if hostname is not None:
+            sql += ' WHERE hostname = ?'
+            args.append(hostname)
+        elif primary:
+            sql += ' WHERE is_primary = 1'
+        rows = self.query(sql + ' ORDER BY is_primary DESC, id', args)
+        return [Site.parse_obj(api, self._loads(data)) for data, in rows]
+
+    def posts(self, site_id, api=None, page=None, num_posts=None, since_id=None,
+              tag=None, start=None, end=None):
+        """
+        A page of the posts of a site, newest first, optionally only those
+        with a tag, newer than since_id or dated from start up to end.
+        """
+        sql = 'SELECT p.data FROM posts p'
+        where = ['p.site_id = ?']
+        args = [site_id]
+        if tag:
+            sql += ' JOIN post_tags t ON t.post_id = p.id'
+            where.append('t.name = ?')
+            args.append(tag)
+        if since_id:
+            where.append('p.id > ?')
+            args.append(since_id)
+        if start is not None:
+            where.append('p.date >= ?')
+            args.append(timestamp(start))
+        if end is not None:
+            where.append('p.date < ?')
+            args.append(timestamp(end))
+        sql += ' WHERE {0} ORDER BY p.date DESC, p.id DESC'.format(' AND '.join(where))
+        if num_posts or page:
+            num_posts = num_posts or 10
+            sql += ' LIMIT ? OFFSET ?'
+            args.extend((num_posts, ((page or 1) - 1) * num_posts))
+        return [self.post(data, api) for data, in self.query(sql, args)]
+
+    def search(self, text, api=None, site_id=None, limit=50, raw=False):
+        """
+        The posts whose title or body contain every word of text, best
+        matches first. Punctuation is matched as in the text, so "e-mail"
+        finds the phrase e mail. With "raw" set, text is passed to FTS5 as
+        a query of its own syntax, e.g. 'brunch OR lunch'.
+        """
+        words = text.split()
+        if raw and not self.fts:
+            raise PosterousError('Raw queries need SQLite with FTS5')
+        if not words:
+            return []
+        if self.fts:
+            sql = ('SELECT p.data FROM posts_fts f JOIN posts p ON p.id = f.rowid '
+                   'WHERE posts_fts MATCH ?')
+            args = [text if raw else fts_query(words)]
+        else:
+            sql = 'SELECT p.data FROM posts p WHERE ' + ' AND '.join(
+                ["(p.title LIKE ? ESCAPE '\\' OR p.body LIKE ? ESCAPE '\\')"] * len(words))
+            args = [pattern for word in words for pattern in [like_pattern(word)] * 2]
+        if site_id:
+            sql += ' AND p.site_id = ?'
+            args.append(site_id)
+        sql += ' ORDER BY rank LIMIT ?' if self.fts else ' ORDER BY p.date DESC LIMIT ?'
+        args.append(limit)
+        return [self.post(data, api) for data, in self.query(sql, args)]
+
+    def tags(self, site_id, api=None):
+        rows = self.query('SELECT data FROM tags WHERE site_id = ? ORDER BY rowid',
+                          (site_id,))
+        return [Tag.parse_obj(api, self._loads(data)) for data, in rows]
+
+    def post(self, data, api=None):
+        """Turns the stored JSON of a post back into a Post."""
+        attrs = self._loads(data)
+        if attrs.get('date'):
+            attrs['date'] = datetime.datetime.fromisoformat(attrs['date'])
+        for comment in attrs.get('comments') or []:
+            if comment.get('date'):
+                comment['date'] = datetime.datetime.fromisoformat(comment['date'])
+        return Post.parse_obj(api, attrs)
+
+
+class MirrorAPI(object):
+    """
+    Takes the read calls of PostyAPI, with the same arguments, and answers
+    them from a Mirror. Other calls go to "api", the live PostyAPI, if one
+    is given. The models it returns are bound to it, so site.read_posts()
+    and site.tags() read from the mirror too.
+    """
+    def __init__(self, mirror, api=None):
+        self.mirror = mirror
+        self.api = api
+
+    def __getattr__(self, name):
+        api = self.__dict__.get('api')
+        if api is None or name.startswith('_'):
+            raise AttributeError('{0} is not answered by the mirror'.format(name))
+        return getattr(api, name)
+
+    def get_sites(self, user_id=None):
+        return self.mirror.sites(self)
+
+    def get_site(self, user_id=None, hostname=None):
+        sites = self.mirror.sites(self, hostname=hostname)
+        if not sites:
+            raise PosterousError('No site {0} in the mirror'.format(hostname), 404)
+        return sites[0]
+
+    def get_primary_site(self, user_id=None):
+        sites = self.mirror.sites(self, primary=True)
+        if not sites:
+            raise PosterousError('No primary site in the mirror', 404)
+        return sites[0]
+
+    def read_posts(self, site_id, user_id=None, page=None, num_posts=None,
+                   since_id=None, tag=None):
+        return self.mirror.posts(site_id, self, page=page, num_posts=num_posts or 10,
+                                 since_id=since_id, tag=tag)
+
+    def iter_posts(self, site_id, **kwargs):
+        kwargs.setdefault('prefetch', 0)
+        return Cursor(self.read_posts, site_id, **kwargs).items()
+
+    def get_tags(self, site_id, user_id=None):
+        return self.mirror.tags(site_id, self)
+
+    def posts_between(self, site_id, start=None, end=None):
+        """The posts dated from start up to but not including end, newest first."""
+        return self.mirror.posts(site_id, self, start=start, end=end)
+
+    def search_posts(self, text, site_id=None, limit=50, raw=False):
+        """Full text search of the titles and bodies of the mirrored posts."""
+        return self.mirror.search(text, self, site_id=site_id, limit=limit, raw=raw)
@@ -7,6 +7,10 @@
 #    the terms of the Apache License Version 2.0 available at 
 #    http://www.apache.org/licenses/LICENSE-2.0.txt 
 
+import os
+import urllib.parse
+
+from posterous.error import PosterousError
 from posterous.utils import parse_datetime
 
 
@@ -61,6 +65,9 @@ class Site(Model):
     def read_posts(self, **kwargs):
         return self._api.read_posts(self.id, **kwargs)
 
+    def iter_posts(self, **kwargs):
+        return self._api.iter_posts(self.id, **kwargs)
+
     def new_post(self, *args, **kwargs):
         return self._api.new_post(self.id, *args, **kwargs)
 
@@ -100,15 +107,135 @@ class Media(Model):
         for k, v in json.items():
             if k == 'medium':
                 Media.parse_obj(api, v, media)
-            elif k == 'thumb':
+            elif k == 'thumb' and isinstance(v, dict):
                 setattr(media, k, Media.parse_obj(api, v))
             else:
                 setattr(media, k, v)
         return media
 
-    def download(self):
-        # TODO: download file
-        pass
+    # (url attribute, size attribute) for each source a file can come from
+    sources = {'medium': ('medium_url', 'medium_filesize'),
+               'url': ('url', 'filesize'),
+               'mp4': ('mp4', None),
+               'flv': ('flv', None)}
+    default_preference = ('medium', 'url', 'mp4', 'flv')
+    # Posterous reports file sizes in kilobytes
+    filesize_unit = 1024
+
+    def best_source(self, prefer=None):
+        """Returns (url, filesize) of the first available preferred source."""
+        for name in prefer or self.default_preference:
+            url_attr, size_attr = self.sources[name]
+            url = getattr(self, url_attr, None)
+            if url:
+                return url, size_attr and getattr(self, size_attr, None)
+        raise PosterousError('Media has no downloadable url')
+
+    def download(self, path=None, prefer=None, chunk_size=64 * 1024,
+                 resume=True, hasher=None, progress=None):
+        """
+        Streams the file to disk and returns the path it was saved to.
+
+        "path" - A file name or an existing folder. Defaults to the name of
+            the file in the current folder.
+        "prefer" - Names of the sources to try in order, see sources.
+        "resume" - Continue a partial download left by an earlier attempt
+            with a Range request.
+        "hasher" - A hashlib object updated with the content.
+        "progress" - Called with (bytes saved, total bytes or None).
+
+        The data goes to path + '.part' in chunk_size pieces and is renamed
+        into place once its size has been checked.
+        """
+        url, filesize = self.best_source(prefer)
+        name = os.path.basename(urllib.parse.urlsplit(url).path)
+        if path is None:
+            path = name
+        elif os.path.isdir(path):
+            path = os.path.join(path, name)
+        part = path + '.part'
+        # the api of an AsyncPostyAPI model has a transport of coroutines
+        transport = (getattr(self._api, 'blocking_transport', None) or
+                     getattr(self._api, 'transport', None))
+        if transport is None:
+            from posterous.transport import HTTPTransport
+            transport = HTTPTransport()
+
+        offset = os.path.getsize(part) if resume and os.path.exists(part) else 0
+        resp, url = self._open(transport, url, offset)
+        if resp.status == 416 and offset:
+            # the partial file doesn't fit the remote one any more
+            resp.close()
+            os.remove(part)
+            offset = 0
+            resp, url = self._open(transport, url, offset)
+        try:
+            if resp.status == 206 and self._range_start(resp) == offset:
+                mode = 'ab'
+                if hasher is not None:
+                    self._hash_file(part, hasher, chunk_size)
+            elif resp.status == 200:
+                # the server ignored the range, start over
+                mode, offset = 'wb', 0
+            else:
+                raise PosterousError('Failed to download {0}: HTTP Error {1}: {2}'.format(
+                        url, resp.status, resp.reason), resp.status)
+
+            length = resp.getheader('Content-Length')
+            total = offset + int(length) if length is not None else None
+            done = offset
+            with open(part, mode) as f:
+                while True:
+                    chunk = resp.read(chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    done += len(chunk)
+                    if progress is not None:
+                        progress(done, total)
+        finally:
+            resp.close()
+
+        if total is not None and done != total:
+            raise PosterousError('Download of {0} stopped after {1} of {2} bytes'.format(
+                    url, done, total))
+        if filesize and abs(done - filesize * self.filesize_unit) > self.filesize_unit:
+            raise PosterousError('Downloaded {0} bytes from {1}, expected about {2}'.format(
+                    done, url, filesize * self.filesize_unit))
+        os.replace(part, path)
+        return path
+
+    def _open(self, transport, url, offset, redirects=5):
+        for i in range(redirects + 1):
+            headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+            resp = transport.request('GET', url, headers=headers, stream=True)
+            location = resp.getheader('Location')
+            if resp.status not in (301, 302, 303, 307, 308) or not location:
+                return resp, url
+            resp.close()
+            url = urllib.parse.urljoin(url, location)
+        raise PosterousError('Too many redirects for {0}'.format(url))
+
+    def _range_start(self, resp):
+        # Content-Range: bytes 100-199/200
+        content_range = resp.getheader('Content-Range', '')
+        try:
+            return int(content_range.split()[1].split('-')[0])
+        except (IndexError, ValueError):
+            return None
+
+    def _hash_file(self, path, hasher, chunk_size):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                hasher.update(chunk)
+
+
+class Token(Model):
+    @classmethod
+    def parse_obj(self, api, json):
+        return json['api_token']
 
 
 class JSONModel(Model):
@@ -126,6 +253,7 @@ class ModelFactory(object):
     comment = Comment
     tag = Tag
     media = Media
+    token = Token
     json = JSONModel
 
 """Used to cast response tags to the correct type"""
@@ -133,6 +261,6 @@ attribute_map = {
     ('id', 'views', 'count', 'filesize', 'height', 'width', 'commentscount', 
      'num_posts'): int,
     ('private', 'commentsenabled', 'primary'): lambda v: v.lower() == 'true',
-    ('date'): lambda v: parse_datetime(v)
+    ('date',): parse_datetime
 }
 
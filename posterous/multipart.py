@@ -0,0 +1,297 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+"""
+multipart/form-data request bodies whose files are streamed from disk
+instead of being read into memory.
+
+    video = Upload('/videos/holiday.mp4')
+    site.new_post(title='Holiday', media=[video],
+                  progress=lambda sent, total: print(sent, total))
+    print(video.digest)
+"""
+
+import io
+import mmap
+import os
+
+from posterous.error import PosterousError
+
+
+class Upload(object):
+    """
+    A file to send as part of a multipart body.
+
+    "source" - A file name, an open binary file or the content as bytes.
+        Files are sent from their current position to the end.
+    "filename" - The name given to the server, by default that of the file.
+    "content_type" - Guessed from the file name if not given.
+    "checksum" - Name of the hashlib algorithm computed while the file is
+        sent, the result is left on digest. None turns it off.
+    """
+    default_name = 'upload'
+
+    def __init__(self, source, filename=None, content_type=None, checksum='md5'):
+        self.source = source
+        self.checksum = checksum
+        # hexdigest of what was sent, once it has been
+        self.digest = None
+        self.start = 0
+        self.size = None
+
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.size = len(source)
+        elif isinstance(source, str):
+            self.size = os.path.getsize(source)
+        elif hasattr(source, 'read'):
+            self.size = self._remaining(source)
+        else:
+            raise TypeError('Can not upload a {0}'.format(type(source).__name__))
+
+        if filename is None:
+            name = source if isinstance(source, str) else getattr(source, 'name', None)
+            filename = os.path.basename(name) if isinstance(name, str) else self.default_name
+        self.filename = filename
+        if content_type is None:
+            import mimetypes
+            content_type = (mimetypes.guess_type(filename)[0] or
+                            'application/octet-stream')
+        self.content_type = content_type
+        self._sent = False
+
+    def _remaining(self, f):
+        """Bytes left in f after its position, or None if it can't tell."""
+        try:
+            self.start = f.tell()
+            size = os.fstat(f.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            try:
+                self.start = f.tell()
+                size = f.seek(0, io.SEEK_END)
+                f.seek(self.start)
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                # a pipe or socket, its size is known once it's been read
+                self.start = None
+                return None
+        return max(size - self.start, 0)
+
+    def open(self):
+        """Returns the file to read, positioned at the start of the upload."""
+        if isinstance(self.source, str):
+            return open(self.source, 'rb')
+        if self.start is None:
+            if self._sent:
+                raise PosterousError('{0} can not be read twice, it can only be '
+                                     'sent once'.format(self.filename))
+        else:
+            self.source.seek(self.start)
+        return self.source
+
+    def hasher(self):
+        if self.checksum is None:
+            return None
+        import hashlib
+        return hashlib.new(self.checksum)
+
+    def chunks(self, chunk_size):
+        """
+        Yields the content in chunk_size pieces. Regular files are mapped
+        into memory so the pieces are views of the page cache, not copies.
+        """
+        hasher = self.hasher()
+        if isinstance(self.source, (bytes, bytearray, memoryview)):
+            view = memoryview(self.source)
+            for offset in range(0, len(view), chunk_size):
+                chunk = view[offset:offset + chunk_size]
+                if hasher is not None:
+                    hasher.update(chunk)
+                yield chunk
+            self._finish(hasher)
+            return
+
+        f = self.open()
+        try:
+            mapped = self._map(f)
+            if mapped is not None:
+                try:
+                    view = memoryview(mapped)
+                    for offset in range(self.start, self.start + self.size, chunk_size):
+                        chunk = view[offset:min(offset + chunk_size, self.start + self.size)]
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        yield chunk
+                    del chunk, view
+                finally:
+                    self._unmap(mapped)
+            else:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    yield chunk
+        finally:
+            self._close(f)
+        self._finish(hasher)
+
+    def send_to(self, sock, chunk_size, progress=None):
+        """
+        Writes the content to a connected socket with sendfile(), so the
+        kernel copies it from the page cache. The checksum is computed from
+        a memory map of the same range, a chunk at a time.
+        """
+        if isinstance(self.source, (bytes, bytearray, memoryview)) or self.size is None:
+            return self._send_chunks(sock, chunk_size, progress)
+
+        hasher = self.hasher()
+        f = self.open()
+        mapped = self._map(f) if hasher is not None else None
+        if hasher is not None and mapped is None:
+            # not a regular file, hash what is read instead
+            self._close(f)
+            return self._send_chunks(sock, chunk_size, progress)
+        try:
+            end = self.start + self.size
+            for offset in range(self.start, end, chunk_size):
+                count = min(chunk_size, end - offset)
+                if mapped is not None:
+                    with memoryview(mapped)[offset:offset + count] as chunk:
+                        hasher.update(chunk)
+                sent = sock.sendfile(f, offset, count)
+                if sent != count:
+                    raise PosterousError('{0} changed while it was being sent'.format(
+                        self.filename))
+                if progress is not None:
+                    progress(count)
+        finally:
+            self._unmap(mapped)
+            self._close(f)
+        self._finish(hasher)
+
+    def _send_chunks(self, sock, chunk_size, progress):
+        for chunk in self.chunks(chunk_size):
+            sock.sendall(chunk)
+            if progress is not None:
+                progress(len(chunk))
+
+    def _map(self, f):
+        if not self.size:
+            return None
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            return None
+
+    def _unmap(self, mapped):
+        if mapped is None:
+            return
+        try:
+            mapped.close()
+        except BufferError:
+            # a chunk is still referenced, the map goes when it does
+            pass
+
+    def _close(self, f):
+        if f is not self.source:
+            f.close()
+
+    def _finish(self, hasher):
+        self._sent = True
+        if hasher is not None:
+            self.digest = hasher.hexdigest()
+
+
+# Values of a parameter that are sent as files, Upload wraps the others
+FILE_TYPES = (Upload, bytes, bytearray, io.IOBase)
+
+
+def quote_header(value):
+    return value.replace('\\', '\\\\').replace('"', '%22').replace(
+        '\r', '%0D').replace('\n', '%0A')
+
+
+def field_bytes(value):
+    """The content of a form field; bytes are sent as they are."""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    if not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+class MultipartBody(object):
+    """
+    A multipart/form-data request body made of (name, value) parameters,
+    where the Upload values are streamed and the others are form fields.
+
+    "progress" - Called with (bytes sent, total bytes or None) as it goes.
+
+    The transports send it with send_to() or by iterating over it; both can
+    be repeated to send the body again, except for uploads read from a pipe.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, parameters, boundary=None, progress=None, chunk_size=None):
+        self.boundary = boundary or os.urandom(16).hex()
+        self.progress = progress
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self.uploads = []
+        self.parts = []
+        pending = []
+        for name, value in parameters:
+            disposition = 'form-data; name="{0}"'.format(quote_header(name))
+            if isinstance(value, Upload):
+                upload = value
+                pending.append('--{0}\r\nContent-Disposition: {1}; filename="{2}"\r\n'
+                               'Content-Type: {3}\r\n\r\n'.format(
+                                   self.boundary, disposition,
+                                   quote_header(upload.filename),
+                                   upload.content_type).encode('utf-8'))
+                self.parts.append(b''.join(pending))
+                self.parts.append(upload)
+                self.uploads.append(upload)
+                pending = [b'\r\n']
+            else:
+                pending.append('--{0}\r\nContent-Disposition: {1}\r\n\r\n'.format(
+                    self.boundary, disposition).encode('utf-8'))
+                pending.append(field_bytes(value))
+                pending.append(b'\r\n')
+        pending.append('--{0}--\r\n'.format(self.boundary).encode('utf-8'))
+        self.parts.append(b''.join(pending))
+
+        self.content_type = 'multipart/form-data; boundary={0}'.format(self.boundary)
+        sizes = [len(part) if isinstance(part, bytes) else part.size
+                 for part in self.parts]
+        # None when an upload is read from a pipe, the body is then chunked
+        self.length = None if None in sizes else sum(sizes)
+
+    def __iter__(self):
+        sent = 0
+        for part in self.parts:
+            chunks = [part] if isinstance(part, bytes) else part.chunks(self.chunk_size)
+            for chunk in chunks:
+                yield chunk
+                sent += len(chunk)
+                if self.progress is not None:
+                    self.progress(sent, self.length)
+
+    def send_to(self, sock):
+        """Writes the body to a connected socket, see Upload.send_to."""
+        sent = [0]
+
+        def sent_bytes(count):
+            sent[0] += count
+            if self.progress is not None:
+                self.progress(sent[0], self.length)
+
+        for part in self.parts:
+            if isinstance(part, bytes):
+                sock.sendall(part)
+                sent_bytes(len(part))
+            else:
+                part.send_to(sock, self.chunk_size, sent_bytes)
@@ -0,0 +1,343 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+"""
+Packed backups: the posts of a site appended to a single file, with an
+index to find any of them by id or date without reading the others.
+
+    posts-{hostname}.pack
+        magic
+        record: payload length, crc32, post id, date | payload (post JSON)
+        record: ...
+    posts-{hostname}.pack.idx
+        magic, entry count, size of the pack it describes
+        entries sorted by post id: post id, date, record offset, length, crc32
+        entry numbers sorted by date, then id
+
+A post saved again is appended, the index points at its newest record.
+Records added after the index was last written (e.g. by a killed run) are
+found by reading the pack from where the index ends, and a record cut
+short by the kill is dropped.
+
+    with PackReader('backup/sachin/posts-sachin.pack') as pack:
+        post = pack.get(55)
+        for post in pack.between(datetime(2010, 1, 1), datetime(2010, 2, 1)):
+            print(post['title'])
+"""
+
+import datetime
+import heapq
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from posterous.error import PosterousError
+
+
+MAGIC = b'PSTPACK1'
+INDEX_MAGIC = b'PSTIDX01'
+# payload length, crc32, post id, date
+RECORD = struct.Struct('<IIQq')
+# magic, number of entries, bytes of the pack the entries cover
+INDEX_HEADER = struct.Struct('<8sQQ')
+# post id, date, record offset, payload length, crc32
+ENTRY = struct.Struct('<QqQII')
+POSITION = struct.Struct('<I')
+
+# dates are stored as seconds since the epoch, posts without one sort first
+NO_DATE = -2 ** 63
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def date_key(date):
+    if date is None:
+        return NO_DATE
+    if isinstance(date, str):
+        # as written by str(datetime) in the JSON of a post
+        date = datetime.datetime.strptime(date[:19], '%Y-%m-%d %H:%M:%S')
+    return int((date - EPOCH).total_seconds())
+
+
+def date_order(entry):
+    return entry[1], entry[0]
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def scan(buf, offset, end):
+    """
+    Reads the records in buf[offset:end]. Returns the entries found and the
+    offset after the last complete record.
+    """
+    entries = []
+    while offset + RECORD.size <= end:
+        length, crc, post_id, date = RECORD.unpack_from(buf, offset)
+        start = offset + RECORD.size
+        if start + length > end or zlib.crc32(buf[start:start + length]) != crc:
+            break
+        entries.append((post_id, date, offset, length, crc))
+        offset = start + length
+    return entries, offset
+
+
+class PackReader(object):
+    """
+    Memory maps a pack and its index. The posts are returned as the dicts
+    their JSON decodes to, only the ones asked for are decoded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size < len(MAGIC):
+            self._file.close()
+            raise PosterousError('{0} is not a pack'.format(path))
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise PosterousError('{0} is not a pack'.format(path))
+        self._loads = None
+        self._index = None
+        self._index_file = None
+        self.count = 0
+        covered = len(MAGIC)
+        try:
+            covered = self._open_index()
+        except (OSError, ValueError, struct.error):
+            self._close_index()
+        # records appended since the index was written
+        tail, self.end = scan(self._map, covered, self.size)
+        self._extra = dict((entry[0], entry) for entry in tail)
+        self._extra_by_date = sorted(self._extra.values(), key=date_order)
+
+    def _open_index(self):
+        path = index_path(self.path)
+        if not os.path.exists(path):
+            return len(MAGIC)
+        self._index_file = open(path, 'rb')
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, covered = INDEX_HEADER.unpack_from(self._index, 0)
+        if (magic != INDEX_MAGIC or covered > self.size or
+                len(self._index) != INDEX_HEADER.size + count * (ENTRY.size + POSITION.size)):
+            # left by another pack of the same name, read the whole pack
+            self._close_index()
+            return len(MAGIC)
+        self.count = count
+        self._dates = INDEX_HEADER.size + count * ENTRY.size
+        return covered
+
+    def _close_index(self):
+        if self._index is not None:
+            self._index.close()
+        if self._index_file is not None:
+            self._index_file.close()
+        self._index = self._index_file = None
+        self.count = 0
+
+    def close(self):
+        self._close_index()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def entry(self, i):
+        """The (post id, date, offset, length, crc32) of the i-th indexed post."""
+        return ENTRY.unpack_from(self._index, INDEX_HEADER.size + i * ENTRY.size)
+
+    def by_date(self, i):
+        """The entry of the i-th indexed post in date order."""
+        return self.entry(POSITION.unpack_from(self._index, self._dates + i * POSITION.size)[0])
+
+    def find(self, post_id):
+        """The entry for post_id, or None."""
+        entry = self._extra.get(post_id)
+        if entry is not None:
+            return entry
+        return self._find_indexed(post_id)
+
+    def _find_indexed(self, post_id):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self.entry(mid)
+            if entry[0] < post_id:
+                lo = mid + 1
+            elif entry[0] > post_id:
+                hi = mid
+            else:
+                return entry
+        return None
+
+    def __contains__(self, post_id):
+        return self.find(post_id) is not None
+
+    def __len__(self):
+        return self.count + sum(1 for post_id in self._extra
+                                if self._find_indexed(post_id) is None)
+
+    def ids(self):
+        """The post ids in the pack, in order."""
+        indexed = [self.entry(i)[0] for i in range(self.count)]
+        if not self._extra:
+            return indexed
+        return sorted(set(indexed).union(self._extra))
+
+    def raw(self, post_id):
+        """The JSON of a post as bytes, or None if it isn't in the pack."""
+        entry = self.find(post_id)
+        if entry is None:
+            return None
+        start = entry[2] + RECORD.size
+        return self._map[start:start + entry[3]]
+
+    def get(self, post_id):
+        """The post as a dict, or None if it isn't in the pack."""
+        payload = self.raw(post_id)
+        if payload is None:
+            return None
+        return self.decode(payload)
+
+    def decode(self, payload):
+        if self._loads is None:
+            from posterous.utils import import_json_loads
+            self._loads = import_json_loads()
+        return self._loads(payload)
+
+    def between(self, start=None, end=None):
+        """
+        Yields the posts dated from start up to but not including end, in
+        date order. Either bound may be None.
+        """
+        for entry in self.entries_between(start, end):
+            offset = entry[2] + RECORD.size
+            yield self.decode(self._map[offset:offset + entry[3]])
+
+    def __iter__(self):
+        return self.between()
+
+    def entries_between(self, start=None, end=None):
+        """The entries of the posts between start and end, see between()."""
+        low = NO_DATE if start is None else date_key(start)
+        high = None if end is None else date_key(end)
+        # a post saved again after the index was written is in the tail,
+        # with the date it has now
+        indexed = (entry for entry in self._indexed_between(low, high)
+                   if entry[0] not in self._extra)
+        extra = (entry for entry in self._extra_by_date
+                 if entry[1] >= low and (high is None or entry[1] < high))
+        return heapq.merge(indexed, extra, key=date_order)
+
+    def _indexed_between(self, low, high):
+        # first post dated low or later
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.by_date(mid)[1] < low:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, self.count):
+            entry = self.by_date(i)
+            if high is not None and entry[1] >= high:
+                return
+            yield entry
+
+    def verify(self):
+        """Raises PosterousError unless every indexed record is intact."""
+        for i in range(self.count):
+            post_id, date, offset, length, crc = self.entry(i)
+            start = offset + RECORD.size
+            if RECORD.unpack_from(self._map, offset) != (length, crc, post_id, date):
+                raise PosterousError('Index entry for post {0} is wrong'.format(post_id))
+            if zlib.crc32(self._map[start:start + length]) != crc:
+                raise PosterousError('Record of post {0} is damaged'.format(post_id))
+
+
+class PackWriter(object):
+    """
+    Appends posts to a pack, creating it if needed. The index is written
+    by flush() and close(); add() may be called from several threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        # post id -> (post id, date, offset, length, crc32)
+        self.entries = {}
+        self._lock = threading.Lock()
+        end = 0
+        # the index is rewritten if it misses records
+        self._changed = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with PackReader(path) as reader:
+                for i in range(reader.count):
+                    entry = reader.entry(i)
+                    self.entries[entry[0]] = entry
+                self.entries.update(reader._extra)
+                end = reader.end
+                self._changed = bool(reader._extra) or reader.end < reader.size
+        self._file = open(path, 'ab')
+        if end:
+            # drop a record that a killed run left half written
+            self._file.truncate(end)
+            self._file.seek(end)
+        else:
+            self._file.write(MAGIC)
+
+    def add(self, post_id, date, payload):
+        """
+        Appends the JSON of a post, unless the pack already has the same
+        record for it.
+        """
+        key = date_key(date)
+        crc = zlib.crc32(payload)
+        with self._lock:
+            entry = self.entries.get(post_id)
+            if entry is not None and entry[1:2] + entry[3:] == (key, len(payload), crc):
+                return
+            offset = self._file.tell()
+            self._file.write(RECORD.pack(len(payload), crc, post_id, key))
+            self._file.write(payload)
+            # readers see the record as soon as it's written
+            self._file.flush()
+            self.entries[post_id] = (post_id, key, offset, len(payload), crc)
+            self._changed = True
+
+    def flush(self):
+        """Writes the index, if posts were added since it was last written."""
+        with self._lock:
+            if not self._changed:
+                return
+            self._file.flush()
+            entries = sorted(self.entries.values())
+            by_date = sorted(range(len(entries)), key=lambda i: date_order(entries[i]))
+            tmp = index_path(self.path) + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(entries), self._file.tell()))
+                f.write(b''.join(ENTRY.pack(*entry) for entry in entries))
+                f.write(b''.join(POSITION.pack(i) for i in by_date))
+            os.replace(tmp, index_path(self.path))
+            self._changed = False
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -7,20 +7,67 @@
 #    the terms of the Apache License Version 2.0 available at 
 #    http://www.apache.org/licenses/LICENSE-2.0.txt 
 
-import xml.etree.cElementTree as ET
+from io import BytesIO
+import time
 
 from posterous.models import ModelFactory, attribute_map
-from posterous.utils import import_simplejson
+from posterous.utils import import_json_loads
 from posterous.error import PosterousError
 
 
-def set_type(name, value):
+class TypeMap(object):
+    """
+    Dispatch table from tag name to the converter that casts its text.
+    It's compiled from models.attribute_map once; converters that only
+    apply to the children of one model element (e.g. 'post') are
+    registered with register(tag, converter, model).
+    """
+    def __init__(self, attribute_map=None):
+        self.converters = {}
+        self.model_converters = {}
+        self._tables = {}
+        for names, converter in (attribute_map or {}).items():
+            if isinstance(names, str):
+                names = (names,)
+            for name in names:
+                self.converters[name] = converter
+
+    def register(self, tag, converter, model=None):
+        if model is None:
+            self.converters[tag] = converter
+        else:
+            self.model_converters.setdefault(model, {})[tag] = converter
+        self._tables.clear()
+
+    def table(self, model=None):
+        """Returns the tag -> converter dict that applies inside model."""
+        try:
+            return self._tables[model]
+        except KeyError:
+            table = dict(self.converters)
+            table.update(self.model_converters.get(model, {}))
+            self._tables[model] = table
+            return table
+
+    def convert(self, name, value, model=None):
+        converter = self.table(model).get(name)
+        if converter is None:
+            # most likely a string
+            return value
+        return converter(value)
+
+
+type_map = TypeMap(attribute_map)
+
+
+def register_converter(tag, converter, model=None):
+    """Casts the text of tag with converter, optionally only inside model."""
+    type_map.register(tag, converter, model)
+
+
+def set_type(name, value, model=None):
     """Sets the value to the appropriate type."""
-    for names in attribute_map:
-        if name in names:
-            return attribute_map.get(names)(value)
-    # most likely a string
-    return value
+    return type_map.convert(name, value, model)
 
  
 class XMLDict(dict):
@@ -33,7 +80,11 @@ class XMLDict(dict):
     Modified from: http://code.activestate.com/recipes/410469/
     """
     def __init__(self, parent_element):
-        childrenNames = list((child.tag for child in parent_element))
+        # count the siblings sharing each tag in a single pass
+        tag_counts = {}
+        for child in parent_element:
+            tag_counts[child.tag] = tag_counts.get(child.tag, 0) + 1
+        converters = type_map.table(parent_element.tag.lower())
 
         for element in parent_element:
             tag = element.tag.lower()
@@ -46,7 +97,7 @@ class XMLDict(dict):
                     # treat like list 
                     aDict = {element[0].tag.lower(): XMLList(element)}
                 
-                if childrenNames.count(tag) > 1:
+                if tag_counts.get(tag, 0) > 1:
                     # there are multiple siblings with this tag, so they 
                     # must be grouped together
                     try:
@@ -59,8 +110,11 @@ class XMLDict(dict):
                     self.update({tag: aDict})
             else:
                 # finally, if there are no child tags, extract the text
-                value = set_type(tag, element.text.strip()) 
-                if childrenNames.count(tag) > 1:
+                value = element.text.strip()
+                converter = converters.get(tag)
+                if converter is not None:
+                    value = converter(value)
+                if tag_counts.get(tag, 0) > 1:
                     # there are multiple instances of this tag, so they 
                     # must be grouped together
                     try:
@@ -81,6 +135,7 @@ class XMLList(list):
     Modified from: http://code.activestate.com/recipes/410469/
     """
     def __init__(self, aList):
+        converters = type_map.table(aList.tag.lower())
         for element in aList:
             if element:
                 if len(element) == 1 or element[0].tag != element[1].tag:
@@ -88,18 +143,92 @@ class XMLList(list):
                 else:
                     self.append(XMLList(element))
             elif element.text:
-                text = set_type(element.tag.lower(), element.text.strip())
+                text = element.text.strip()
+                converter = converters.get(element.tag.lower())
+                if converter is not None:
+                    text = converter(text)
                 if text:
                     self.append(text)
 
 
-class XMLParser(object):
+# The XML and JSON libraries are imported when first needed, which keeps
+# 'import posterous' cheap for short-lived scripts.
+ET = None
+json_loads = None
+
+
+def etree():
+    """The ElementTree module."""
+    global ET
+    if ET is None:
+        import xml.etree.cElementTree as ET
+    return ET
+
+
+def json_decoder():
+    """The loads function of the fastest JSON library available."""
+    global json_loads
+    if json_loads is None:
+        json_loads = import_json_loads()
+    return json_loads
+
+
+def detect_format(payload, default='xml'):
+    """Tells a JSON payload from an XML one by its first character."""
+    head = payload[:64].lstrip()[:1]
+    if head in (b'{', b'[', '{', '['):
+        return 'json'
+    if head in (b'<', '<'):
+        return 'xml'
+    return default
+
+
+def content_format(content_type, default='xml'):
+    """The payload format announced by a Content-Type header."""
+    content_type = (content_type or '').lower()
+    if 'json' in content_type:
+        return 'json'
+    if 'xml' in content_type:
+        return 'xml'
+    return default
+
+
+class Parser(object):
+    """What the XML and JSON parsers share: errors and the final shape."""
+    def parse_error(self, error):
+        raise PosterousError(error.get('msg'), error.get('code'))
+
+    def cleanup(self, output):
+        def clean(obj):
+            if 'comment' in obj:
+                comments = obj['comment']
+                del obj['comment']
+                # make it a list
+                if not isinstance(comments, list):
+                    comments = [comments]
+                obj['comments'] = comments
+
+            if 'media' in obj:
+                # make it a list
+                if not isinstance(obj['media'], list):
+                    obj['media'] = [obj['media']]
+            return obj
+
+        if isinstance(output, list):
+            output = list((clean(obj) for obj in output))
+        else: 
+            output = clean(output)
+        
+        return output
+
+
+class XMLParser(Parser):
     def __init__(self):
         pass
 
     def parse(self, method, payload):
-        """Parses the JSON payload and returns a dict of objects"""
-        root = ET.XML(payload)
+        """Parses the XML payload and returns a dict of objects"""
+        root = etree().XML(payload)
         
         if root.tag != 'rsp':
             raise PosterousError('XML response is missing the status tag! ' \
@@ -116,56 +245,154 @@ class XMLParser(object):
             # If the root has multiple children, all siblings of the first
             # child will be moved under said child.
             if not method.payload_list and len(root) > 1:
-                for node in root[1:]:
-                    root[0].append(node)
-                    root.remove(node)
+                siblings = root[1:]
+                del root[1:]
+                root[0].extend(siblings)
             
             if method.payload_list:
                 # A list of results is expected
                 result = []
                 for node in root:
                     result.append(XMLDict(node))
-            else:
+            elif len(root[0]):
                 # Move to the first child before parsing the tree
                 result = XMLDict(root[0])
+            else:
+                # a bare value such as <api_token>, keep its tag
+                result = XMLDict(root)
             
             # Make sure the values are formatted properly
             return self.cleanup(result)
 
-    def parse_error(self, error):
-        raise PosterousError(error.get('msg'), error.get('code'))
-    
-    def cleanup(self, output):
-        def clean(obj):
-            if 'comment' in obj:
-                comments = obj['comment']
-                del obj['comment']
-                # make it a list
-                if not isinstance(comments, list):
-                    comments = [comments]
-                obj['comments'] = comments
+    def iterparse(self, method, source):
+        """
+        Parses a list payload incrementally from a bytes string or a file-like
+        object and yields a dict for each child of the root as soon as its
+        closing tag has been read. Finished elements are dropped so the full
+        tree is never held in memory.
+        """
+        if isinstance(source, bytes):
+            source = BytesIO(source)
 
-            if 'media' in obj:
-                # make it a list
-                if not isinstance(obj['media'], list):
-                    obj['media'] = [obj['media']]
-            return obj
+        root = None
+        depth = 0
+        try:
+            for event, element in etree().iterparse(source, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if root is None:
+                        root = element
+                        if root.tag != 'rsp':
+                            raise PosterousError('XML response is missing the status ' \
+                                                 'tag! The response may be malformed.')
+                    continue
 
-        if isinstance(output, list):
-            output = list((clean(obj) for obj in output))
-        else: 
-            output = clean(output)
-        
-        return output
+                depth -= 1
+                if depth != 1:
+                    continue
+
+                if root.get('stat') == 'fail':
+                    self.parse_error(element)
+                yield self.cleanup(XMLDict(element))
+                element.clear()
+                root.remove(element)
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+
+
+
+class JSONParser(Parser):
+    """
+    Parses JSON responses into the same dicts XMLParser returns: keys are
+    lower case, string values are cast with the type map and comments and
+    media always come as lists.
+
+    The payload is either the object(s) themselves or wrapped in an object
+    with a single key, e.g. {"site": {...}} or {"posts": [...]}. Failures
+    look like {"stat": "fail", "err": {"msg": ..., "code": ...}}.
+    """
+    def __init__(self):
+        pass
+
+    def parse(self, method, payload):
+        data = json_decoder()(payload)
+        if isinstance(data, dict):
+            if data.get('stat') == 'fail':
+                self.parse_error(data.get('err') or {})
+            data.pop('stat', None)
+            if len(data) == 1:
+                value = next(iter(data.values()))
+                if isinstance(value, (list, dict)):
+                    data = value
+
+        if method.payload_list:
+            if isinstance(data, dict):
+                data = [data]
+            result = [self.normalize(obj, method.payload_type) for obj in data]
+        else:
+            result = self.normalize(data, method.payload_type)
+        return self.cleanup(result)
+
+    def iterparse(self, method, source):
+        """Yields the dict of each object of a list payload."""
+        payload = source
+        if not isinstance(source, (bytes, str)):
+            # no incremental JSON decoding, read the whole response
+            try:
+                payload = source.read()
+            finally:
+                source.close()
+        for obj in self.parse(method, payload):
+            yield obj
+
+    def normalize(self, obj, model):
+        converters = type_map.table(model)
+        result = {}
+        for key, value in obj.items():
+            key = key.lower()
+            if isinstance(value, dict):
+                value = self.normalize(value, key)
+            elif isinstance(value, list):
+                value = [self.normalize(item, key) if isinstance(item, dict)
+                         else self.convert(converters, key, item)
+                         for item in value]
+            else:
+                value = self.convert(converters, key, value)
+            result[key] = value
+        return result
+
+    def convert(self, converters, key, value):
+        # only text needs casting, JSON numbers and booleans are typed
+        if not isinstance(value, str):
+            return value
+        value = value.strip()
+        converter = converters.get(key)
+        if converter is not None:
+            value = converter(value)
+        return value
 
 
 class ModelParser(object):
     """Used for parsing a method response into a model object."""
 
+    parsers = {'xml': XMLParser, 'json': JSONParser}
+
     def __init__(self, model_factory=None):
         self.model_factory = model_factory or ModelFactory
 
+    def format_parser(self, format):
+        try:
+            return self.parsers[format]()
+        except KeyError:
+            raise NotImplementedError('Unsupported response format: {0}'.format(format))
+
     def parse(self, method, payload):
+        """
+        Returns the model (or list of models) for the payload. Methods
+        called with iterator=True get a generator of models instead, which
+        reads the payload incrementally.
+        """
         # Get the appropriate model for this payload
         try:
             if method.payload_type is None:
@@ -174,13 +401,45 @@ class ModelParser(object):
         except AttributeError:
             raise Exception('No model for this payload type: {0}'.format(method.payload_type))
 
-        # The payload XML must be parsed into a dict of objects before
-        # being used in the model.
-        if method.response_type == 'xml':
-            xml_parser = XMLParser()
-            data = xml_parser.parse(method, payload)
-        else:
-            raise NotImplementedError
+        if getattr(method, 'iterator', False):
+            return self.parse_iter(method, model, payload)
 
-        return model.parse(method.api, data)
+        # The payload must be parsed into a dict of objects before being
+        # used in the model. What the server sent wins over what was asked.
+        start = time.perf_counter()
+        format = detect_format(payload, method.format)
+        data = self.format_parser(format).parse(method, payload)
+        parsed = time.perf_counter()
 
+        result = model.parse(method.api, data)
+        timings = getattr(method, 'timings', None)
+        if timings is not None:
+            timings['parse'] = parsed - start
+            timings['build'] = time.perf_counter() - parsed
+        return result
+
+    def parse_iter(self, method, model, payload):
+        format = method.format
+        if isinstance(payload, (bytes, str)):
+            format = detect_format(payload, format)
+        items = iter(self.format_parser(format).iterparse(method, payload))
+
+        # the body is read while it is parsed, so parse includes its transfer
+        parse = build = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    data = next(items)
+                except StopIteration:
+                    break
+                parsed = time.perf_counter()
+                obj = model.parse_obj(method.api, data)
+                parse += parsed - start
+                build += time.perf_counter() - parsed
+                yield obj
+        finally:
+            timings = getattr(method, 'timings', None)
+            if timings is not None:
+                timings['parse'] = parse
+                timings['build'] = build
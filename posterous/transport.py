@@ -0,0 +1,281 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+from collections import deque
+import http.client
+import threading
+import time
+import urllib.parse
+
+
+# Errors raised when a pooled connection was closed by the server while it
+# sat idle. The request is retried once on a fresh connection if its
+# method is idempotent: the server may have acted on a POST before closing.
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected,
+                           http.client.BadStatusLine,
+                           ConnectionResetError,
+                           BrokenPipeError)
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'DELETE'])
+
+
+class Response(object):
+    """
+    An HTTP response whose body has been read in full. The headers are an
+    http.client.HTTPMessage, so lookups are case-insensitive.
+    """
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        # measurements of the exchange, see posterous.metrics
+        self.timings = {}
+        self._offset = 0
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, amt=None):
+        """Reads the body like a file; the whole of it stays on self.body."""
+        start = self._offset
+        end = len(self.body) if amt is None else start + amt
+        self._offset = min(end, len(self.body))
+        return self.body[start:end]
+
+    def close(self):
+        pass
+
+
+class StreamingResponse(Response):
+    """
+    A Response whose body is read from the connection on demand. The
+    connection goes back to the pool once the body has been read to the
+    end, and is dropped if the response is closed before that.
+    """
+    def __init__(self, transport, key, conn, resp):
+        Response.__init__(self, resp.status, resp.reason, resp.msg, None)
+        self._transport = transport
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self.timings = {}
+
+    def read(self, amt=None):
+        if self._conn is None:
+            return b''
+        data = self._resp.read(amt)
+        if amt is None or not data:
+            self._finish(complete=True)
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            self._finish(complete=False)
+
+    def _finish(self, complete):
+        conn, self._conn = self._conn, None
+        if complete and not self._resp.will_close:
+            self._transport._release(self._key, conn)
+        else:
+            self._transport._discard(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def request_size(method, target, headers, body):
+    """Approximate size of a request on the wire."""
+    size = len(method) + len(target) + 12
+    for name, value in (headers or {}).items():
+        size += len(name) + len(str(value)) + 4
+    if body is None or isinstance(body, (bytes, str)):
+        return size + len(body or b'')
+    # a streamed body, see posterous.multipart
+    return size + (body.length or 0)
+
+
+class TransportStats(object):
+    """Counters describing how often pooled connections were reused."""
+    def __init__(self):
+        self.requests = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.connections_closed = 0
+
+    @property
+    def reuse_ratio(self):
+        """Fraction of requests that were sent on an already open connection."""
+        if not self.requests:
+            return 0.0
+        return self.connections_reused / float(self.requests)
+
+    def as_dict(self):
+        return {'requests': self.requests,
+                'connections_opened': self.connections_opened,
+                'connections_reused': self.connections_reused,
+                'connections_closed': self.connections_closed,
+                'reuse_ratio': self.reuse_ratio}
+
+    def __repr__(self):
+        return 'TransportStats({0})'.format(self.as_dict())
+
+
+class HTTPTransport(object):
+    """
+    Sends requests over persistent HTTP/1.1 connections.
+
+    Idle connections are pooled per (scheme, host, port) so that consecutive
+    API calls to the same host skip the TCP and TLS handshakes.
+
+    "pool_size" - The maximum number of idle connections kept per host.
+    "idle_timeout" - Seconds after which an idle connection is discarded
+        instead of being reused.
+    "timeout" - Socket timeout in seconds passed to each connection.
+    """
+    connection_classes = {'http': http.client.HTTPConnection,
+                          'https': http.client.HTTPSConnection}
+
+    def __init__(self, pool_size=4, idle_timeout=60, timeout=None):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.stats = TransportStats()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None, stream=False):
+        """
+        Sends the request and returns a Response. With stream=True the body
+        is left on the connection and a StreamingResponse is returned.
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        target = parts.path or '/'
+        if parts.query:
+            target = '{0}?{1}'.format(target, parts.query)
+
+        timings = {'request_bytes': request_size(method, target, headers, body)}
+        conn, reused = self._acquire(key)
+        try:
+            resp = self._send(conn, method, target, body, headers, timings)
+        except STALE_CONNECTION_ERRORS:
+            self._discard(conn)
+            if not reused or method not in IDEMPOTENT_METHODS:
+                raise
+            # the server closed the idle connection, try again on a new one
+            conn, reused = self._acquire(key, fresh=True)
+            try:
+                resp = self._send(conn, method, target, body, headers, timings)
+            except Exception:
+                self._discard(conn)
+                raise
+        except Exception:
+            self._discard(conn)
+            raise
+
+        with self._lock:
+            self.stats.requests += 1
+            if reused:
+                self.stats.connections_reused += 1
+
+        if stream:
+            response = StreamingResponse(self, key, conn, resp)
+            response.timings = timings
+            return response
+
+        start = time.perf_counter()
+        response = Response(resp.status, resp.reason, resp.msg, resp.read())
+        timings['transfer'] = time.perf_counter() - start
+        timings['response_bytes'] = len(response.body)
+        response.timings = timings
+        if resp.will_close:
+            self._discard(conn)
+        else:
+            self._release(key, conn)
+        return response
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for conn, _ in pool:
+                self._discard(conn)
+
+    def _send(self, conn, method, target, body, headers, timings):
+        if conn.sock is None:
+            start = time.perf_counter()
+            conn.connect()
+            timings['connect'] = time.perf_counter() - start
+        start = time.perf_counter()
+        if hasattr(body, 'send_to') and body.length is not None:
+            self._send_streamed(conn, method, target, body, headers or {})
+        else:
+            # a streamed body of unknown length is iterated and chunked
+            conn.request(method, target, body, headers or {})
+        resp = conn.getresponse()
+        timings['ttfb'] = time.perf_counter() - start
+        return resp
+
+    def _send_streamed(self, conn, method, target, body, headers):
+        """
+        Sends the headers through http.client and leaves the body to
+        write itself to the socket, so files can go out with sendfile().
+        """
+        names = set(name.lower() for name in headers)
+        conn.putrequest(method, target, skip_host='host' in names,
+                        skip_accept_encoding='accept-encoding' in names)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        if 'content-length' not in names:
+            conn.putheader('Content-Length', str(body.length))
+        conn.endheaders()
+        body.send_to(conn.sock)
+
+    def _acquire(self, key, fresh=False):
+        now = time.monotonic()
+        expired = []
+        conn = None
+        with self._lock:
+            pool = self._pools.get(key)
+            while pool and not fresh:
+                candidate, last_used = pool.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+            # anything left further down the stack is even older
+            while pool and pool[0][1] + self.idle_timeout <= now:
+                expired.append(pool.popleft()[0])
+        for candidate in expired:
+            self._discard(candidate)
+        if conn is not None:
+            return conn, True
+
+        scheme, host, port = key
+        conn = self.connection_classes[scheme](host, port, timeout=self.timeout)
+        with self._lock:
+            self.stats.connections_opened += 1
+        return conn, False
+
+    def _release(self, key, conn):
+        with self._lock:
+            pool = self._pools.setdefault(key, deque())
+            if len(pool) < self.pool_size:
+                pool.append((conn, time.monotonic()))
+                return
+        self._discard(conn)
+
+    def _discard(self, conn):
+        conn.close()
+        with self._lock:
+            self.stats.connections_closed += 1
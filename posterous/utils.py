@@ -8,23 +8,43 @@
 #    http://www.apache.org/licenses/LICENSE-2.0.txt 
 
 from datetime import datetime, timedelta
-import locale
-import time
+from functools import lru_cache
 
 
+_MONTHS = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+           'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12}
+
+# Number of distinct date strings whose parsed value is kept around
+DATE_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
 def parse_datetime(time_string):
-    # Set locale for date parsing
-    utc_offset_str = time_string[-6:].strip()
-    sign = 1
-    
-    if utc_offset_str[0] == '-':
-        sign = -1
-        utc_offset_str = utc_offset_str[1:5]
+    """
+    Parses a Posterous date like 'Sun, 03 May 2009 19:58:58 -0800' into a
+    naive datetime in UTC. The month names are matched in English no matter
+    what the process locale is. Results are cached since the same
+    timestamps show up again and again.
+    """
+    parts = time_string.split()
+    if len(parts) == 6:
+        # drop the day of the week
+        parts = parts[1:]
+    day, month, year, clock, offset = parts
+    hour, minute, second = clock.split(':')
 
-    utcoffset = sign * timedelta(hours=int(utc_offset_str[0:2]), 
-                                 minutes=int(utc_offset_str[2:4]))
+    sign = -1 if offset[0] == '-' else 1
+    offset = offset.lstrip('+-')
+    utcoffset = sign * (int(offset[0:2]) * 60 + int(offset[2:4]))
 
-    return datetime.strptime(time_string[:-6], '%a, %d %b %Y %H:%M:%S') - utcoffset
+    return (datetime(int(year), _MONTHS[month[:3].lower()], int(day),
+                     int(hour), int(minute), int(second)) -
+            timedelta(minutes=utcoffset))
+
+def parse_datetimes(time_strings):
+    """Parses a list of Posterous dates, see parse_datetime."""
+    parse = parse_datetime
+    return [parse(s) for s in time_strings]
 
 def strip_dict(d):
     """Returns a new dictionary with keys that had a value"""
@@ -42,6 +62,23 @@ def enc_utf8_str(arg):
         arg = str(arg)
     return arg
 
+def import_json_loads():
+    """
+    Returns the loads function of the fastest JSON library available.
+    It accepts bytes as well as str.
+    """
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return ujson.loads
+    except ImportError:
+        pass
+    return import_simplejson().loads
+
 def import_simplejson():
     try:
         import simplejson as json
@@ -50,5 +87,9 @@ def import_simplejson():
             # they may have django
             from django.utils import simplejson as json
         except ImportError:
-            raise ImportError("Can't load a json library")
+            try:
+                # bundled with python since 2.6
+                import json
+            except ImportError:
+                raise ImportError("Can't load a json library")
     return json
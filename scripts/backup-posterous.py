@@ -5,24 +5,10 @@
 
 from optparse import OptionParser
 import logging 
-import datetime
-import os, os.path
-import re
 import sys
-import urllib.parse, urllib.request, urllib.parse, urllib.error
-import simplejson
 
-from posterous.api import Posterous
-
-
-class JsonDateEncoder(simplejson.JSONEncoder):
-    def default(self, o):
-        try:
-            if o and type(o) == datetime.datetime:
-                return str(o).encode('utf8')
-        except TypeError:
-            pass
-        return simplejson.JSONEncoder.default(self, o)
+from posterous.api import PostyAPI
+from posterous.backup import BackupEngine, BlobStore
 
 
 if __name__ == '__main__':
@@ -33,6 +19,11 @@ if __name__ == '__main__':
                 site-{site.hostname}.json
                 {post-slug}.json  <-- contains body & comments & everything else
                 {post-slug}_media{num}
+                manifest-{site.hostname}.json  <-- lets reruns skip saved posts
+
+        or with --format pack, the posts go to a single indexed file
+                posts-{site.hostname}.pack  <-- see posterous.pack
+                posts-{site.hostname}.pack.idx
     """
     
     batch_sz = 50 # default (and current api max)
@@ -55,6 +46,37 @@ if __name__ == '__main__':
         default=batch_sz, help="The number of posts to get per API call. " \
                                "Default is %d" % batch_sz)
     
+    opt_parser.add_option("--page-workers", type="int", dest="page_workers",
+        default=4, help="The number of pages requested at the same time. " \
+                        "Default is 4")
+
+    opt_parser.add_option("--json-workers", type="int", dest="json_workers",
+        default=2, help="The number of threads writing post files. " \
+                        "Default is 2")
+
+    opt_parser.add_option("--media-workers", type="int", dest="media_workers",
+        default=8, help="The number of concurrent media downloads. " \
+                        "Default is 8")
+
+    opt_parser.add_option("--full", dest="incremental", action="store_false",
+        default=True, help="Save every post again instead of skipping the " \
+                           "ones the manifest shows as unchanged")
+
+    opt_parser.add_option("--blob-store", dest="blob_store",
+        help="Keep each media file once in this folder and link it into " \
+             "the backup. Can be shared by the backups of several accounts")
+
+    opt_parser.add_option("--link", dest="link", default="hardlink",
+        choices=["hardlink", "symlink", "copy"],
+        help="How media is placed from the blob store: hardlink (default), " \
+             "symlink or copy")
+
+    opt_parser.add_option("--format", dest="format", default="folder",
+        choices=["folder", "pack"],
+        help="folder (default) saves a JSON file per post, pack appends " \
+             "the posts of each site to one indexed file. " \
+             "See scripts/convert-backup.py to switch an existing backup")
+
     opt_parser.add_option("-d", "--debug", dest="debug", action="store_true", 
         default=False, help="Debug output")
     
@@ -79,55 +101,26 @@ if __name__ == '__main__':
         opt_parser.print_help()
         sys.exit()
 
-    # Make the API calls and parse the data
-    posterous = Posterous(options.username, options.password)
-
-    for site in posterous.get_sites():
-        if options.site_id and options.site_id != site.id:
-            continue
-
-        site_folder = os.path.join(options.folder, site.hostname)
-        logging.info("Creating folder '%s' for site '%s'" % (site_folder, site.id))
-        if not os.path.exists(site_folder):
-            os.makedirs(site_folder)
-                    
-        # create a private folder in case they have private posts
-        private_folder = os.path.join(site_folder, "private")
-        if not os.path.exists(private_folder):
-            os.mkdir(private_folder)
-
-        site_file = os.path.join(site_folder, 'site-%s.json' % site.hostname)
-        logging.debug("Opening file '%s' for site '%s' (%s)" % 
-                      (site_file, site.hostname, site.id))
-
-        with open(site_file, 'w+') as sf:
-            simplejson.dump(site, sf, cls=JsonDateEncoder)
-            
-        rem = 2 if site.num_posts % options.batch_size > 0 else 1
-        page_numbers = list(range(1, int(site.num_posts/options.batch_size) + rem))
-
-        for page in page_numbers:
-            logging.info("Retrieving page %s of %s with %s posts per page" % 
-                         (page, len(page_numbers), options.batch_size))
-            
-            for p in posterous.get_posts(site_id=site.id, page_num=page, 
-                                         num_posts=options.batch_size):
-                post_slug = re.sub(r'^/', '', urllib.parse.urlparse(p.link).path)
-                post_file = os.path.join(site_folder, '%s.json' % post_slug)
-            
-                logging.debug("Opening file '%s' for post '%s'" % 
-                              (post_file, p.title))
+    # Make the API calls and save the data
+    posterous = PostyAPI(options.username, options.password)
+    blob_store = None
+    if options.blob_store:
+        blob_store = BlobStore(options.blob_store, options.link)
+    engine = BackupEngine(posterous, options.folder, 
+                          batch_size=options.batch_size,
+                          site_id=options.site_id,
+                          page_workers=options.page_workers,
+                          json_workers=options.json_workers,
+                          media_workers=options.media_workers,
+                          incremental=options.incremental,
+                          blob_store=blob_store,
+                          format=options.format)
+    stats = engine.run()
 
-                with open(post_file, 'w+') as f:
-                    simplejson.dump(p, f, cls=JsonDateEncoder)
-                
-                # save the media from each post
-                for i, m in enumerate(p.media):
-                    u = m.medium_url if hasattr(m, 'medium_url') else m.url
-                    media_type = re.search(r'\.(\w+)$', u).group(1)
-                    media_file = os.path.join(site_folder, '%s_%s.%s' % 
-                                              (post_slug, i, media_type))                
-                    logging.debug("Getting media for post '%s' from url '%s'" %
-                                  (p.title, u))
-                
-                    urllib.request.urlretrieve(u, media_file)
+    print(stats.summary())
+    if blob_store is not None:
+        print('Reused %s media files by url and %s by content, %.1f MB saved' %
+              (blob_store.url_hits, blob_store.hash_hits, 
+               blob_store.bytes_saved / 1e6))
+    if stats.errors:
+        sys.exit(1)
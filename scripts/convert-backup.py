@@ -0,0 +1,44 @@
+"""
+    Converts a backup made by backup-posterous.py from one layout to the
+    other: the JSON file per post of the folder layout, or the indexed
+    posts-{site.hostname}.pack of the pack layout.
+"""
+
+
+from optparse import OptionParser
+import os
+import sys
+
+from posterous.backup import folder_to_pack, pack_path, pack_to_folder
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser(usage="%prog --to pack|folder [options] FOLDER")
+
+    opt_parser.add_option("-t", "--to", dest="to", choices=["pack", "folder"],
+        help="The layout to convert to: pack or folder")
+
+    opt_parser.add_option("-s", "--site", dest="site",
+        help="Only convert the site with this hostname")
+
+    opt_parser.add_option("--remove", dest="remove", action="store_true",
+        default=False, help="Delete the post files (or pack) once converted")
+
+    (options, args) = opt_parser.parse_args()
+
+    if not options.to or len(args) != 1:
+        opt_parser.print_help()
+        sys.exit(1)
+
+    folder = args[0]
+    for hostname in sorted(os.listdir(folder)):
+        site_folder = os.path.join(folder, hostname)
+        if options.site and options.site != hostname:
+            continue
+        if not os.path.isfile(os.path.join(site_folder, 'site-%s.json' % hostname)):
+            continue
+        if options.to == 'pack':
+            print('Packed %s' % folder_to_pack(site_folder, options.remove))
+        elif os.path.exists(pack_path(site_folder)):
+            pack_to_folder(site_folder, options.remove)
+            print('Unpacked %s' % pack_path(site_folder))
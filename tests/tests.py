@@ -2,9 +2,18 @@
 import sys
 sys.path.append("..")
 
+import asyncio
 from datetime import datetime 
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os.path
+import subprocess
+import threading
+import time
 from posterous.api import *
+from posterous.aio import AsyncPostyAPI
+from posterous.backup import BackupEngine
+from posterous.transport import HTTPTransport
 
 
 def get_file_name(n):
@@ -75,3 +84,1369 @@ def test_post_xml_parser():
         assert vid.mp4 == "http://posterous.com/getfile/files.posterous.com/sachin/DIptatiCkiv/movie.mp4"
         
 
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves the XML fixtures over keep-alive HTTP/1.1 connections."""
+    protocol_version = 'HTTP/1.1'
+    routes = {'/posts': 'posts.xml', '/auth/token': 'token.xml'}
+    connections = set()
+    rejected_tokens = set()
+    # number of requests to answer with 503 before serving the fixtures
+    unavailable = 0
+    # seconds to wait before answering
+    delay = 0
+
+    def fixture_for(self, path):
+        for suffix, name in self.routes.items():
+            if path.endswith(suffix):
+                return name
+        return 'sites.xml'
+
+    def do_GET(self):
+        FixtureHandler.connections.add(self.client_address)
+        FixtureHandler.requests.append((self.command, self.path))
+        FixtureHandler.accepts.append(self.headers.get('Accept'))
+        time.sleep(self.delay)
+        path = self.path.split('?')[0]
+        if any('api_token=' + t in self.path for t in self.rejected_tokens):
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if FixtureHandler.unavailable:
+            FixtureHandler.unavailable -= 1
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        name = self.fixture_for(path)
+        content_type = 'text/xml'
+        json_name = name.replace('.xml', '.json')
+        if ('json' in self.headers.get('Accept', '') and
+                os.path.exists(get_file_name(json_name))):
+            name, content_type = json_name, 'application/json'
+        with open(get_file_name(name), 'rb') as f:
+            body = f.read()
+        etag = '"{0}"'.format(len(body))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        FixtureHandler.posted.append((self.headers, body))
+        self.do_GET()
+
+    do_DELETE = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fixture_server():
+    FixtureHandler.connections = set()
+    FixtureHandler.requests = []
+    FixtureHandler.accepts = []
+    FixtureHandler.posted = []
+    FixtureHandler.rejected_tokens = set()
+    FixtureHandler.unavailable = 0
+    FixtureHandler.delay = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fixture_api(server, cls=PostyAPI, **kwargs):
+    api = cls(**kwargs)
+    api.host = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    api.api_token = 'token'
+    return api
+
+
+def test_transport_reuses_connections():
+    server = start_fixture_server()
+    try:
+        api = fixture_api(server)
+        for i in range(5):
+            sites = api.get_sites()
+            assert len(sites) == 2
+            assert sites[0].hostname == 'sachin'
+
+        stats = api.transport.stats
+        assert stats.requests == 5
+        assert stats.connections_opened == 1
+        assert stats.connections_reused == 4
+        assert len(FixtureHandler.connections) == 1
+    finally:
+        server.shutdown()
+
+
+def test_transport_discards_idle_connections():
+    server = start_fixture_server()
+    try:
+        api = fixture_api(server, transport=HTTPTransport(idle_timeout=0))
+        api.get_sites()
+        api.get_sites()
+        assert api.transport.stats.connections_opened == 2
+        assert api.transport.stats.connections_reused == 0
+    finally:
+        server.shutdown()
+
+
+def test_async_api_runs_calls_concurrently():
+    server = start_fixture_server()
+
+    async def fetch_all(api):
+        async with api:
+            return await asyncio.gather(*[api.get_sites() for i in range(20)])
+
+    try:
+        api = fixture_api(server, cls=AsyncPostyAPI)
+        results = asyncio.run(fetch_all(api))
+
+        assert len(results) == 20
+        for sites in results:
+            assert [s.hostname for s in sites] == ['sachin', 'agarwal']
+        assert api.transport.stats.requests == 20
+        assert api.transport.stats.connections_opened <= 20
+    finally:
+        server.shutdown()
+
+
+def test_async_api_iterates_posts_and_refuses_batches():
+    server = start_fixture_server()
+
+    async def titles(api, **kwargs):
+        async with api:
+            return [post.title async for post in api.iter_posts(1, **kwargs)]
+
+    try:
+        # the fixture serves 4 posts for every page
+        for prefetch in (0, 1):
+            FixtureHandler.requests = []
+            api = fixture_api(server, cls=AsyncPostyAPI)
+            result = asyncio.run(titles(api, per_page=5, prefetch=prefetch))
+            assert len(result) == 4 and result[0] == 'Brunch in San Francisco'
+            assert len(FixtureHandler.requests) == 1
+
+        class PagedAPI(AsyncPostyAPI):
+            async def read_posts(self, site_id, page=None, num_posts=None):
+                self.pages.append(page)
+                return list(range(10))[(page - 1) * num_posts:page * num_posts]
+
+        async def first(api, count):
+            items = []
+            async for item in api.iter_posts(1, per_page=3):
+                items.append(item)
+                if len(items) == count:
+                    break
+            return items
+
+        api = PagedAPI()
+        api.pages = []
+        assert asyncio.run(first(api, 100)) == list(range(10)) and api.pages == [1, 2, 3, 4]
+        api.pages = []
+        assert asyncio.run(first(api, 2)) == [0, 1]
+        try:
+            api.batch()
+            assert False, 'expected a TypeError'
+        except TypeError:
+            pass
+    finally:
+        server.shutdown()
+
+
+def test_iterator_yields_posts_as_they_are_parsed():
+    server = start_fixture_server()
+    try:
+        api = fixture_api(server)
+        posts = api.read_posts(1, iterator=True)
+        assert not isinstance(posts, list)
+
+        first = next(posts)
+        assert first.title == 'Brunch in San Francisco'
+        assert len(first.comments) == 1
+        assert len(first.media) == 3
+        assert len(list(posts)) == 3
+
+        # the connection went back to the pool once the body was consumed
+        api.get_sites()
+        assert api.transport.stats.connections_opened == 1
+    finally:
+        server.shutdown()
+
+
+def test_iterparse_matches_parse():
+    from posterous.parsers import XMLParser
+
+    class Method(object):
+        payload_list = True
+
+    with open(get_file_name('posts.xml'), 'rb') as f:
+        payload = f.read()
+    parser = XMLParser()
+    assert list(parser.iterparse(Method, payload)) == parser.parse(Method, payload)
+
+
+def test_xmldict_groups_repeated_siblings():
+    from posterous.parsers import XMLDict, XMLParser
+    import xml.etree.cElementTree as ET
+
+    element = ET.XML('<post><id>1</id><tag>a</tag><tag>b</tag>'
+                     '<comment><body>x</body></comment>'
+                     '<comment><body>y</body></comment>'
+                     '<media><url>u</url></media></post>')
+    assert XMLDict(element) == {'id': 1, 'tag': ['a', 'b'],
+                                'comment': [{'body': 'x'}, {'body': 'y'}],
+                                'media': {'url': 'u'}}
+
+    class Method(object):
+        payload_list = False
+
+    site = XMLParser().parse(Method, b'<rsp stat="ok"><site><id>1</id></site>'
+                                     b'<comment><body>x</body></comment>'
+                                     b'<media><url>u</url></media></rsp>')
+    assert site == {'id': 1, 'comments': [{'body': 'x'}], 'media': [{'url': 'u'}]}
+
+
+def test_type_map_dispatch():
+    from posterous.parsers import TypeMap
+    from posterous.models import attribute_map
+
+    types = TypeMap(attribute_map)
+    assert types.convert('views', '10') == 10
+    assert types.convert('private', 'True') is True
+    # 'date' used to be a plain string and matched any substring of it
+    assert types.convert('at', 'x') == 'x'
+    assert types.convert('te', 'x') == 'x'
+
+    types.register('body', str.upper, model='comment')
+    assert types.convert('body', 'hi', model='comment') == 'HI'
+    assert types.convert('body', 'hi', model='post') == 'hi'
+    assert types.convert('id', '3', model='comment') == 3
+
+
+def test_register_converter_applies_to_model_children():
+    from posterous import parsers
+    import xml.etree.cElementTree as ET
+
+    element = ET.XML('<post><title>t</title><comment><title>c</title></comment></post>')
+    saved = parsers.type_map
+    parsers.type_map = parsers.TypeMap(parsers.attribute_map)
+    try:
+        parsers.register_converter('title', str.upper, model='comment')
+        assert parsers.XMLDict(element) == {'title': 't', 'comment': {'title': 'C'}}
+    finally:
+        parsers.type_map = saved
+
+
+def test_parse_datetime():
+    from posterous.utils import parse_datetime, parse_datetimes
+
+    assert parse_datetime('Sun, 03 May 2009 19:58:58 -0800') == datetime(2009, 5, 4, 3, 58, 58)
+    assert parse_datetime('Mon, 25 Jan 2010 00:00:20 +0130') == datetime(2010, 1, 24, 22, 30, 20)
+    assert parse_datetime('3 May 2009 19:58:58 +0000') == datetime(2009, 5, 3, 19, 58, 58)
+    assert parse_datetimes(['Thu, 04 Jun 2009 01:33:43 -0800'] * 2) == [datetime(2009, 6, 4, 9, 33, 43)] * 2
+
+
+class ClosingHandler(BaseHTTPRequestHandler):
+    """Answers as if keeping the connection alive, then closes it."""
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        ClosingHandler.requests.append(self.command)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+        self.close_connection = True
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def test_transport_only_resends_idempotent_requests():
+    ClosingHandler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ClosingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+        transport = HTTPTransport()
+        transport.request('GET', url)
+        time.sleep(0.1)
+        # the pooled connection was closed, the read goes out again
+        assert transport.request('GET', url).body == b'ok'
+
+        time.sleep(0.1)
+        try:
+            transport.request('POST', url, b'x=1', {'Content-Length': '3'})
+            assert False, 'expected the POST to fail rather than be resent'
+        except (http.client.HTTPException, ConnectionError):
+            pass
+        assert ClosingHandler.requests == ['GET', 'GET']
+    finally:
+        server.shutdown()
+
+
+def test_cache_serves_reads_and_revalidates():
+    from posterous.cache import MemoryCache
+
+    server = start_fixture_server()
+    try:
+        api = fixture_api(server, cache=MemoryCache())
+        assert api.get_sites()[0].hostname == 'sachin'
+        assert api.get_sites()[0].hostname == 'sachin'
+        assert len(FixtureHandler.requests) == 1
+        assert api.cache.hits == 1
+
+        # an expired entry is revalidated with its ETag
+        for entry in api.cache._entries.values():
+            entry.expires = 0
+        assert len(api.get_sites()) == 2
+        assert len(FixtureHandler.requests) == 2
+        assert api.cache.revalidations == 1
+        assert len(api.get_sites()) == 2
+        assert len(FixtureHandler.requests) == 2
+
+        # writing to the resource drops the cached read
+        api.create_site(name='new')
+        api.get_sites()
+        assert [m for m, p in FixtureHandler.requests] == ['GET', 'GET', 'POST', 'GET']
+    finally:
+        server.shutdown()
+
+
+def test_delete_site_returns_status_and_drops_cached_sites():
+    from posterous.cache import MemoryCache
+
+    server = start_fixture_server()
+    try:
+        api = fixture_api(server, cache=MemoryCache())
+        api.get_sites()
+        api.get_sites()
+        assert api.delete_site(hostname='sachin') == 200
+        api.get_sites()
+        assert [m for m, p in FixtureHandler.requests] == ['GET', 'DELETE', 'GET']
+    finally:
+        server.shutdown()
+
+
+def test_cache_evicts_least_recently_used():
+    from posterous.cache import MemoryCache
+
+    cache = MemoryCache(max_entries=2, max_bytes=10)
+    cache.store('a', '/a', b'1234', 60)
+    cache.store('b', '/b', b'1234', 60)
+    cache.get('a')
+    cache.store('c', '/c', b'1234', 60)
+    assert cache.get('b') is None
+    assert cache.get('a').body == b'1234'
+    cache.store('d', '/d', b'123456', 60)
+    assert cache.size == 10
+    assert cache.get('c') is None
+    cache.store('e', '/e', b'x' * 11, 60)
+    assert cache.get('e') is None
+
+
+def token_requests():
+    return [p for m, p in FixtureHandler.requests if p.startswith('/api/2/auth/token')]
+
+
+def test_token_is_fetched_once_for_all_threads():
+    server = start_fixture_server()
+    try:
+        api = fixture_api(server, username='user', password='pass')
+        api.api_token = None
+        # every thread sends its own request
+        api.inflight = None
+        threads = [threading.Thread(target=api.get_sites) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(token_requests()) == 1
+        assert api.api_token == 'fresh-token'
+        assert api.tokens.fetches == 1
+        assert len(FixtureHandler.requests) == 11
+    finally:
+        server.shutdown()
+
+
+def test_rejected_token_is_refreshed_once():
+    from posterous.auth import TokenManager
+    import tempfile
+
+    server = start_fixture_server()
+    try:
+        path = os.path.join(tempfile.mkdtemp(), 'token')
+        api = fixture_api(server, username='user', password='pass',
+                          tokens=TokenManager(path))
+        api.api_token = 'expired'
+        FixtureHandler.rejected_tokens.add('expired')
+
+        assert len(api.get_sites()) == 2
+        assert len(token_requests()) == 1
+        with open(path) as f:
+            assert f.read() == 'fresh-token'
+
+        # another worker picks the token up from the file
+        other = fixture_api(server, username='user', password='pass',
+                            tokens=TokenManager(path))
+        other.api_token = None
+        other.get_sites()
+        assert len(token_requests()) == 1
+    finally:
+        server.shutdown()
+
+
+def test_token_bucket_spaces_out_requests():
+    from posterous.bind import TokenBucket
+
+    bucket = TokenBucket(rate=100, capacity=2)
+    assert bucket.reserve() == 0 and bucket.reserve() == 0
+    # the third and fourth requests wait for one and two refills
+    assert 0.005 < bucket.reserve() <= 0.01
+    assert 0.015 < bucket.reserve() <= 0.02
+    bucket.slow_down(0.5, min_rate=1)
+    assert bucket.rate == 50
+    bucket.speed_up(100)
+    assert bucket.rate == 100
+
+
+def test_rate_limiter_retries_and_backs_off():
+    from posterous.bind import RateLimiter
+
+    server = start_fixture_server()
+    try:
+        limiter = RateLimiter(rate=50, max_in_flight=4, base_delay=0.01,
+                              backoff_interval=0)
+        api = fixture_api(server, rate_limiter=limiter)
+        FixtureHandler.unavailable = 2
+
+        assert len(api.get_sites()) == 2
+        assert len(FixtureHandler.requests) == 3
+        assert limiter.throttled == 2 and limiter.retried == 2
+        # halved twice, then raised again by the successful retry
+        assert limiter.limit == 2
+        assert limiter.current_rate(id(api)) < 50
+        assert limiter.in_flight == 0 and limiter.queue_depth == 0
+
+        # writes are never retried
+        FixtureHandler.unavailable = 1
+        try:
+            api.create_site(name='new')
+            assert False, 'expected an error'
+        except Exception as e:
+            assert '503' in str(e)
+    finally:
+        server.shutdown()
+
+
+def test_rate_limiter_only_backs_off_when_throttled():
+    from posterous.bind import RateLimiter
+    import socket
+
+    # a port nothing listens on
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    limiter = RateLimiter(rate=50, max_in_flight=4, retries=1, base_delay=0.01,
+                          backoff_interval=0)
+    api = PostyAPI(rate_limiter=limiter)
+    api.host = 'http://127.0.0.1:{0}'.format(port)
+    api.api_token = 'token'
+    try:
+        api.get_sites()
+        assert False, 'expected a connection error'
+    except Exception:
+        pass
+    assert limiter.retried == 1 and limiter.throttled == 0
+    assert limiter.limit == 4 and limiter.current_rate(id(api)) == 50
+
+    method = PostyAPI.get_sites.api_method(api, (), {})
+    for status in (400, 404):
+        limiter.acquire(method)
+        limiter.release(method, status)
+    assert limiter.limit == 4 and limiter.current_rate(id(api)) == 50
+    for status in (429, 500, 503):
+        limiter.acquire(method)
+        limiter.release(method, status)
+    assert limiter.throttled == 3 and limiter.limit == 1
+    assert limiter.current_rate(id(api)) < 50 and limiter.in_flight == 0
+
+
+def test_rate_limiter_bounds_async_calls():
+    from posterous.bind import RateLimiter
+
+    class PeakLimiter(RateLimiter):
+        peak = 0
+
+        async def acquire_async(self, method):
+            await RateLimiter.acquire_async(self, method)
+            self.peak = max(self.peak, self.in_flight)
+
+    async def fetch_all(api):
+        async with api:
+            return await asyncio.gather(*[api.get_sites() for i in range(8)])
+
+    server = start_fixture_server()
+    try:
+        FixtureHandler.delay = 0.05
+        limiter = PeakLimiter(rate=1000, max_in_flight=2)
+        api = fixture_api(server, cls=AsyncPostyAPI, rate_limiter=limiter)
+        assert len(asyncio.run(fetch_all(api))) == 8
+        assert limiter.peak == 2
+        assert limiter.in_flight == 0 and limiter.queue_depth == 0
+    finally:
+        server.shutdown()
+
+
+def test_batch_sends_calls_concurrently():
+    server = start_fixture_server()
+    try:
+        api = fixture_api(server)
+        with api.batch(max_workers=4) as batch:
+            futures = [api.get_site(hostname='site{0}'.format(i)) for i in range(6)]
+            futures.append(api.get_site(hostname=42))
+            # nothing is sent before the block exits
+            assert not FixtureHandler.requests
+            assert not any(f.done() for f in futures)
+
+        assert len(FixtureHandler.requests) == 6
+        results = batch.results()
+        assert len(results) == 7 and results[-1] is None
+        assert all(site.hostname for site in results[:6])
+        assert futures[0].result() is results[0]
+        assert [(i, type(e)) for i, e in batch.errors] == [(6, TypeError)]
+
+        # calls block again outside the batch
+        assert len(api.get_sites()) == 2
+
+        # nothing is sent when the block raises
+        from concurrent.futures import CancelledError
+        try:
+            with api.batch() as batch:
+                api.get_site(hostname='site0')
+                api.get_site(hostname='site1')
+                raise ValueError('stop')
+        except ValueError:
+            pass
+        assert len(FixtureHandler.requests) == 7
+        assert batch.results() == [None, None]
+        assert [(i, type(e)) for i, e in batch.errors] == [(0, CancelledError),
+                                                           (1, CancelledError)]
+    finally:
+        server.shutdown()
+
+
+def test_identical_reads_share_one_request():
+    server = start_fixture_server()
+    try:
+        api = fixture_api(server)
+        FixtureHandler.delay = 0.2
+        results = []
+
+        def read():
+            results.append(api.get_site(hostname='popular'))
+
+        threads = [threading.Thread(target=read) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(FixtureHandler.requests) == 1
+        assert api.inflight.shared == 4
+        assert len(set(id(site) for site in results)) == 5
+        assert all(site._api is api for site in results)
+        assert len(set(site.hostname for site in results)) == 1
+
+        # other parameters are a different request
+        FixtureHandler.delay = 0
+        api.get_site(hostname='other')
+        assert len(FixtureHandler.requests) == 2
+    finally:
+        server.shutdown()
+
+
+def test_histogram_percentiles():
+    from posterous.metrics import Histogram
+
+    histogram = Histogram()
+    for i in range(1, 1001):
+        histogram.add(i / 1000.0)
+    assert histogram.count == 1000
+    assert abs(histogram.percentile(50) - 0.5) < 0.5 * 0.05
+    assert abs(histogram.percentile(99) - 0.99) < 0.99 * 0.05
+    assert histogram.percentile(100) == 1.0
+    assert abs(histogram.mean - 0.5005) < 1e-9
+
+
+def test_metrics_record_each_phase_per_method():
+    from posterous.metrics import MetricsRegistry
+
+    server = start_fixture_server()
+    try:
+        metrics = MetricsRegistry()
+        calls = []
+        metrics.subscribe(lambda path, measurements: calls.append(path))
+        api = fixture_api(server, metrics=metrics)
+        for i in range(3):
+            api.get_sites()
+        api.read_posts(1)
+
+        assert calls == ['/users/{user_id}/sites'] * 3 + ['/users/{user_id}/sites/{site_id}/posts']
+        sites = metrics.summary()['/users/{user_id}/sites']
+        for name in ('queue', 'ttfb', 'transfer', 'parse', 'build',
+                     'request_bytes', 'response_bytes'):
+            assert sites[name]['count'] == 3
+        # the connection was opened once and reused afterwards
+        assert sites['connect']['count'] == 1
+        with open(get_file_name('sites.xml'), 'rb') as f:
+            assert sites['response_bytes']['max'] == len(f.read())
+        assert sites['ttfb']['p99'] >= sites['ttfb']['p50'] > 0
+        assert sites['error']['count'] == 3 and sites['error']['max'] == 0
+
+        # failed calls are recorded too
+        FixtureHandler.unavailable = 1
+        try:
+            api.get_primary_site()
+            assert False, 'expected an error'
+        except Exception:
+            pass
+        primary = metrics.summary()['/users/{user_id}/sites/primary']
+        assert primary['error']['count'] == 1 and primary['error']['mean'] == 1
+
+        # the queue time leaves out the attempt that was retried
+        from posterous.bind import RateLimiter
+        api = fixture_api(server, metrics=metrics, rate_limiter=RateLimiter(
+            rate=50, base_delay=0.01, max_delay=0.01, backoff_interval=0))
+        FixtureHandler.unavailable = 1
+        FixtureHandler.delay = 0.2
+        api.read_posts(1)
+        assert metrics.histogram('/users/{user_id}/sites/{site_id}/posts', 'queue').max < 0.1
+    finally:
+        server.shutdown()
+
+
+def test_metrics_record_coalesced_and_iterator_calls():
+    from posterous.metrics import MetricsRegistry
+
+    server = start_fixture_server()
+    try:
+        metrics = MetricsRegistry()
+        api = fixture_api(server, metrics=metrics)
+        FixtureHandler.delay = 0.2
+        threads = [threading.Thread(target=api.get_site, kwargs={'hostname': 'popular'})
+                   for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(FixtureHandler.requests) == 1
+        site = metrics.summary()['/users/{user_id}/sites']
+        assert site['error']['count'] == 3
+        assert site['coalesced']['count'] == 3 and site['coalesced']['mean'] == 2.0 / 3
+        assert site['wait']['count'] == 2 and site['wait']['min'] > 0.05
+
+        # recorded once the posts have been read, with their parse time
+        FixtureHandler.delay = 0
+        calls = []
+        metrics.subscribe(lambda path, measurements: calls.append(dict(measurements)))
+        posts = api.read_posts(1, iterator=True)
+        assert calls == []
+        assert len(list(posts)) > 0
+        assert len(calls) == 1
+        assert calls[0]['parse'] > 0 and calls[0]['build'] > 0
+        assert calls[0]['error'] == 0
+    finally:
+        server.shutdown()
+
+
+def model_attrs(value):
+    """The attributes of models, recursively, without their api."""
+    if isinstance(value, list):
+        return [model_attrs(v) for v in value]
+    if hasattr(value, '_api'):
+        return dict((k, model_attrs(v)) for k, v in vars(value).items()
+                    if k != '_api')
+    return value
+
+
+def test_json_responses_match_xml():
+    server = start_fixture_server()
+    try:
+        xml_api = fixture_api(server)
+        json_api = fixture_api(server, format='json')
+        for call in ('get_sites', 'read_posts'):
+            args = (1,) if call == 'read_posts' else ()
+            xml_models = getattr(xml_api, call)(*args)
+            json_models = getattr(json_api, call)(*args)
+            assert model_attrs(json_models) == model_attrs(xml_models)
+
+        assert FixtureHandler.accepts == ['text/xml, application/xml',
+                                          'application/json'] * 2
+        posts = json_api.read_posts(1, iterator=True)
+        assert [p.id for p in posts] == [m.id for m in xml_models]
+    finally:
+        server.shutdown()
+
+
+def test_call_plan_fills_path_placeholders():
+    api = PostyAPI()
+    api.api_token = 'token'
+    method = PostyAPI.read_posts.api_method(api, (5,), {'page': 2, 'tag': 'a b'})
+    http_method, url, body, headers = method.build_request()
+    path, query = url.split('?')
+    assert path == 'http://posterous.com/api/2/users/me/sites/5/posts'
+    assert sorted(query.split('&')) == ['api_token=token', 'page=2', 'tag=a+b']
+
+    method = PostyAPI.get_sites.api_method(api, ('some one',), {})
+    assert method.build_request()[1].startswith(
+        'http://posterous.com/api/2/users/some%20one/sites?')
+
+    method = PostyAPI.create_site.api_method(api, (), {'name': 'x', 'is_private': True})
+    http_method, url, body, headers = method.build_request()
+    assert url == 'http://posterous.com/api/2/users/me/sites'
+    assert sorted(body.split('&')) == ['api_token=token', 'is_private=1', 'name=x']
+
+    for args, kwargs in (((), {}), ((1,), {'site_id': 2}), ((1,), {'bogus': 1}),
+                         (('1',), {})):
+        try:
+            PostyAPI.read_posts.api_method(api, args, kwargs)
+            assert False, 'expected a TypeError for {0} {1}'.format(args, kwargs)
+        except TypeError:
+            pass
+
+
+def test_multipart_body_sends_bytes_fields_as_they_are():
+    from posterous.multipart import MultipartBody, Upload
+
+    body = MultipartBody([('body', b'caf\xc3\xa9 <b>'), ('title', 'caf\xe9'),
+                          ('autopost', 1), ('media', Upload(b'xyz', filename='a.txt'))],
+                         boundary='B')
+    content = b''.join(body)
+    assert len(content) == body.length
+    assert b'name="body"\r\n\r\ncaf\xc3\xa9 <b>\r\n' in content
+    assert b'name="title"\r\n\r\ncaf\xc3\xa9\r\n' in content
+    assert b'name="autopost"\r\n\r\n1\r\n' in content
+    assert b"b'" not in content
+
+
+def test_new_post_streams_media_uploads():
+    from email.parser import BytesParser
+    from posterous.models import Post
+    from posterous.multipart import Upload
+    import hashlib
+    import io
+    import tempfile
+
+    content = os.urandom(300000)
+    path = os.path.join(tempfile.mkdtemp(), 'clip.mp4')
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    def parts(headers, body):
+        message = BytesParser().parsebytes(
+            'Content-Type: {0}\r\n\r\n'.format(headers['Content-Type']).encode('ascii') + body)
+        return [(part.get_param('name', header='Content-Disposition'),
+                 part.get_filename(), part.get_content_type(),
+                 part.get_payload(decode=True)) for part in message.get_payload()]
+
+    server = start_fixture_server()
+    try:
+        api = fixture_api(server)
+        progress = []
+        upload = Upload(path)
+        post = api.new_post(1, title='Clip', media=[upload, b'raw'],
+                            progress=lambda sent, total: progress.append((sent, total)))
+        assert isinstance(post, Post)
+        headers, body = FixtureHandler.posted[-1]
+        assert FixtureHandler.requests[-1][1] == '/api/2/users/me/sites/1/posts'
+        assert headers['Content-Length'] == str(len(body))
+        assert sorted(parts(headers, body)) == sorted([
+            ('title', None, 'text/plain', b'Clip'),
+            ('api_token', None, 'text/plain', b'token'),
+            ('media[]', 'clip.mp4', 'video/mp4', content),
+            ('media[]', 'upload', 'application/octet-stream', b'raw')])
+        assert upload.digest == hashlib.md5(content).hexdigest()
+        assert progress[-1] == (len(body), len(body))
+        assert len(progress) > 3
+
+        # the asyncio transport writes the same body from a file object
+        async def main():
+            async with fixture_api(server, AsyncPostyAPI) as api:
+                with open(path, 'rb') as f:
+                    f.seek(100)
+                    await api.new_post(1, media=Upload(f, checksum=None))
+        asyncio.run(main())
+        headers, body = FixtureHandler.posted[-1]
+        assert parts(headers, body)[0][1:] == ('clip.mp4', 'video/mp4', content[100:])
+    finally:
+        server.shutdown()
+
+
+def test_cursor_stops_on_short_page():
+    from posterous.cursor import Cursor
+
+    calls = []
+    def read_posts(site_id, page=None, num_posts=None):
+        calls.append(page)
+        return list(range((page - 1) * num_posts, min(page * num_posts, 7)))
+
+    for prefetch in (0, 1, 3):
+        del calls[:]
+        items = list(Cursor(read_posts, 1, per_page=3, prefetch=prefetch).items())
+        assert items == list(range(7))
+        assert calls == [1, 2, 3]
+
+
+def test_cursor_prefetches_next_page():
+    from posterous.cursor import Cursor
+
+    fetched = []
+    ready = threading.Event()
+    def read_posts(site_id, page=None, num_posts=None):
+        fetched.append(page)
+        if page == 2:
+            ready.set()
+        return [page] * num_posts
+
+    pages = Cursor(read_posts, 1, per_page=2, prefetch=1).pages()
+    assert next(pages) == [1, 1]
+    # page 2 is fetched while page 1 is consumed, but nothing further
+    assert ready.wait(5)
+    time.sleep(0.05)
+    assert fetched == [1, 2]
+    pages.close()
+
+
+def test_cursor_reraises_errors():
+    from posterous.cursor import Cursor
+
+    def read_posts(site_id, page=None, num_posts=None):
+        if page == 2:
+            raise ValueError('boom')
+        return [1, 2]
+
+    items = []
+    try:
+        for item in Cursor(read_posts, 1, per_page=2).items():
+            items.append(item)
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected the error of page 2'
+    assert items == [1, 2]
+
+
+def fixture_models(name, model):
+    from posterous.parsers import XMLParser
+
+    class Method(object):
+        payload_list = True
+
+    with open(get_file_name(name), 'rb') as f:
+        return [model.parse_obj(None, d) for d in XMLParser().parse(Method, f.read())]
+
+
+class FakeBackupAPI(object):
+    """Serves the fixture site and its posts one per page."""
+    def __init__(self):
+        from posterous.models import Post, Site
+        self.sites = fixture_models('sites.xml', Site)[:1]
+        # newest first, like the server
+        self.posts = fixture_models('posts.xml', Post)[::-1]
+        self.pages = []
+
+    def get_sites(self):
+        return self.sites
+
+    def read_posts(self, site_id, page=None, num_posts=None):
+        self.pages.append(page)
+        return self.posts[(page - 1) * num_posts:page * num_posts]
+
+
+class FakeMediaEngine(BackupEngine):
+    """Writes each media url into its file instead of downloading it."""
+    fail_for = None
+
+    def download_media(self, post, media, path):
+        if post.id == self.fail_for:
+            raise IOError('connection dropped')
+        with open(path, 'w') as f:
+            f.write(media.url)
+        return 'checksum'
+
+
+def test_backup_engine_keeps_folder_layout():
+    from posterous.backup import BackupEngine
+    import json
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    api = FakeBackupAPI()
+    stats = FakeMediaEngine(api, folder, batch_size=1, page_workers=3).run()
+
+    site_folder = os.path.join(folder, 'sachin')
+    files = set(os.listdir(site_folder))
+    assert {'private', 'site-sachin.json', 'brunch-in-san-francisco.json',
+            'brunch-in-san-francisco_0.jpg', 'brunch-in-san-francisco_1.mp3',
+            'brunch-in-san-francisco_2.avi'} <= files
+    with open(os.path.join(site_folder, 'brunch-in-san-francisco.json')) as f:
+        post = json.load(f)
+    assert post['title'] == 'Brunch in San Francisco'
+    assert post['comments'][0]['author'] == 'sachin'
+    assert stats.posts == 4 and stats.sites == 1 and not stats.errors
+    # page 5 comes back empty and ends the site
+    assert stats.pages == 5
+
+
+def test_backup_rerun_skips_unchanged_posts():
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    api = FakeBackupAPI()
+    first = FakeMediaEngine(api, folder, batch_size=1).run()
+    assert first.posts == 4 and first.media == 4
+
+    api.pages = []
+    second = FakeMediaEngine(api, folder, batch_size=1, page_workers=1).run()
+    assert second.posts == 0 and second.media == 0
+    # the second page only has posts older than the checkpoint
+    assert api.pages == [1, 2]
+
+    # a new comment makes the post stale again
+    api.posts[0].commentscount = 5
+    third = FakeMediaEngine(api, folder, batch_size=1, page_workers=1).run()
+    assert third.posts == 1
+
+    # so does a missing or cut short post file
+    from posterous.backup import post_slug
+    os.remove(os.path.join(folder, 'sachin', post_slug(api.posts[0]) + '.json'))
+    with open(os.path.join(folder, 'sachin', post_slug(api.posts[1]) + '.json'), 'r+') as f:
+        f.truncate(10)
+    fourth = FakeMediaEngine(api, folder, batch_size=1, page_workers=1).run()
+    assert fourth.posts == 2
+
+
+def test_backup_rerun_retries_a_post_that_failed_to_save():
+    from posterous.backup import Manifest
+    from posterous.models import Post
+    import tempfile
+
+    class FailingEngine(FakeMediaEngine):
+        def write_json(self, obj, path):
+            if isinstance(obj, Post) and obj.id == 55:
+                raise IOError('disk full')
+            FakeMediaEngine.write_json(self, obj, path)
+
+    folder = tempfile.mkdtemp()
+    api = FakeBackupAPI()
+    stats = FailingEngine(api, folder, batch_size=1, page_workers=1).run()
+    # the post has 3 media, none of them were started
+    assert stats.errors == ['backup_post failed for post 55: disk full']
+    manifest = Manifest.load(os.path.join(folder, 'sachin', 'manifest-sachin.json'))
+    assert manifest.checkpoint is None and manifest.resume_page == 3
+
+    stats = FakeMediaEngine(api, folder, batch_size=1, page_workers=1).run()
+    assert stats.posts == 1 and not stats.errors
+    assert os.path.exists(os.path.join(folder, 'sachin', 'brunch-in-san-francisco.json'))
+
+
+def test_backup_manifest_checks_pack_records():
+    from posterous.backup import Manifest, pack_path
+    from posterous.pack import PackWriter
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    api = FakeBackupAPI()
+    FakeMediaEngine(api, folder, batch_size=1, format='pack').run()
+    site_folder = os.path.join(folder, 'sachin')
+    manifest = Manifest.load(os.path.join(site_folder, 'manifest-sachin.json'))
+    newest, other = api.posts[:2]
+    with PackWriter(pack_path(site_folder)) as pack:
+        assert all(manifest.is_current(post, site_folder, pack) for post in api.posts)
+        # the record in the pack isn't the one the manifest saw
+        manifest.posts[str(newest.id)]['record']['crc32'] += 1
+        assert not manifest.is_current(newest, site_folder, pack)
+        # or it is gone, e.g. dropped after a killed run cut it short
+        del pack.entries[other.id]
+        assert not manifest.is_current(other, site_folder, pack)
+
+
+def test_backup_resumes_from_last_completed_page():
+    from posterous.backup import Manifest
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    api = FakeBackupAPI()
+    engine = FakeMediaEngine(api, folder, batch_size=1, page_workers=1)
+    # the oldest post, on the last page, loses all three media downloads
+    engine.fail_for = 55
+    assert len(engine.run().errors) == 3
+
+    manifest = Manifest.load(os.path.join(folder, 'sachin', 'manifest-sachin.json'))
+    assert manifest.resume_page == 3
+    assert manifest.checkpoint is None
+
+    api.pages = []
+    stats = FakeMediaEngine(api, folder, batch_size=1, page_workers=1).run()
+    assert api.pages[0] == 3
+    assert stats.posts == 1 and not stats.errors
+    manifest = Manifest.load(os.path.join(folder, 'sachin', 'manifest-sachin.json'))
+    assert manifest.resume_page is None
+    assert manifest.checkpoint == datetime(2010, 2, 11, 8, 52, 22)
+
+
+def test_pack_layout_matches_folder_layout():
+    from posterous.backup import folder_to_pack, pack_to_folder
+    from posterous.pack import PackReader, PackWriter
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    FakeMediaEngine(FakeBackupAPI(), folder, batch_size=1).run()
+    packed = tempfile.mkdtemp()
+    FakeMediaEngine(FakeBackupAPI(), packed, batch_size=1, format='pack').run()
+
+    site_folder = os.path.join(folder, 'sachin')
+    pack_folder = os.path.join(packed, 'sachin')
+    assert 'brunch-in-san-francisco.json' not in os.listdir(pack_folder)
+    assert 'brunch-in-san-francisco_0.jpg' in os.listdir(pack_folder)
+    path = os.path.join(pack_folder, 'posts-sachin.pack')
+    with PackReader(path) as pack:
+        pack.verify()
+        assert len(pack) == 4 and pack.ids() == [55, 10529618, 10537108, 11502888]
+        with open(os.path.join(site_folder, 'brunch-in-san-francisco.json'), 'rb') as f:
+            assert pack.raw(55) == f.read()
+        assert pack.get(55)['comments'][0]['author'] == 'sachin'
+        assert pack.get(1) is None
+        assert [post['id'] for post in pack.between(datetime(2010, 1, 25),
+                                                    datetime(2010, 2, 1))] == [10529618, 10537108]
+
+    # a post saved again after the index was written, and one cut short
+    writer = PackWriter(path)
+    writer.add(55, datetime(2011, 1, 1), b'{"id": 55, "title": "again"}')
+    writer._file.write(b'half a record')
+    writer._file.close()
+    with PackReader(path) as pack:
+        assert len(pack) == 4 and pack.get(55)['title'] == 'again'
+        assert [post['id'] for post in pack][-1] == 55
+    PackWriter(path).close()
+    with PackReader(path) as pack:
+        pack.verify()
+        assert pack.get(55)['title'] == 'again'
+
+    # the converters go both ways without changing a byte
+    def json_files():
+        contents = {}
+        for name in os.listdir(site_folder):
+            if name.endswith('.json'):
+                with open(os.path.join(site_folder, name), 'rb') as f:
+                    contents[name] = f.read()
+        return contents
+    before = json_files()
+    folder_to_pack(site_folder, remove=True)
+    assert not os.path.exists(os.path.join(site_folder, 'brunch-in-san-francisco.json'))
+    pack_to_folder(site_folder, remove=True)
+    assert json_files() == before
+    assert not os.path.exists(os.path.join(site_folder, 'posts-sachin.pack'))
+
+
+def test_mirror_serves_read_calls():
+    from posterous.error import PosterousError
+    from posterous.mirror import Mirror, MirrorAPI
+    from posterous.models import Tag
+
+    class FakeTagsAPI(FakeBackupAPI):
+        def get_tags(self, site_id):
+            return [Tag.parse_obj(self, {'tag_string': 'art', 'count': 2})]
+
+    live = FakeTagsAPI()
+    live.posts[1].tags = ['art']
+    live.posts[3].tags = [{'tag_string': 'art'}, {'tag_string': 'food'}]
+    mirror = Mirror(':memory:')
+    assert mirror.sync(live, per_page=2) == {'sites': 1, 'posts': 4, 'deleted': 0}
+
+    # nothing changed, so the first page ends the sync
+    live.pages = []
+    assert mirror.sync(live, per_page=2)['posts'] == 0 and live.pages == [1]
+
+    api = MirrorAPI(mirror)
+    site = api.get_primary_site()
+    assert api.get_site(hostname='sachin').id == site.id == 1
+    assert [post.id for post in site.read_posts(page=2, num_posts=3)] == [55]
+    assert [post.id for post in site.read_posts(tag='art')] == [10537108, 55]
+    assert [post.id for post in site.iter_posts(per_page=1)] == [
+        11502888, 10537108, 10529618, 55]
+    assert [str(tag) for tag in site.tags()] == ['art']
+
+    post = api.read_posts(1, since_id=10537108)[0]
+    assert post.id == 11502888 and post.date == datetime(2010, 2, 11, 8, 52, 22)
+    brunch = api.posts_between(1, datetime(2009, 5, 1), datetime(2009, 6, 1))[0]
+    assert brunch.title == 'Brunch in San Francisco' and len(brunch.media) == 3
+    assert brunch.comments[0].author == 'sachin' and brunch.comments[0]._api is api
+    assert [post.id for post in api.search_posts('brunch')] == [55]
+    assert api.search_posts('posterous_bookmarklet_entry') == []
+    # punctuation and FTS5 keywords are searched for, not parsed
+    for text in ('great brunch!', '"brunch', 'brunch?'):
+        assert [post.id for post in api.search_posts(text)] == [55], text
+    for text in ("don't", 'C++', 'e-mail', 'brunch AND', 'NOT', ''):
+        assert api.search_posts(text) == [], text
+    assert sorted(post.id for post in api.search_posts('brunch OR touchtable', raw=True)) == [
+        55, 10529618]
+    # without FTS5 every word is matched as a substring
+    mirror.fts = False
+    assert [post.id for post in api.search_posts('great brunch!')] == [55]
+    assert api.search_posts('100%') == [] and api.search_posts('e-mail') == []
+    mirror.fts = True
+    for call, error in ((lambda: api.get_site(hostname='nobody'), PosterousError),
+                        (lambda: api.new_post, AttributeError)):
+        try:
+            call()
+            assert False, 'expected {0}'.format(error.__name__)
+        except error:
+            pass
+
+    # a full sync drops the posts the site no longer has
+    del live.posts[0]
+    assert mirror.sync(live, full=True)['deleted'] == 1
+    assert [post.id for post in site.read_posts()] == [10537108, 10529618, 55]
+    assert api.search_posts('FastCompany') == []
+
+
+def test_mirror_sync_finishes_an_interrupted_one():
+    from posterous.mirror import Mirror
+
+    class FlakyAPI(FakeBackupAPI):
+        fail_at = 3
+
+        def read_posts(self, site_id, page=None, num_posts=None):
+            if page == self.fail_at:
+                raise IOError('connection dropped')
+            return FakeBackupAPI.read_posts(self, site_id, page, num_posts)
+
+    live = FlakyAPI()
+    mirror = Mirror(':memory:')
+    try:
+        mirror.sync(live, per_page=1)
+        assert False, 'expected an error'
+    except IOError:
+        pass
+    assert mirror.sync_state(1) == (2, False)
+    assert len(mirror.post_versions(1)) == 2
+
+    # the older pages first, then the newest until nothing changed
+    live.fail_at = None
+    live.pages = []
+    assert mirror.sync(live, per_page=1)['posts'] == 2
+    assert live.pages[:5] == [2, 3, 4, 5, 1]
+    assert len(mirror.post_versions(1)) == 4
+    assert mirror.sync_state(1) == (None, True)
+
+    # the next page may have been prefetched
+    live.pages = []
+    assert mirror.sync(live, per_page=1)['posts'] == 0 and live.pages[0] == 1
+    assert len(live.pages) <= 2
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves a file with support for Range requests."""
+    protocol_version = 'HTTP/1.1'
+    content = bytes(range(256)) * 400
+    ranges = []
+
+    def do_GET(self):
+        if self.path == '/redirect/file.bin':
+            self.send_response(302)
+            self.send_header('Location', '/files/file.bin')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start = 0
+        byte_range = self.headers.get('Range')
+        MediaHandler.ranges.append(byte_range)
+        if byte_range:
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                    start, len(self.content) - 1, len(self.content)))
+        else:
+            self.send_response(200)
+        body = self.content[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_media_download_resumes_partial_file():
+    from posterous.models import Media
+    import hashlib
+    import tempfile
+
+    MediaHandler.ranges = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        base = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+        media = Media.parse_obj(PostyAPI(), {'type': 'video',
+                                             'url': base + '/redirect/file.bin',
+                                             'filesize': 100,
+                                             'mp4': base + '/files/movie.mp4'})
+        assert media.best_source() == (base + '/redirect/file.bin', 100)
+        assert media.best_source(prefer=('mp4',))[0] == base + '/files/movie.mp4'
+
+        folder = tempfile.mkdtemp()
+        with open(os.path.join(folder, 'file.bin.part'), 'wb') as f:
+            f.write(MediaHandler.content[:30000])
+
+        progress = []
+        checksum = hashlib.sha1()
+        path = media.download(folder, chunk_size=4096, hasher=checksum,
+                              progress=lambda done, total: progress.append((done, total)))
+
+        assert path == os.path.join(folder, 'file.bin')
+        with open(path, 'rb') as f:
+            assert f.read() == MediaHandler.content
+        assert not os.path.exists(path + '.part')
+        assert MediaHandler.ranges == ['bytes=30000-']
+        assert checksum.hexdigest() == hashlib.sha1(MediaHandler.content).hexdigest()
+        assert progress[-1] == (102400, 102400)
+        assert progress[0][0] == 30000 + 4096
+    finally:
+        server.shutdown()
+
+
+def test_media_of_async_api_downloads():
+    from posterous.models import Media
+    import tempfile
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        api = AsyncPostyAPI()
+        media = Media.parse(api, [{'url': 'http://127.0.0.1:{0}/files/a.bin'.format(
+            server.server_address[1])}])[0]
+        path = media.download(os.path.join(tempfile.mkdtemp(), 'a.bin'))
+        with open(path, 'rb') as f:
+            assert f.read() == MediaHandler.content
+        assert api.blocking_transport.stats.requests == 1
+        asyncio.run(api.close())
+    finally:
+        server.shutdown()
+
+
+def test_blob_store_deduplicates_media():
+    from posterous.backup import BlobStore
+    from posterous.models import Media
+    import tempfile
+
+    MediaHandler.ranges = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        base = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+        api = PostyAPI()
+        first = Media.parse_obj(api, {'url': base + '/files/a.bin'})
+        repost = Media.parse_obj(api, {'url': base + '/files/a.bin'})
+        copy = Media.parse_obj(api, {'url': base + '/files/b.bin'})
+
+        folder = tempfile.mkdtemp()
+        store = BlobStore(os.path.join(folder, 'blobs'))
+        paths = [os.path.join(folder, name) for name in ('one', 'two', 'three')]
+        checksums = [store.fetch(m, p) for m, p in zip((first, repost, copy), paths)]
+
+        assert len(set(checksums)) == 1
+        # the repost was linked by url, the copy dropped after hashing
+        assert len(MediaHandler.ranges) == 2
+        assert store.url_hits == 1 and store.hash_hits == 1
+        assert len(set(os.stat(p).st_ino for p in paths)) == 1
+        with open(paths[2], 'rb') as f:
+            assert f.read() == MediaHandler.content
+
+        store.save_index()
+        assert BlobStore(os.path.join(folder, 'blobs')).urls == store.urls
+    finally:
+        server.shutdown()
+
+
+def test_blob_store_fetches_a_url_once_across_threads():
+    from posterous.backup import BlobStore
+    from posterous.models import Media
+    import tempfile
+
+    MediaHandler.ranges = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{0}/files/shared.bin'.format(server.server_address[1])
+        folder = tempfile.mkdtemp()
+        store = BlobStore(os.path.join(folder, 'blobs'))
+        start = threading.Barrier(4)
+        results, errors = [], []
+
+        def fetch(i):
+            start.wait()
+            try:
+                media = Media.parse_obj(PostyAPI(), {'url': url})
+                results.append(store.fetch(media, os.path.join(folder, str(i))))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert errors == [] and len(results) == 4 and len(set(results)) == 1
+        assert len(MediaHandler.ranges) == 1 and store.url_hits == 3
+        for i in range(4):
+            with open(os.path.join(folder, str(i)), 'rb') as f:
+                assert f.read() == MediaHandler.content
+    finally:
+        server.shutdown()
+
+
+def test_import_is_lazy():
+    # a fresh interpreter, so the modules these tests loaded don't count
+    code = 'import sys; import posterous; print(" ".join(sorted(sys.modules)))'
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    modules = set(output.decode('utf-8').split())
+    for heavy in ('posterous.api', 'posterous.bind', 'http.client',
+                  'xml.etree.ElementTree', 'json', 'concurrent.futures'):
+        assert heavy not in modules, heavy
+
+    # the api leaves out the modules of features that weren't used
+    code = ('import sys; from posterous.api import PostyAPI; '
+            'print(" ".join(sorted(sys.modules)))')
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    modules = set(output.decode('utf-8').split())
+    for optional in ('posterous.auth', 'posterous.batch', 'posterous.cache',
+                     'posterous.cursor', 'posterous.multipart', 'random'):
+        assert optional not in modules, optional
+
+    import posterous
+    assert posterous.API is PostyAPI
+    assert posterous.api is posterous.api and posterous.api.username is None